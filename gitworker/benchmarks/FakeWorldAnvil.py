@@ -0,0 +1,245 @@
+import json
+import random
+import threading
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+from http import HTTPStatus
+from time import sleep
+from urllib.parse import parse_qsl, urlsplit
+
+from requests import Response
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+
+PAGE_SIZE=50
+UNCATEGORIZED_UUID='-1'
+EPOCH=datetime(2024, 1, 1, tzinfo=timezone.utc)
+API_BASE_URL='https://www.worldanvil.com/api/external/boromir/'
+# API paths of the pywaclient calls WAClient makes, by the endpoint method they belong to
+API_PATHS={
+    'identity': 'user.identity',
+    'user/worlds': 'user.worlds',
+    'world/categories': 'world.categories',
+    'world/articles': 'world.articles',
+    'world/images': 'world.images',
+    'world/maps': 'world.maps',
+    'world/blockfolders': 'world.statblock_folders',
+    'blockfolder/blocks': 'block_folder.blocks',
+    'world': 'world.get',
+    'category': 'category.get',
+    'article': 'article.get',
+    'image': 'image.get',
+    'map': 'map.get',
+    'block': 'block.get',
+    'blockfolder': 'block_folder.get'
+}
+
+
+class APIRequest:
+    """
+    A World Anvil API request as the endpoint method call it came from:
+    'endpoint' such as 'article.get' or 'world.articles', and its arguments.
+    Listings are POSTed a page at a time; 'offset' is that page's.
+    """
+    def __init__(self, request):
+        url=urlsplit(request.url)
+        path=url.path.removeprefix(urlsplit(API_BASE_URL).path)
+        params=dict(parse_qsl(url.query))
+        content=json.loads(request.body) if request.body else {}
+        self.endpoint=API_PATHS.get(path, path)
+        self.listing='offset' in content
+        self.offset=content.get('offset', 0)
+        self.headers=request.headers
+        if self.endpoint == 'user.identity':
+            self.args=[]
+        elif self.listing:
+            parents=[value['id'] for key, value in content.items() if isinstance(value, dict)]
+            self.args=[params.get('id'), *parents]
+        else:
+            self.args=[params.get('id'), int(params.get('granularity', -1))]
+
+
+class WorldAnvilAdapter(BaseAdapter):
+    """
+    requests transport adapter answering World Anvil API requests from 'api',
+    a FakeWorldAnvil or ReplayWorldAnvil. Mounted on a WAClient's transport
+    session, requests go through pywaclient and the transport as they would
+    to the real API. GET responses carry an ETag of their body and answer a
+    matching If-None-Match with 304 Not Modified and no body.
+    """
+    def __init__(self, api):
+        super().__init__()
+        self.api=api
+
+    def send(self, request, **kwargs):
+        status, body, headers=self.api.respond(APIRequest(request))
+        content=json.dumps(body).encode('utf-8')
+        if request.method == 'GET' and status == 200:
+            etag=f'"{blake2b(content, digest_size=16).hexdigest()}"'
+            headers={**headers, 'ETag': etag}
+            if request.headers.get('If-None-Match') == etag:
+                status, content=304, b''
+        response=Response()
+        response.status_code=status
+        response.reason=HTTPStatus(status).phrase
+        response.headers=CaseInsensitiveDict(headers)
+        response._content=content
+        response.encoding='utf-8'
+        response.url=request.url
+        response.request=request
+        return response
+
+    def close(self):
+        pass
+
+def mount(api, wacli):
+    # Serve the API requests of 'wacli' from 'api'
+    wacli.transport.session.mount(API_BASE_URL, WorldAnvilAdapter(api))
+
+
+class FakeWorldAnvil:
+    """
+    In-memory World Anvil: one user owning synthetic worlds, categories and
+    articles, served to pywaclient through a WorldAnvilAdapter. Every request
+    is counted and delayed by 'latency_s' (plus up to 'jitter_s'); collection
+    listings cost one request per page of PAGE_SIZE, like pywaclient's scrolling. advance() moves the clock one cycle and edits a
+    'change_rate' fraction of the articles.
+    """
+    def __init__(self, worlds:int=1, categories_per_world:int=10, articles:int=1000,
+                 content_bytes:int=2000, change_rate:float=0.01,
+                 latency_s:float=0.0, jitter_s:float=0.0, seed:int=0):
+        self.rng=random.Random(seed)
+        self.content_bytes=content_bytes
+        self.change_rate=change_rate
+        self.latency_s=latency_s
+        self.jitter_s=jitter_s
+        self.calls=Counter()
+        self.lock=threading.Lock()
+        self.clock=EPOCH
+        self.vocabulary=[''.join(self.rng.choices('abcdefghijklmnopqrstuvwxyz', k=self.rng.randint(2, 10))) for _ in range(1024)]
+        self.user={'id': self.new_uuid(), 'username': 'benchmark'}
+        self.worlds={}
+        self.categories={}
+        self.articles={}
+        self.listings={}
+        self.generate(worlds, categories_per_world, articles)
+
+    # Generation section
+    def new_uuid(self)->str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+    def date(self)->dict:
+        return {'date': self.clock.strftime('%Y-%m-%d %H:%M:%S.000000'), 'timezone_type': 3, 'timezone': 'UTC'}
+
+    def text(self)->str:
+        # Average word length plus separator is ~7 bytes
+        return ' '.join(self.rng.choices(self.vocabulary, k=max(1, self.content_bytes // 7)))
+
+    def generate(self, worlds:int, categories_per_world:int, articles:int):
+        for world_index in range(max(1, worlds)):
+            world_uuid=self.new_uuid()
+            self.worlds[world_uuid]={'id': world_uuid, 'title': f'World {world_index}',
+                                     'url': f'https://www.worldanvil.com/w/world-{world_index}',
+                                     'description': self.text(), 'updateDate': self.date()}
+            for category_index in range(categories_per_world):
+                category_uuid=self.new_uuid()
+                self.categories[category_uuid]={'id': category_uuid, 'title': f'Category {category_index}',
+                                                'url': f'https://www.worldanvil.com/w/world-{world_index}/c/category-{category_index}',
+                                                'world': world_uuid, 'description': self.text(),
+                                                'updateDate': self.date()}
+        world_uuids=list(self.worlds)
+        world_categories={world_uuid: [cat_uuid for cat_uuid, cat in self.categories.items() if cat['world'] == world_uuid]
+                          for world_uuid in world_uuids}
+        for article_index in range(articles):
+            world_uuid=world_uuids[article_index % len(world_uuids)]
+            category_uuids=world_categories[world_uuid]
+            # Roughly one article in ten is left uncategorized
+            category_uuid=self.rng.choice(category_uuids) if category_uuids and self.rng.random() > 0.1 else UNCATEGORIZED_UUID
+            article_uuid=self.new_uuid()
+            self.articles[article_uuid]={'id': article_uuid, 'title': f'Article {article_index}',
+                                         'url': f'https://www.worldanvil.com/w/world/a/article-{article_index}',
+                                         'world': world_uuid, 'category': category_uuid,
+                                         'content': self.text(), 'updateDate': self.date()}
+            self.listings.setdefault((world_uuid, category_uuid), []).append(article_uuid)
+
+    def advance(self)->int:
+        # Next cycle: edit a random sample of articles; returns how many changed
+        self.clock += timedelta(minutes=1)
+        changed=self.rng.sample(list(self.articles), k=min(len(self.articles), round(len(self.articles) * self.change_rate)))
+        for article_uuid in changed:
+            article=self.articles[article_uuid]
+            article['content']=self.text()
+            article['updateDate']=self.date()
+        return len(changed)
+
+    # API section
+    def call(self, endpoint:str):
+        with self.lock:
+            self.calls[endpoint] += 1
+        if self.latency_s or self.jitter_s:
+            sleep(self.latency_s + self.rng.uniform(0, self.jitter_s))
+
+    def reset_calls(self)->dict:
+        with self.lock:
+            calls=dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def respond(self, request:APIRequest)->tuple:
+        # (status, body, headers) of an API request; listings cost one call per page
+        self.call(request.endpoint)
+        if request.listing:
+            entities=self.listing(request.endpoint, request.args)
+            return 200, {'success': True, 'entities': entities[request.offset:request.offset + PAGE_SIZE]}, {}
+        obj=self.get(request.endpoint, request.args)
+        if obj is None:
+            return 404, {'success': False, 'error': 'Not found'}, {}
+        return 200, {'success': True, **obj}, {}
+
+    def listing(self, endpoint:str, args:list)->list:
+        match endpoint:
+            case 'user.worlds':
+                if args[0] != self.user['id']:
+                    return []
+                return [{'id': world['id'], 'title': world['title'], 'url': world['url']} for world in self.worlds.values()]
+            case 'world.categories':
+                return [{'id': cat['id'], 'title': cat['title']} for cat in self.categories.values() if cat['world'] == args[0]]
+            case 'world.articles':
+                if len(args) == 1:
+                    article_uuids=[art_uuid for art_uuid, art in self.articles.items() if art['world'] == args[0]]
+                else:
+                    article_uuids=self.listings.get((args[0], args[1]), [])
+                # Listing entries carry summary fields such as the update date
+                return [{'id': art_uuid, 'title': self.articles[art_uuid]['title'],
+                         'updateDate': self.articles[art_uuid]['updateDate']} for art_uuid in article_uuids]
+            case _:
+                return []
+
+    def get(self, endpoint:str, args:list)->dict|None:
+        match endpoint:
+            case 'user.identity':
+                return dict(self.user)
+            case 'world.get':
+                objects, entity_class=self.worlds, 'World'
+            case 'category.get':
+                objects, entity_class=self.categories, 'Category'
+            case 'article.get':
+                objects, entity_class=self.articles, 'Article'
+            case _:
+                return None
+        obj=objects.get(args[0])
+        return self.view(obj, entity_class, args[1]) if obj is not None else None
+
+    def view(self, obj:dict, entity_class:str, granularity:int)->dict:
+        # Lower granularities return fewer fields, as the beacon calls do
+        view={'id': obj['id'], 'title': obj['title'], 'entityClass': entity_class, 'updateDate': obj['updateDate']}
+        if 'url' in obj:
+            view['url']=obj['url']
+        if granularity >= 0:
+            view.update({key: value for key, value in obj.items() if key not in ('content', 'description')})
+        if granularity >= 1:
+            view.update(obj)
+        return view
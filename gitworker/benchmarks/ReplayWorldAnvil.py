@@ -0,0 +1,99 @@
+import json
+import threading
+from collections import Counter, deque
+from time import sleep
+
+from requests.exceptions import ConnectionError
+
+from FakeWorldAnvil import PAGE_SIZE, APIRequest
+from Recording import read_records
+
+
+# HTTP status of a recorded pywaclient exception class, when the recording has none
+REPLAYED_ERROR_STATUS={
+    'UnauthorizedRequest': 401,
+    'AccessForbidden': 403,
+    'ResourceNotFound': 404,
+    'UnprocessableDataProvided': 422,
+    'InternalServerException': 500
+}
+
+
+class ReplayWorldAnvil:
+    """
+    Serves a TrafficRecorder recording through a WorldAnvilAdapter. Calls are
+    matched on endpoint and arguments; repeated calls get the recorded
+    responses in order, and the last one again once they run out, so a
+    recording of several cycles replays its changes cycle by cycle. Recorded
+    listings are served a page at a time, and recorded errors as the HTTP
+    responses pywaclient raises them from. Each call is delayed by its
+    recorded latency times 'latency_scale' (0 for none).
+    """
+    def __init__(self, filepath:str, latency_scale:float=1.0):
+        self.latency_scale=latency_scale
+        self.calls=Counter()
+        self.lock=threading.Lock()
+        self.responses={}
+        self.listed={}
+        for record in read_records(filepath):
+            self.responses.setdefault(self.key(record['endpoint'], record['args']), deque()).append(record)
+        self.user=self.first_body('user.identity', [])
+        self.worlds={world['id']: world for world in self.first_body('user.worlds', [self.user['id']])}
+        self.articles={json.loads(key[1])[0] for key in self.responses if key[0] == 'article.get'}
+
+    @staticmethod
+    def key(endpoint:str, args:list)->tuple:
+        return (endpoint, json.dumps(args))
+
+    def first_body(self, endpoint:str, args:list):
+        responses=self.responses.get(self.key(endpoint, args))
+        if not responses:
+            raise ValueError(f"Recording has no '{endpoint}' response for {args}")
+        return responses[0]['body']
+
+    def advance(self):
+        # Changes between cycles come from the recording itself
+        return None
+
+    def reset_calls(self)->dict:
+        with self.lock:
+            calls=dict(self.calls)
+            self.calls.clear()
+        return calls
+
+    def respond(self, request:APIRequest)->tuple:
+        # (status, body, headers) of an API request; further pages of a listing come from the record of its first
+        key=self.key(request.endpoint, request.args)
+        with self.lock:
+            self.calls[request.endpoint] += 1
+            if request.listing and request.offset > 0 and key in self.listed:
+                record=self.listed[key]
+                return 200, {'success': True, 'entities': record['body'][request.offset:request.offset + PAGE_SIZE]}, {}
+            responses=self.responses.get(key)
+            if not responses:
+                return 404, {'success': False, 'error': 'Not recorded'}, {}
+            record=responses.popleft() if len(responses) > 1 else responses[0]
+            if request.listing:
+                self.listed[key]=record
+        if self.latency_scale:
+            sleep(record['latency_s'] * self.latency_scale)
+        if 'error' in record:
+            return self.replayed_error(record)
+        if request.listing:
+            return 200, {'success': True, 'entities': record['body'][:PAGE_SIZE]}, {}
+        return 200, {'success': True, **record['body']}, {}
+
+    @staticmethod
+    def replayed_error(record:dict)->tuple:
+        # The response pywaclient raises the recorded exception class and status from, so retries and
+        # error handling follow the recording; recordings without 'error_type' carry the class name in
+        # front of the message
+        error_type, _, message=record['error'].partition(': ')
+        error_type=record.get('error_type', error_type)
+        if error_type == 'ConnectionException':
+            raise ConnectionError(message)
+        headers={'Retry-After': str(record['retry_after'])} if record.get('retry_after') is not None else {}
+        if error_type == 'FailedRequest':
+            return 200, {'success': False, 'error': message}, headers
+        status=record.get('status') or REPLAYED_ERROR_STATUS.get(error_type, 500)
+        return status, {'success': False, 'error': message, 'trace': ''}, headers
@@ -0,0 +1,363 @@
+"""
+End-to-end benchmark of the gitworker tracking cycle.
+
+TrackObjectService runs against a FakeWorldAnvil, or a ReplayWorldAnvil
+serving recorded API traffic (mounted as a requests adapter under
+pywaclient's BoromirApiClient and WAClient's transport), and a temporary
+git repository with a local bare remote.
+Results are written as JSON: one record per cycle plus a summary, optionally
+compared against an earlier result file.
+
+    python benchmark.py --scale medium --cycles 5 --output medium.json
+    python benchmark.py --scale medium --cycles 5 --baseline medium.json
+    python benchmark.py --replay traffic.jsonl.gz --cycles 5 --latency-scale 0.5
+
+With --http-cache, GETs are revalidated against the fake's ETags through an
+HTTPCache, and the benchmark fails unless warm cycles skip hashing every
+unchanged beacon.
+
+With --crash-at-write, the first cycle runs in a child process that dies on
+that object write; the benchmark then recovers from its journal, runs the
+cycles and fails unless every object of the fake API reached HEAD.
+
+    python benchmark.py --articles 30 --categories-per-world 1 --max-objects-per-commit 5 --crash-at-write 12
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import wraps
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import APIClients
+import BackendUtils
+import gitworker
+import LogConfig
+import Metrics
+from APIUtils import RateLimiter
+from HTTPCache import HTTPCache
+import FakeWorldAnvil as fwa
+from Recording import TrafficRecorder
+from ReplayWorldAnvil import ReplayWorldAnvil
+
+
+SCALES={
+    'small': {'worlds': 1, 'categories_per_world': 3, 'articles': 10},
+    'medium': {'worlds': 1, 'categories_per_world': 20, 'articles': 1000},
+    'large': {'worlds': 2, 'categories_per_world': 100, 'articles': 50000}
+}
+REPO_NAME='benchmark-repo'
+UNLIMITED_REQUESTS_PER_S=1e9
+SUMMARY_METRICS=['cycle_wall_time_s', 'warm_cycle_wall_time_s', 'api_calls_per_cycle', 'hashes_per_warm_cycle',
+                 'registry_bytes_read', 'registry_bytes_written', 'commits', 'peak_rss_kb', 'peak_rss_children_kb']
+CRASH_EXIT_CODE=86
+
+
+class RegistryIOCounter:
+    """Counts the bytes of registry files read and written through BackendUtils.Registry."""
+    def __init__(self):
+        self.bytes_read=0
+        self.bytes_written=0
+
+    def install(self):
+        load_registry=BackendUtils.Registry.load_registry
+        write_registry=BackendUtils.Registry.write_registry
+
+        @wraps(load_registry)
+        def counted_load_registry(registry):
+            self.bytes_read += os.path.getsize(registry.reg_dir_filepath)
+            return load_registry(registry)
+
+        @wraps(write_registry)
+        def counted_write_registry(registry, reg):
+            write_registry(registry, reg)
+            self.bytes_written += os.path.getsize(registry.reg_dir_filepath)
+
+        BackendUtils.Registry.load_registry=counted_load_registry
+        BackendUtils.Registry.write_registry=counted_write_registry
+
+    def reset(self)->tuple:
+        counts=(self.bytes_read, self.bytes_written)
+        self.bytes_read=0
+        self.bytes_written=0
+        return counts
+
+
+def git(*args, cwd:str):
+    subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def setup_repository(workdir:str)->str:
+    # Working repository with empty registries, pushed to a local bare 'github-repo' remote
+    remote_path=os.path.join(workdir, 'remote.git')
+    repo_path=os.path.join(workdir, REPO_NAME)
+    git('init', '--bare', '-b', 'main', remote_path, cwd=workdir)
+    git('init', '-b', 'main', repo_path, cwd=workdir)
+    git('config', 'user.name', 'benchmark', cwd=repo_path)
+    git('config', 'user.email', 'benchmark@localhost', cwd=repo_path)
+    for reg_name in gitworker.REGISTRY_NAMES:
+        with open(os.path.join(repo_path, reg_name), mode='w') as reg:
+            json.dump({}, reg)
+    git('add', *gitworker.REGISTRY_NAMES, cwd=repo_path)
+    git('commit', '-m', 'Initial registries', cwd=repo_path)
+    git('remote', 'add', 'github-repo', remote_path, cwd=repo_path)
+    git('push', '-u', 'github-repo', 'main', cwd=repo_path)
+    return repo_path
+
+def configure_gitworker(args, workdir:str):
+    gitworker.REPO_PATH=workdir
+    gitworker.REGISTRY_BACKEND=args.registry_backend
+    gitworker.REGISTRY_DB_PATH=os.path.join(workdir, 'registry.db')
+    gitworker.JOURNAL_PATH=os.path.join(workdir, 'journal.jsonl')
+    gitworker.FILE_INDEX_MEMBERS_PATH=os.path.join(workdir, 'file_index_members.json')
+    gitworker.MAINTENANCE_STATE_PATH=os.path.join(workdir, 'maintenance_state.json')
+    gitworker.GIT_COMMIT_ENGINE=args.commit_engine
+    gitworker.PUSH_IN_BACKGROUND=not args.sync_push
+
+def commit_count(repo_path:str)->int:
+    return int(subprocess.run(['git', 'rev-list', '--count', 'HEAD'], cwd=repo_path, check=True,
+                              capture_output=True, text=True).stdout)
+
+def committed_uuids(repo_path:str)->set:
+    paths=subprocess.run(['git', 'ls-tree', '-r', '--name-only', 'HEAD'], cwd=repo_path, check=True,
+                         capture_output=True, text=True).stdout.split()
+    return {gitworker.Gitworker.path_uuid(path) for path in paths}
+
+def missing_objects(repo_path:str, fake)->list:
+    # Objects of the fake API that are not in HEAD
+    committed=committed_uuids(repo_path)
+    return [uuid for uuid in [*fake.worlds, *fake.categories, *fake.articles] if uuid not in committed]
+
+def peak_rss()->tuple:
+    # ru_maxrss is in kilobytes on Linux
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def metric_counts()->dict:
+    # Hashes computed, unchanged beacons, and HTTP cache results so far, from the metrics registry
+    snapshot=Metrics.snapshot()
+    counts={'hashes': sum(entry['count'] for entry in snapshot['histograms'].get('magpy_hash_seconds', [])),
+            'unchanged_beacons': sum(entry['value'] for entry in snapshot['metrics'].get('magpy_beacon_checks_total', [])
+                                     if entry['labels']['result'] == 'unchanged'),
+            'http_cache_beacon_hits': sum(entry['value'] for entry in snapshot['metrics'].get('magpy_beacon_cache_hits_total', []))}
+    for entry in snapshot['metrics'].get('magpy_http_cache_requests_total', []):
+        counts[f"http_cache_{entry['labels']['result']}"]=entry['value']
+    return counts
+
+def summarize(cycles:list)->dict:
+    warm=cycles[1:] or cycles
+    return {
+        'cycles': len(cycles),
+        'cycle_wall_time_s': sum(cycle['wall_time_s'] for cycle in cycles) / len(cycles),
+        'warm_cycle_wall_time_s': sum(cycle['wall_time_s'] for cycle in warm) / len(warm),
+        'api_calls_per_cycle': sum(cycle['api_calls'] for cycle in warm) / len(warm),
+        'hashes_per_warm_cycle': sum(cycle['hashes'] for cycle in warm) / len(warm),
+        'registry_bytes_read': sum(cycle['registry_bytes_read'] for cycle in cycles),
+        'registry_bytes_written': sum(cycle['registry_bytes_written'] for cycle in cycles),
+        'commits': sum(cycle['commits'] for cycle in cycles),
+        'peak_rss_kb': cycles[-1]['peak_rss_kb'],
+        'peak_rss_children_kb': cycles[-1]['peak_rss_children_kb']
+    }
+
+def compare(summary:dict, baseline_filepath:str)->dict:
+    with open(baseline_filepath, mode='r') as baseline_file:
+        baseline=json.load(baseline_file)['summary']
+    return {metric: {'baseline': baseline[metric],
+                     'current': summary[metric],
+                     'ratio': summary[metric] / baseline[metric] if baseline[metric] else None}
+            for metric in SUMMARY_METRICS if metric in baseline}
+
+def build_gitworker(args):
+    return gitworker.Gitworker(SimpleNamespace(repo_ssh_url=f'git@localhost:benchmark/{REPO_NAME}.git'),
+                               batch_commits=not args.no_batch_commits,
+                               max_objects_per_commit=args.max_objects_per_commit)
+
+def build_service(args, gitw, trackobjs:dict, fake, recorder=None, http_cache=None):
+    wacli=APIClients.WAClient(application_key='benchmark', authentication_token='benchmark',
+                              rate_limiter=RateLimiter(requests_per_s=args.rate_limit or UNLIMITED_REQUESTS_PER_S),
+                              http_cache=http_cache, listing_beacons=args.listing_beacons, recorder=recorder,
+                              pool_connections=args.fetch_workers)
+    fwa.mount(fake, wacli)
+    return gitworker.TrackObjectService(gitworker=gitw, trackobjs=trackobjs, apiclient=wacli,
+                                        max_workers=args.fetch_workers)
+
+def crash_first_cycle(args, fake, trackobjs:dict):
+    # Run a first cycle in a forked process that exits on its 'crash_at_write'th object write,
+    # leaving the repository, registries and journal as a crash would
+    def crashing_cycle():
+        gitw=build_gitworker(args)
+        write_object=gitw.commit_engine.write_object
+        writes=[0]
+        def write_or_crash(path, content):
+            writes[0] += 1
+            if writes[0] == args.crash_at_write:
+                os._exit(CRASH_EXIT_CODE)
+            write_object(path, content)
+        gitw.commit_engine.write_object=write_or_crash
+        build_service(args, gitw, trackobjs, fake).run_cycle()
+        os._exit(0)
+    process=multiprocessing.get_context('fork').Process(target=crashing_cycle)
+    process.start()
+    process.join()
+    if process.exitcode != CRASH_EXIT_CODE:
+        raise RuntimeError(f"The crashing cycle exited with code {process.exitcode}, before object write {args.crash_at_write}")
+    logging.warning(f"Crashed on object write {args.crash_at_write}, recovering")
+
+def run(args, workdir:str)->dict:
+    scale={key: getattr(args, key) if getattr(args, key) is not None else value for key, value in SCALES[args.scale].items()}
+    if args.replay:
+        fake=ReplayWorldAnvil(args.replay, latency_scale=args.latency_scale)
+    else:
+        fake=fwa.FakeWorldAnvil(**scale, content_bytes=args.content_bytes, change_rate=args.change_rate,
+                                latency_s=args.latency_ms / 1000, jitter_s=args.jitter_ms / 1000, seed=args.seed)
+    recorder=TrafficRecorder(args.record) if args.record else None
+    http_cache=HTTPCache(cache_dir=os.path.join(workdir, 'http_cache')) if args.http_cache else None
+    registry_io=RegistryIOCounter()
+    registry_io.install()
+
+    configure_gitworker(args, workdir)
+    repo_path=setup_repository(workdir)
+    trackobjs=gitworker.build_trackobjs(fake.user['id'], {world_uuid: {'world': True, 'categories': True, 'articles': True}
+                                                          for world_uuid in fake.worlds})
+    if args.crash_at_write:
+        crash_first_cycle(args, fake, trackobjs)
+    gitw=build_gitworker(args)
+    service=build_service(args, gitw, trackobjs, fake, recorder, http_cache)
+    fake.reset_calls()
+    registry_io.reset()
+    Metrics.reset()
+
+    cycles=[]
+    counted={}
+    try:
+        for cycle in range(args.cycles):
+            changed=fake.advance() if cycle > 0 else len(fake.articles)
+            commits_before=commit_count(repo_path)
+            started=time.perf_counter()
+            service.run_cycle()
+            wall_time_s=time.perf_counter() - started
+            calls=fake.reset_calls()
+            bytes_read, bytes_written=registry_io.reset()
+            rss, rss_children=peak_rss()
+            counts=metric_counts()
+            cycle_counts={name: count - counted.get(name, 0) for name, count in counts.items()}
+            counted=counts
+            cycles.append({
+                'cycle': cycle,
+                'articles_changed': changed,
+                'wall_time_s': wall_time_s,
+                'api_calls': sum(calls.values()),
+                'api_calls_by_endpoint': calls,
+                'hashes': cycle_counts.pop('hashes'),
+                'unchanged_beacons': cycle_counts.pop('unchanged_beacons'),
+                'http_cache': cycle_counts,
+                'registry_bytes_read': bytes_read,
+                'registry_bytes_written': bytes_written,
+                'commits': commit_count(repo_path) - commits_before,
+                'peak_rss_kb': rss,
+                'peak_rss_children_kb': rss_children
+            })
+            logging.warning(f"Cycle {cycle}: {wall_time_s:.3f}s, {sum(calls.values())} API calls, {changed} articles changed")
+    finally:
+        started=time.perf_counter()
+        gitw.shutdown()
+        service.apiclient.close()
+        push_drain_s=time.perf_counter() - started
+        if recorder is not None:
+            recorder.close()
+        if http_cache is not None:
+            http_cache.close()
+
+    summary=summarize(cycles)
+    summary['push_drain_s']=push_drain_s
+    result={
+        'benchmark': 'gitworker.TrackObjectService',
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {**vars(args), **scale},
+        'cycles': cycles,
+        'summary': summary,
+        'metrics': Metrics.snapshot()['summary']
+    }
+    if args.crash_at_write:
+        missing=missing_objects(repo_path, fake)
+        result['recovery']={'crashed_at_write': args.crash_at_write, 'objects_missing': len(missing), 'missing': missing}
+    if args.http_cache and not args.listing_beacons:
+        # Every beacon of the fake comes from a GET, so in a warm cycle each unchanged one is a cache hit, left unhashed
+        not_skipping=[cycle['cycle'] for cycle in cycles[1:]
+                      if cycle['http_cache']['http_cache_beacon_hits'] < cycle['unchanged_beacons']]
+        result['http_cache']={'cycles_not_skipping_hashes': not_skipping}
+    if args.baseline:
+        result['comparison']=compare(summary, args.baseline)
+    return result
+
+def parse_args():
+    parser=argparse.ArgumentParser(description='Benchmark the gitworker tracking cycle against a fake World Anvil API.')
+    parser.add_argument('--scale', choices=SCALES.keys(), default='small')
+    parser.add_argument('--worlds', type=int, help='override the number of worlds of --scale')
+    parser.add_argument('--categories-per-world', type=int, help='override the number of categories of --scale')
+    parser.add_argument('--articles', type=int, help='override the number of articles of --scale')
+    parser.add_argument('--content-bytes', type=int, default=2000, help='approximate article content size')
+    parser.add_argument('--change-rate', type=float, default=0.01, help='fraction of articles edited between cycles')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='latency added to every API call')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='random extra latency, up to this value')
+    parser.add_argument('--replay', help='serve a recorded API traffic file instead of the fake API')
+    parser.add_argument('--latency-scale', type=float, default=1.0, help='multiplier for replayed latencies, 0 for none')
+    parser.add_argument('--record', help='record the API traffic of this run to a file')
+    parser.add_argument('--http-cache', action='store_true',
+                        help='revalidate GETs through an HTTP cache; warm cycles must then skip hashing unchanged beacons')
+    parser.add_argument('--cycles', type=int, default=3, help='tracking cycles; the first one starts from empty registries')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fetch-workers', type=int, default=gitworker.FETCH_MAX_WORKERS)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='client requests per second, 0 for unlimited')
+    parser.add_argument('--registry-backend', choices=BackendUtils.REGISTRY_BACKENDS.keys(), default=gitworker.REGISTRY_BACKEND)
+    parser.add_argument('--commit-engine', choices=['index', 'odb'], default=gitworker.GIT_COMMIT_ENGINE)
+    parser.add_argument('--no-batch-commits', action='store_true', help='commit per section instead of per cycle')
+    parser.add_argument('--max-objects-per-commit', type=int, default=gitworker.GIT_MAX_OBJECTS_PER_COMMIT)
+    parser.add_argument('--crash-at-write', type=int, default=0,
+                        help='crash the first cycle on this object write, recover, and check that HEAD holds every object')
+    parser.add_argument('--sync-push', action='store_true', help='push in the tracking thread')
+    parser.add_argument('--listing-beacons', action='store_true', help='use article listing entries as beacons')
+    parser.add_argument('--baseline', help='earlier result file to compare the summary against')
+    parser.add_argument('--output', help='result file (default: stdout)')
+    parser.add_argument('--keep-repo', action='store_true', help='keep the temporary repository')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+if __name__=='__main__':
+    args=parse_args()
+    # Logs go to stderr, so stdout only carries the JSON result
+    LogConfig.configure(level=args.log_level, stream=sys.stderr)
+
+    workdir=tempfile.mkdtemp(prefix='gitworker-benchmark-')
+    try:
+        result=run(args, workdir)
+    finally:
+        if args.keep_repo:
+            logging.warning(f"Benchmark repository kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, mode='w') as output:
+            json.dump(result, output, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    if result.get('recovery', {}).get('objects_missing'):
+        logging.error(f"{result['recovery']['objects_missing']} objects missing from HEAD after crash recovery")
+        sys.exit(1)
+    if result.get('http_cache', {}).get('cycles_not_skipping_hashes'):
+        logging.error(f"Warm cycles {result['http_cache']['cycles_not_skipping_hashes']} hashed beacons the HTTP cache reported unchanged")
+        sys.exit(1)
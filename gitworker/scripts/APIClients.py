@@ -1,10 +1,18 @@
 import Utils
-from APIUtils import WorldAnvilUtils as wau
+import LogConfig
+from APIUtils import WorldAnvilUtils as wau, RateLimiter
+from Transport import APITransport, route_endpoints, HTTP_POOL_CONNECTIONS
 from pywaclient.api import BoromirApiClient
+import requests
 import logging
 import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import wraps
 from string import hexdigits
+from time import monotonic
+
+logger=logging.getLogger(__name__)
 
 
 
@@ -12,11 +20,63 @@ from string import hexdigits
 SCRIPT_NAME='gitworker.py'
 MAGPY_REPO_URL='https://github.com/Arghantyr/MagPy'
 SCRIPT_VERSION='0.1'
+MAPPING_CACHE_TTL_S=300
+LISTING_MAX_WORKERS=8
+UNCATEGORIZED_UUID='-1'
+# Types whose listing entries can stand in for beacons
+LISTING_BEACON_TYPES=['articles', 'images', 'maps']
+MAPPING_TYPES=['world', 'categories', 'articles', 'images', 'maps', 'article_blocks']
+DOWNLOAD_CHUNK_SIZE=64*1024
+DOWNLOAD_TIMEOUT_S=60
+
+
+
+class MappingCache(object):
+    """
+    Mapping responses keyed by (uuid, type). Entries expire after 'ttl_s' seconds
+    or when the cache is cleared at the start of a polling cycle. 'summaries'
+    holds the listing entry of every article, image and map seen in this
+    cycle's listings.
+    """
+    def __init__(self, ttl_s:float=MAPPING_CACHE_TTL_S):
+        self.ttl_s=ttl_s
+        self.entries={}
+        self.summaries={}
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+
+    def key(self, uuid:str, _type:str, args:tuple=(), kwargs:dict={}):
+        return (uuid, _type, repr(args), repr(sorted(kwargs.items())))
+
+    def get(self, key):
+        with self.lock:
+            entry=self.entries.get(key)
+            if entry is not None and monotonic() - entry[0] < self.ttl_s:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, key, mapping):
+        with self.lock:
+            self.entries[key]=(monotonic(), mapping)
+
+    def clear(self):
+        with self.lock:
+            logger.info(f"Mapping cache cleared. Entries: {len(self.entries)}, hits: {self.hits}, misses: {self.misses}")
+            self.entries={}
+            self.summaries={}
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
 
 
 
 class WAClient(object):
-    def __init__(self, application_key: str, authentication_token: str):
+    def __init__(self, application_key: str, authentication_token: str, rate_limiter: RateLimiter = None,
+                 http_cache=None, listing_beacons: bool = False, recorder=None,
+                 pool_connections: int = HTTP_POOL_CONNECTIONS):
         try:
             self.client=BoromirApiClient(
                     SCRIPT_NAME,
@@ -25,12 +85,27 @@ class WAClient(object):
                     application_key,
                     authentication_token
                     )
-            logging.info(f"WAClient object initiated...")
+            self.rate_limiter=rate_limiter or RateLimiter()
+            self.mapping_cache=MappingCache()
+            self.http_cache=http_cache
+            self.listing_beacons=listing_beacons
+            self.recorder=recorder
+            self.download_session=requests.Session()
+            # Every request of the client's endpoints is rate limited, retried and cached in the transport;
+            # the recorder wraps the endpoints' public methods, on top of it
+            self.transport=APITransport(rate_limiter=self.rate_limiter, http_cache=http_cache,
+                                        pool_connections=pool_connections)
+            route_endpoints(self.client, self.transport)
+            if self.recorder is not None:
+                self.recorder.install(self.client)
+            if self.http_cache is not None:
+                logger.info(f"HTTP cache enabled: {self.http_cache.cache_dir}")
+            logger.info(f"WAClient object initiated...")
 
             self.set_granularities()
             self.load_apimethods_mapping()
         except Exception as e:
-            logging.warning(f"Could not initiate WAClient")
+            logger.warning(f"Could not initiate WAClient")
             raise Exception(f"{e}")
     
     # Input verification decorators
@@ -75,102 +150,247 @@ class WAClient(object):
             self.track_gran={
                     'world': 1,
                     'categories': 1,
-                    'articles': 1
+                    'articles': 1,
+                    'images': 0,
+                    'maps': 1,
+                    'article_blocks': 1
             }
-            logging.info(f"Tracking granularities set:\n{json.dumps(self.track_gran, indent=2)}")
+            logger.info(f"Tracking granularities set:\n{json.dumps(self.track_gran, indent=2)}")
 
             self.beacon_gran={
                     'world': 0,
                     'categories': 0,
-                    'articles': -1
+                    'articles': -1,
+                    'images': -1,
+                    'maps': -1,
+                    'article_blocks': -1
             }
-            logging.info(f"Beacon granularities set:\n{json.dumps(self.beacon_gran, indent=2)}")
+            logger.info(f"Beacon granularities set:\n{json.dumps(self.beacon_gran, indent=2)}")
             assert all([self.beacon_gran[prop] <= self.track_gran[prop] for prop in self.track_gran.keys()]) == True
         except AssertionError:
             raise Exception("Invalid granularity settings. Beacon must be <= than Track.")
         except Exception as e:
-            logging.warning(f"Could not set granularities: {e}")
+            logger.warning(f"Could not set granularities: {e}")
             raise Exception(f"{e}")
 
     @wau.endpoint_exceptions_wrapper
     def get_auth_user_id(self):
         result = self.client.user.identity()
-        logging.info(f"Fetching user identity object...")
+        logger.info(f"Fetching user identity object...")
         return result
 
     @wau.endpoint_exceptions_wrapper
     @verify_uuid
     def get_user_worlds(self, uuid:str=''):
-        logging.info(f"Fetching worlds owned by user {uuid}")
-        return self.client.user.worlds(uuid)
+        logger.info(f"Fetching worlds owned by user {uuid}")
+        return list(self.client.user.worlds(uuid))
 
     @wau.endpoint_exceptions_wrapper
     @verify_granularity
     @verify_uuid
     def get_world(self, uuid:str='', granularity:int=-1):
-        logging.info(f"World object fetched. UUID: {uuid}, GRANULARITY: {granularity}")
+        logger.info("World object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
         return self.client.world.get(uuid, granularity)
 
     @wau.endpoint_exceptions_wrapper
     @verify_granularity
     @verify_uuid
     def get_category(self, uuid:str='', granularity:int=-1):
-        logging.info(f"Category object fetched. UUID: {uuid}, GRANULARITY: {granularity}")
+        logger.info("Category object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
         return self.client.category.get(uuid, granularity)
 
     @wau.endpoint_exceptions_wrapper
     @verify_granularity
     @verify_uuid
     def get_article(self, uuid:str='', granularity:int=-1):
-        logging.info(f"Article object fetched. UUID: {uuid}, GRANULARITY: {granularity}")
+        logger.info("Article object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
         return self.client.article.get(uuid, granularity)
-    
+
+    @wau.endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    def get_image(self, uuid:str='', granularity:int=-1):
+        logger.info("Image object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return self.client.image.get(uuid, granularity)
+
+    @wau.endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    def get_map(self, uuid:str='', granularity:int=-1):
+        logger.info("Map object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return self.client.map.get(uuid, granularity)
+
+    @wau.endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    def get_block(self, uuid:str='', granularity:int=-1):
+        logger.info("Block object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return self.client.block.get(uuid, granularity)
+
+    def get_asset_url(self, objtype:str, content:dict)->str|None:
+        # Download URL of the binary behind an object: an image's file, or the image a map is drawn on
+        match objtype:
+            case 'images':
+                return content.get('url')
+            case 'maps':
+                image=content.get('image')
+                if isinstance(image, dict) and image.get('id'):
+                    return self.get_image(uuid=image['id'], granularity=self.beacon_gran['images']).get('url')
+        return None
+
+    def download_asset(self, url:str=''):
+        # Chunks of the file at 'url' as they arrive; at most one chunk is held in memory
+        logger.info("Downloading asset: %s", url)
+        with self.download_session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT_S) as response:
+            response.raise_for_status()
+            yield from response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+
+    def flush_http_cache(self):
+        if self.http_cache is not None:
+            self.http_cache.flush()
+
+    def close(self):
+        self.transport.close()
+        self.download_session.close()
+
     def load_apimethods_mapping(self):
         try:
             self.apimethods_mapping={
                     'world': self.get_world,
                     'categories': self.get_category,
-                    'articles': self.get_article
+                    'articles': self.get_article,
+                    'images': self.get_image,
+                    'maps': self.get_map,
+                    'article_blocks': self.get_block
             }
-            logging.info(f"API methods mapping loaded")
+            logger.info(f"API methods mapping loaded")
         except Exception as e:
-            logging.warning(f"Could not load API methods mapping: {e}")
+            logger.warning(f"Could not load API methods mapping: {e}")
             raise Exception(f"{e}")
 
+    def list_world_categories(self, uuid:str=''):
+        return list(self.client.world.categories(uuid))
+
+    def list_category_articles(self, uuid:str='', category_uuid:str=UNCATEGORIZED_UUID):
+        # Pages are consumed as they arrive; only the article ids are kept, plus the
+        # listing entries themselves in listing beacon mode
+        if not self.listing_beacons:
+            return [art['id'] for art in self.client.world.articles(uuid, category_uuid)]
+        article_uuids=[]
+        for art in self.client.world.articles(uuid, category_uuid):
+            self.mapping_cache.summaries[art['id']]=art
+            article_uuids.append(art['id'])
+        return article_uuids
+
+    def list_world_entities(self, uuid:str='', listing:str=''):
+        # Ids of a world listing ('images', 'maps'); entries are kept as summaries in listing beacon mode
+        entity_uuids=[]
+        for entity in getattr(self.client.world, listing)(uuid):
+            if self.listing_beacons:
+                self.mapping_cache.summaries[entity['id']]=entity
+            entity_uuids.append(entity['id'])
+        return entity_uuids
+
+    def list_world_images(self, uuid:str=''):
+        return self.list_world_entities(uuid, 'images')
+
+    def list_world_maps(self, uuid:str=''):
+        return self.list_world_entities(uuid, 'maps')
+
+    def list_world_block_folders(self, uuid:str=''):
+        return [folder['id'] for folder in self.client.world.statblock_folders(uuid)]
+
+    def list_folder_blocks(self, uuid:str=''):
+        return [block['id'] for block in self.client.block_folder.blocks(uuid)]
+
+    def get_listing_beacons(self, objtype:str, uuids:list)->dict:
+        # Listing entries standing in for the beacons of 'uuids', where this cycle's listings had them
+        if not self.listing_beacons or objtype not in LISTING_BEACON_TYPES:
+            return {}
+        summaries=self.mapping_cache.summaries
+        return {uuid: summaries[uuid] for uuid in uuids if uuid in summaries}
+
     @wau.endpoint_exceptions_wrapper
     @verify_uuid
     def get_world_categories_mapping(self, uuid:str=''):
-        categories = [category['id'] for category in self.client.world.categories(uuid)]
-        logging.info(f"Categories fetched for world {uuid}: {', '.join(categories)}")
+        categories = [category['id'] for category in self.list_world_categories(uuid)]
+        logger.info("Categories fetched for world %s: %s", uuid, LogConfig.Lazy(', '.join, categories))
         return {uuid: categories}
 
     @wau.endpoint_exceptions_wrapper
     @verify_uuid
-    def get_category_articles_mapping(self, uuid:str='', category_uuids:list=[]):
-        category_uuids.append('-1') #Account for uncategorized articles
-        articles_mapping={cat_uuid: [art['id'] for art in self.client.world.articles(uuid, cat_uuid)
-                                    ] for cat_uuid in category_uuids}
-        logging.info(f"Fetched category-article mapping for world {uuid}:\n{json.dumps(articles_mapping, indent=2)}")
+    def get_category_articles_mapping(self, uuid:str='', category_uuids:list|None=None):
+        if category_uuids is None:
+            category_uuids = self.get_mapping(uuid, 'categories')[uuid]
+        category_uuids = [*category_uuids, UNCATEGORIZED_UUID] #Account for uncategorized articles
+        listings = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(LISTING_MAX_WORKERS, len(category_uuids)))) as executor:
+            futures = {executor.submit(self.list_category_articles, uuid, cat_uuid): cat_uuid for cat_uuid in category_uuids}
+            for future in as_completed(futures):
+                listings[futures[future]] = future.result()
+        articles_mapping={cat_uuid: listings[cat_uuid] for cat_uuid in category_uuids}
+        logger.info("Fetched category-article mapping for world %s: %d categories, %d articles", uuid,
+                    len(articles_mapping), sum(len(articles) for articles in articles_mapping.values()))
+        logger.debug("Category-article mapping for world %s:\n%s", uuid, LogConfig.Lazy(json.dumps, articles_mapping, indent=2))
         return articles_mapping
     
+    @wau.endpoint_exceptions_wrapper
+    @verify_uuid
+    def get_world_images_mapping(self, uuid:str=''):
+        images = self.list_world_images(uuid)
+        logger.info("Fetched %d images for world %s", len(images), uuid)
+        return {uuid: images}
+
+    @wau.endpoint_exceptions_wrapper
+    @verify_uuid
+    def get_world_maps_mapping(self, uuid:str=''):
+        maps = self.list_world_maps(uuid)
+        logger.info("Fetched %d maps for world %s", len(maps), uuid)
+        return {uuid: maps}
+
+    @wau.endpoint_exceptions_wrapper
+    @verify_uuid
+    def get_block_folder_blocks_mapping(self, uuid:str=''):
+        # Statblocks of a world, grouped by their block folder
+        folder_uuids = self.list_world_block_folders(uuid)
+        listings = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(LISTING_MAX_WORKERS, len(folder_uuids)))) as executor:
+            futures = {executor.submit(self.list_folder_blocks, folder_uuid): folder_uuid for folder_uuid in folder_uuids}
+            for future in as_completed(futures):
+                listings[futures[future]] = future.result()
+        blocks_mapping={folder_uuid: listings[folder_uuid] for folder_uuid in folder_uuids}
+        logger.info("Fetched folder-block mapping for world %s: %d folders, %d blocks", uuid,
+                    len(blocks_mapping), sum(len(blocks) for blocks in blocks_mapping.values()))
+        return blocks_mapping
+
     @wau.endpoint_exceptions_wrapper
     def get_user_worlds_mapping(self, uuid: str = ''):
         user_uuid = self.get_auth_user_id()['id']
         worlds = [world['id'] for world in self.get_user_worlds(user_uuid)]
         if uuid:
             worlds = [uuid] if uuid in worlds else []
-        logging.info(f"Fetched worlds mapping for user {user_uuid}: {', '.join(worlds)}")
+        logger.info(f"Fetched worlds mapping for user {user_uuid}: {', '.join(worlds)}")
         return {user_uuid: worlds}
     
     @wau.endpoint_exceptions_wrapper
     def get_mapping(self, uuid: str, _type: str, *args, **kwargs):
-        if _type not in ['world', 'categories', 'articles']:
-            raise ValueError(f"Invalid type '{_type}'. Supported types are: world, categories, articles")
+        if _type not in MAPPING_TYPES:
+            raise ValueError(f"Invalid type '{_type}'. Supported types are: {', '.join(MAPPING_TYPES)}")
         
         mapping_methods = {
             'world': lambda: self.get_user_worlds_mapping(uuid, *args, **kwargs),
             'categories': lambda: self.get_world_categories_mapping(uuid, *args, **kwargs),
-            'articles': lambda: self.get_category_articles_mapping(uuid, *args, **kwargs)
+            'articles': lambda: self.get_category_articles_mapping(uuid, *args, **kwargs),
+            'images': lambda: self.get_world_images_mapping(uuid, *args, **kwargs),
+            'maps': lambda: self.get_world_maps_mapping(uuid, *args, **kwargs),
+            'article_blocks': lambda: self.get_block_folder_blocks_mapping(uuid, *args, **kwargs)
         }
-        logging.info(f"Fetching mapping for type '{_type}' with UUID: {uuid}")
-        return mapping_methods[_type]()
+        cache_key = self.mapping_cache.key(uuid, _type, args, kwargs)
+        mapping = self.mapping_cache.get(cache_key)
+        if mapping is not None:
+            logger.info("Mapping for type '%s' with UUID: %s served from cache", _type, uuid)
+            return mapping
+        logger.info("Fetching mapping for type '%s' with UUID: %s", _type, uuid)
+        mapping = mapping_methods[_type]()
+        self.mapping_cache.put(cache_key, mapping)
+        return mapping
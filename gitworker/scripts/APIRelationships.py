@@ -3,7 +3,10 @@ WORLDANVIL_OBJECT_RELATIONSHIPS = {
         ('user', 'manuscript'),
         ('user', 'world'),
         ('world', 'categories'),
-        ('world', 'articles')
+        ('world', 'articles'),
+        ('world', 'images'),
+        ('world', 'maps'),
+        ('blockfolder', 'article_blocks')
 }
 
 class WorldAnvilRelationships:
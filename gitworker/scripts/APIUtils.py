@@ -1,6 +1,12 @@
 from functools import wraps
+import asyncio
 import logging
-from time import sleep
+import random
+import threading
+from time import sleep, monotonic, perf_counter
+import Metrics
+from requests import RequestException
+from pywaclient.endpoints import _parse_response
 from pywaclient.exceptions import (
         ConnectionException,
         UnexpectedStatusException,
@@ -12,39 +18,208 @@ from pywaclient.exceptions import (
         FailedRequest
         )
 
+logger=logging.getLogger(__name__)
 
-CONNECTION_SLEEP_TIME_S=60
+
+RATE_LIMIT_REQUESTS_PER_S=5.0
+RATE_LIMIT_MIN_REQUESTS_PER_S=0.5
+RATE_LIMIT_BURST=10
+RETRY_MAX_ATTEMPTS=6
+RETRY_BASE_DELAY_S=1.0
+RETRY_MAX_DELAY_S=60.0
+
+
+class RateLimiter(object):
+    """
+    Token bucket shared by all endpoints of a client. The refill rate backs off
+    multiplicatively when the API throttles us and recovers additively on success.
+    """
+    def __init__(self,
+                 requests_per_s:float=RATE_LIMIT_REQUESTS_PER_S,
+                 burst:int=RATE_LIMIT_BURST,
+                 min_requests_per_s:float=RATE_LIMIT_MIN_REQUESTS_PER_S):
+        if requests_per_s <= 0 or burst < 1:
+            raise ValueError(f"Invalid rate limiter settings: {requests_per_s} req/s, burst {burst}")
+        self.max_rate=requests_per_s
+        self.min_rate=min(min_requests_per_s, requests_per_s)
+        self.rate=requests_per_s
+        self.capacity=burst
+        self.tokens=float(burst)
+        self.updated=monotonic()
+        self.lock=threading.Lock()
+
+    def reserve(self)->float:
+        # Take a token and return how long the caller has to wait for it
+        with self.lock:
+            now=monotonic()
+            self.tokens=min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated=now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait=self.reserve()
+        if wait > 0:
+            sleep(wait)
+
+    async def acquire_async(self):
+        wait=self.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def throttled(self):
+        with self.lock:
+            self.rate=max(self.min_rate, self.rate / 2)
+        logger.warning(f"Request rate reduced to {self.rate:.2f} req/s")
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate=min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def backoff_delay(self, attempt:int, retry_after:float|None=None)->float:
+        if retry_after is not None:
+            return min(retry_after, RETRY_MAX_DELAY_S)
+        # Exponential backoff with full jitter
+        return random.uniform(0, min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * 2 ** attempt))
 
 
 class WorldAnvilUtils(object):
+    def get_status(exception):
+        return getattr(exception, 'status', None) or getattr(exception, 'status_code', None)
+
+    def get_retry_after(exception):
+        retry_after=getattr(exception, 'retry_after', None)
+        if retry_after is None:
+            headers=getattr(getattr(exception, 'response', None), 'headers', None) or {}
+            retry_after=headers.get('Retry-After')
+        try:
+            return float(retry_after) if retry_after is not None else None
+        except (TypeError, ValueError):
+            return None
+
+    def parse_response(path, response, params, content):
+        # pywaclient's response parsing, with the Retry-After header kept on the raised exception
+        try:
+            return _parse_response(path, response, params, content)
+        except Exception as e:
+            e.retry_after=response.headers.get('Retry-After')
+            raise
+
+    def request(session, method, url, path, params, content, headers):
+        # One round trip in place of pywaclient's BasicEndpoint request methods
+        try:
+            response=session.request(method, url, params=params, json=content or None, headers=headers)
+        except RequestException as err:
+            raise ConnectionException(str(err))
+        return WorldAnvilUtils.parse_response(path, response, params, content)
+
+    def is_throttled(exception):
+        return WorldAnvilUtils.get_status(exception) == 429
+
+    def is_retryable(exception):
+        match exception:
+            case ConnectionException() | InternalServerException():
+                return True
+            case UnexpectedStatusException():
+                status=WorldAnvilUtils.get_status(exception)
+                return status is not None and (status == 429 or status >= 500)
+            case _:
+                return False
+
+    def handle_endpoint_exception(exception):
+        # Log an endpoint exception and return the exception to re-raise (None if swallowed)
+        match exception:
+            case ConnectionException():
+                logger.warning(f"Unable to connect to WorldAnvil API. {exception}")
+            case InternalServerException():
+                logger.warning(f"WorldAnvil server unable to process request. {exception}")
+            case UnauthorizedRequest():
+                logger.warning(f"User unauthorized to process this request. {exception}")
+            case AccessForbidden():
+                logger.warning(f"Invalid permissions to view requested resource. {exception}")
+            case ResourceNotFound():
+                logger.warning(f"Requested resource not found. {exception}")
+            case UnprocessableDataProvided():
+                logger.error(f"Request could not be processed. {exception}")
+            case FailedRequest():
+                logger.error(f"Request failed. {exception}")
+                return None
+            case _:
+                logger.warning(f"Could not fetch user identity")
+        return Exception(f"{exception}")
+
+    def record_request(endpoint, started, outcome):
+        Metrics.observe('magpy_api_request_seconds', perf_counter() - started, endpoint=endpoint)
+        Metrics.inc('magpy_api_requests_total', endpoint=endpoint, outcome=outcome)
+
+    def retry_round_trip(rate_limiter, endpoint, func, *args, **kwargs):
+        # A single API round trip: waits for a token, retries transient failures
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            with Metrics.timed('magpy_rate_limit_wait_seconds'):
+                rate_limiter.acquire()
+            started=perf_counter()
+            try:
+                result=func(*args, **kwargs)
+                rate_limiter.succeeded()
+                WorldAnvilUtils.record_request(endpoint, started, 'ok')
+                return result
+            except Exception as e:
+                if not WorldAnvilUtils.is_retryable(e) or attempt == RETRY_MAX_ATTEMPTS - 1:
+                    WorldAnvilUtils.record_request(endpoint, started, 'error')
+                    raise
+                WorldAnvilUtils.record_request(endpoint, started, 'retry')
+                if WorldAnvilUtils.is_throttled(e):
+                    rate_limiter.throttled()
+                delay=rate_limiter.backoff_delay(attempt, WorldAnvilUtils.get_retry_after(e))
+                logger.warning(f"{endpoint} failed ({e}), retrying in {delay:.1f}s [{attempt + 1}/{RETRY_MAX_ATTEMPTS}]")
+                sleep(delay)
+
+    def async_rate_limited(func):
+        @wraps(func)
+        async def inner(self, *args, **kwargs):
+            for attempt in range(RETRY_MAX_ATTEMPTS):
+                with Metrics.timed('magpy_rate_limit_wait_seconds'):
+                    await self.rate_limiter.acquire_async()
+                started=perf_counter()
+                try:
+                    result=await func(self, *args, **kwargs)
+                    self.rate_limiter.succeeded()
+                    WorldAnvilUtils.record_request(func.__name__, started, 'ok')
+                    return result
+                except Exception as e:
+                    if not WorldAnvilUtils.is_retryable(e) or attempt == RETRY_MAX_ATTEMPTS - 1:
+                        WorldAnvilUtils.record_request(func.__name__, started, 'error')
+                        raise
+                    WorldAnvilUtils.record_request(func.__name__, started, 'retry')
+                    if WorldAnvilUtils.is_throttled(e):
+                        self.rate_limiter.throttled()
+                    delay=self.rate_limiter.backoff_delay(attempt, WorldAnvilUtils.get_retry_after(e))
+                    logger.warning(f"{func.__name__} failed ({e}), retrying in {delay:.1f}s [{attempt + 1}/{RETRY_MAX_ATTEMPTS}]")
+                    await asyncio.sleep(delay)
+
+        return inner
+
     def endpoint_exceptions_wrapper(func):
         @wraps(func)
         def inner(self, *args, **kwargs):
             try:
                 return func(self, *args, **kwargs)
-            except ConnectionException as connection_exception:
-                time.sleep(CONNECTION_SLEEP_TIME_S)
-                logging.warning(f"Unable to connect to WorldAnvil API. {connection_exception}")
-                raise Exception(f"{connection_exception}")
-            except InternalServerException as internal_server_exception:
-                logging.warning(f"WorldAnvil server unable to process request. {internal_server_exception}")
-                raise Exception(f"{internal_server_exception}")
-            except UnauthorizedRequest as unauthorized_request:
-                logging.warning(f"User unauthorized to process this request. {unauthorized_request}")
-                raise Exception(f"{unauthorized_request}")
-            except AccessForbidden as access_forbidden:
-                logging.warning(f"Invalid permissions to view requested resource. {access_forbidden}")
-                raise Exception(f"{access_forbidden}")
-            except ResourceNotFound as resource_not_found:
-                logging.warning(f"Requested resource not found. {resource_not_found}")
-                raise Exception(f"{resource_not_found}")
-            except UnprocessableDataProvided as unprocessable_data_provided:
-                logging.error(f"Request could not be processed. {unprocessable_data_provided}")
-                raise Exception(f"{unprocessable_data_provided}")
-            except FailedRequest as failed_request:
-                logging.error(f"Request failed. {failed_request}")
             except Exception as e:
-                logging.warning(f"Could not fetch user identity")
-                raise Exception(f"{e}")
-        
+                exception=WorldAnvilUtils.handle_endpoint_exception(e)
+                if exception is not None:
+                    raise exception
+
+        return inner
+
+    def async_endpoint_exceptions_wrapper(func):
+        @wraps(func)
+        async def inner(self, *args, **kwargs):
+            try:
+                return await func(self, *args, **kwargs)
+            except Exception as e:
+                exception=WorldAnvilUtils.handle_endpoint_exception(e)
+                if exception is not None:
+                    raise exception
+
         return inner
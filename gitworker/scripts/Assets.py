@@ -0,0 +1,120 @@
+import logging
+import os
+import tempfile
+import threading
+from hashlib import sha256
+from urllib.parse import urlparse
+
+import Metrics
+
+logger=logging.getLogger(__name__)
+
+
+ASSETS_DIR='assets'
+ASSET_SUFFIX_MAX_LENGTH=8
+
+
+class AssetDownload:
+    """
+    One asset being received: chunks are written to a temporary file in the
+    store and hashed as they arrive. finish() moves the file to its content
+    address, or drops it when the store already holds the same bytes.
+    """
+    def __init__(self, store, url:str):
+        self.store=store
+        self.url=url
+        self.hasher=sha256()
+        self.size=0
+        fd, self.tmp_path=tempfile.mkstemp(dir=os.path.join(store.repo_path, store.assets_dir),
+                                           prefix='.download.', suffix='.tmp')
+        self.file=os.fdopen(fd, mode='wb')
+
+    def write(self, chunk:bytes):
+        self.hasher.update(chunk)
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def abort(self):
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+    def finish(self)->tuple:
+        # Returns the asset reference and whether the bytes are new to the store
+        path, new=None, False
+        try:
+            self.file.close()
+            digest=self.hasher.hexdigest()
+            path=self.store.asset_path(digest, self.store.suffix(self.url))
+            new=self.store.claim(path)
+            if new:
+                filepath=os.path.join(self.store.repo_path, path)
+                os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                os.replace(self.tmp_path, filepath)
+            else:
+                os.remove(self.tmp_path)
+            Metrics.inc('magpy_assets_total', result='stored' if new else 'deduplicated')
+            Metrics.inc('magpy_asset_bytes_total', self.size)
+            logger.info("Asset %s %s (%d bytes)", path, 'stored' if new else 'already in the store', self.size)
+            return {'path': path, 'sha256': digest, 'size': self.size}, new
+        except Exception as e:
+            self.abort()
+            if new:
+                # The bytes never reached their address, so a later download may store them
+                self.store.release(path)
+            logger.warning(f"Unable to store asset downloaded from {self.url}")
+            raise Exception(f"{e}")
+
+
+class AssetStore:
+    """
+    Content-addressed store for binary assets inside the repository working
+    tree: an asset lives at 'assets/<sha256[:2]>/<sha256><suffix>', so bytes
+    shared by several objects are stored, staged and committed once. Files
+    are only renamed into place once complete, so a stored asset is intact.
+    'tracked' holds the asset paths already in the git index; a file in the
+    store that is not among them is stored and staged again.
+    """
+    def __init__(self, repo_path:str, assets_dir:str=ASSETS_DIR, tracked:set=set()):
+        self.repo_path=repo_path
+        self.assets_dir=assets_dir
+        self.tracked=set(tracked)
+        self.claimed=set()
+        self.lock=threading.Lock()
+
+    @staticmethod
+    def suffix(url:str)->str:
+        # File extension of the source URL, kept for readability of the archive
+        suffix=os.path.splitext(urlparse(url).path)[1].lower()
+        return suffix if 1 < len(suffix) <= ASSET_SUFFIX_MAX_LENGTH and suffix[1:].isalnum() else ''
+
+    def asset_path(self, digest:str, suffix:str='')->str:
+        return f"{self.assets_dir}/{digest[:2]}/{digest}{suffix}"
+
+    def claim(self, path:str)->bool:
+        # True for the first download of bytes not yet committed, even if a crash left their file in place
+        with self.lock:
+            new=path not in self.claimed and path not in self.tracked
+            self.claimed.add(path)
+        return new
+
+    def release(self, path:str):
+        # Drop a claim whose file could not be moved into place
+        with self.lock:
+            self.claimed.discard(path)
+
+    def begin(self, url:str='')->AssetDownload:
+        os.makedirs(os.path.join(self.repo_path, self.assets_dir), exist_ok=True)
+        return AssetDownload(self, url)
+
+    def store(self, chunks, url:str='')->tuple:
+        # Consume an iterable of chunks into the store
+        download=self.begin(url)
+        try:
+            for chunk in chunks:
+                download.write(chunk)
+        except Exception as e:
+            download.abort()
+            logger.warning(f"Unable to download asset from {url}")
+            raise Exception(f"{e}")
+        return download.finish()
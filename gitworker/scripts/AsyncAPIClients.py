@@ -0,0 +1,315 @@
+from APIClients import (WAClient, MappingCache, SCRIPT_NAME, MAGPY_REPO_URL, SCRIPT_VERSION, LISTING_MAX_WORKERS,
+                        UNCATEGORIZED_UUID, MAPPING_TYPES, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_TIMEOUT_S)
+from APIUtils import WorldAnvilUtils as wau, RateLimiter
+import LogConfig
+from pywaclient.exceptions import (
+        ConnectionException,
+        UnexpectedStatusException,
+        InternalServerException,
+        UnauthorizedRequest,
+        AccessForbidden,
+        ResourceNotFound,
+        UnprocessableDataProvided,
+        FailedRequest
+        )
+import aiohttp
+import asyncio
+import logging
+import json
+
+logger=logging.getLogger(__name__)
+
+
+
+
+BOROMIR_BASE_URL='https://www.worldanvil.com/api/external/boromir/'
+COLLECTION_PAGE_LIMIT=50
+MAX_CONNECTIONS=100
+REQUEST_TIMEOUT_S=60
+
+# Same status mapping as pywaclient.endpoints._parse_response
+STATUS_EXCEPTIONS={
+        401: lambda status, reason, path, data, params, content: UnauthorizedRequest(path, params, content),
+        403: lambda status, reason, path, data, params, content: AccessForbidden(path, params, content),
+        404: lambda status, reason, path, data, params, content: ResourceNotFound(path, params, content),
+        422: lambda status, reason, path, data, params, content: UnprocessableDataProvided(path, data, params, content),
+        500: lambda status, reason, path, data, params, content: InternalServerException(status, path, params, content)
+}
+
+
+
+class AsyncWAClient(object):
+    """
+    asyncio counterpart of WAClient. Talks to the Boromir API directly through
+    a pooled aiohttp session instead of the blocking BoromirApiClient.
+    """
+    def __init__(self, application_key: str, authentication_token: str, max_connections: int = MAX_CONNECTIONS,
+                 rate_limiter: RateLimiter = None, listing_beacons: bool = False):
+        try:
+            self.headers={
+                    'x-auth-token': authentication_token,
+                    'x-application-key': application_key,
+                    'Accept': 'application/json',
+                    'User-Agent': f'{SCRIPT_NAME} ({MAGPY_REPO_URL}, {SCRIPT_VERSION})'
+            }
+            self.max_connections=max_connections
+            self.session=None
+            self.download_session=None
+            self.rate_limiter=rate_limiter or RateLimiter()
+            self.mapping_cache=MappingCache()
+            # Mapping fetches in flight by cache key, so concurrent misses share one fetch
+            self.pending_mappings={}
+            self.listing_beacons=listing_beacons
+            logger.info(f"AsyncWAClient object initiated...")
+
+            self.set_granularities()
+            self.load_apimethods_mapping()
+        except Exception as e:
+            logger.warning(f"Could not initiate AsyncWAClient")
+            raise Exception(f"{e}")
+
+    # Shared with the synchronous client
+    verify_uuid=WAClient.verify_uuid
+    verify_granularity=WAClient.verify_granularity
+    set_granularities=WAClient.set_granularities
+    load_apimethods_mapping=WAClient.load_apimethods_mapping
+    get_listing_beacons=WAClient.get_listing_beacons
+
+    # Session section
+    def get_session(self):
+        # The session has to be created inside a running event loop
+        if self.session is None or self.session.closed:
+            self.session=aiohttp.ClientSession(
+                    base_url=BOROMIR_BASE_URL,
+                    headers=self.headers,
+                    connector=aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=30),
+                    timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_S)
+                    )
+            logger.info(f"AsyncWAClient session opened (max connections: {self.max_connections})")
+        return self.session
+
+    def get_download_session(self):
+        # Asset files are served from outside the API, without its base URL and credentials
+        if self.download_session is None or self.download_session.closed:
+            self.download_session=aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None, sock_read=DOWNLOAD_TIMEOUT_S))
+        return self.download_session
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+            logger.info(f"AsyncWAClient session closed")
+        if self.download_session is not None and not self.download_session.closed:
+            await self.download_session.close()
+
+    async def __aenter__(self):
+        self.get_session()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    @wau.async_rate_limited
+    async def request(self, method: str, path: str, params: dict = None, content: dict = None):
+        try:
+            async with self.get_session().request(method, path, params=params, json=content) as response:
+                text=await response.text()
+                if response.ok:
+                    body=json.loads(text)
+                    if 'success' not in body:
+                        raise UnexpectedStatusException(response.status, 'Response contained no success flag.', path, params, content)
+                    if not body['success']:
+                        raise FailedRequest(response.status, path, body.get('error'), body, params, content)
+                    return body
+                if response.status in STATUS_EXCEPTIONS:
+                    data=json.loads(text) if response.status == 422 else None
+                    exception=STATUS_EXCEPTIONS[response.status](response.status, response.reason, path, data, params, content)
+                else:
+                    exception=UnexpectedStatusException(response.status, response.reason, path, params, content)
+                exception.retry_after=response.headers.get('Retry-After')
+                raise exception
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            raise ConnectionException(f"{e}")
+
+    async def scroll_collection(self, path: str, params: dict, content: dict = None, collection_tag: str = 'entities'):
+        # Pages until an empty one comes back, like pywaclient's _scroll_collection
+        items=[]
+        offset=0
+        while True:
+            page=await self.request('POST', path, params=params,
+                                    content={**(content or {}), 'offset': offset, 'limit': COLLECTION_PAGE_LIMIT})
+            entities=page.get(collection_tag, [])
+            if not entities:
+                return items
+            items.extend(entities)
+            offset += COLLECTION_PAGE_LIMIT
+
+    @wau.async_endpoint_exceptions_wrapper
+    async def get_auth_user_id(self):
+        logger.info(f"Fetching user identity object...")
+        return await self.request('GET', 'identity')
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_user_worlds(self, uuid:str=''):
+        logger.info(f"Fetching worlds owned by user {uuid}")
+        return await self.scroll_collection('user/worlds', {'id': uuid})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_world(self, uuid:str='', granularity:int=-1):
+        logger.info("World object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'world', params={'id': uuid, 'granularity': str(granularity)})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_category(self, uuid:str='', granularity:int=-1):
+        logger.info("Category object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'category', params={'id': uuid, 'granularity': str(granularity)})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_article(self, uuid:str='', granularity:int=-1):
+        logger.info("Article object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'article', params={'id': uuid, 'granularity': str(granularity)})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_image(self, uuid:str='', granularity:int=-1):
+        logger.info("Image object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'image', params={'id': uuid, 'granularity': str(granularity)})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_map(self, uuid:str='', granularity:int=-1):
+        logger.info("Map object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'map', params={'id': uuid, 'granularity': str(granularity)})
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_granularity
+    @verify_uuid
+    async def get_block(self, uuid:str='', granularity:int=-1):
+        logger.info("Block object fetched. UUID: %s, GRANULARITY: %s", uuid, granularity)
+        return await self.request('GET', 'block', params={'id': uuid, 'granularity': str(granularity)})
+
+    async def get_asset_url(self, objtype:str, content:dict)->str|None:
+        match objtype:
+            case 'images':
+                return content.get('url')
+            case 'maps':
+                image=content.get('image')
+                if isinstance(image, dict) and image.get('id'):
+                    return (await self.get_image(uuid=image['id'], granularity=self.beacon_gran['images'])).get('url')
+        return None
+
+    async def download_asset(self, url:str=''):
+        logger.info("Downloading asset: %s", url)
+        async with self.get_download_session().get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_world_categories_mapping(self, uuid:str=''):
+        categories = [category['id'] for category in await self.scroll_collection('world/categories', {'id': uuid})]
+        logger.info("Categories fetched for world %s: %s", uuid, LogConfig.Lazy(', '.join, categories))
+        return {uuid: categories}
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_category_articles_mapping(self, uuid:str='', category_uuids:list|None=None):
+        if category_uuids is None:
+            category_uuids = (await self.get_mapping(uuid, 'categories'))[uuid]
+        category_uuids = [*category_uuids, UNCATEGORIZED_UUID] #Account for uncategorized articles
+        semaphore = asyncio.Semaphore(LISTING_MAX_WORKERS)
+        async def list_category_articles(cat_uuid):
+            async with semaphore:
+                return await self.scroll_collection('world/articles', {'id': uuid}, {'category': {'id': cat_uuid}})
+        listings = await asyncio.gather(*(list_category_articles(cat_uuid) for cat_uuid in category_uuids))
+        articles_mapping={cat_uuid: [art['id'] for art in listing] for cat_uuid, listing in zip(category_uuids, listings)}
+        if self.listing_beacons:
+            self.mapping_cache.summaries.update((art['id'], art) for listing in listings for art in listing)
+        logger.info("Fetched category-article mapping for world %s: %d categories, %d articles", uuid,
+                    len(articles_mapping), sum(len(articles) for articles in articles_mapping.values()))
+        logger.debug("Category-article mapping for world %s:\n%s", uuid, LogConfig.Lazy(json.dumps, articles_mapping, indent=2))
+        return articles_mapping
+
+    async def list_world_entities(self, uuid:str, listing:str):
+        entities=await self.scroll_collection(f'world/{listing}', {'id': uuid})
+        if self.listing_beacons:
+            self.mapping_cache.summaries.update((entity['id'], entity) for entity in entities)
+        return [entity['id'] for entity in entities]
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_world_images_mapping(self, uuid:str=''):
+        images = await self.list_world_entities(uuid, 'images')
+        logger.info("Fetched %d images for world %s", len(images), uuid)
+        return {uuid: images}
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_world_maps_mapping(self, uuid:str=''):
+        maps = await self.list_world_entities(uuid, 'maps')
+        logger.info("Fetched %d maps for world %s", len(maps), uuid)
+        return {uuid: maps}
+
+    @wau.async_endpoint_exceptions_wrapper
+    @verify_uuid
+    async def get_block_folder_blocks_mapping(self, uuid:str=''):
+        folder_uuids = [folder['id'] for folder in await self.scroll_collection('world/blockfolders', {'id': uuid})]
+        semaphore = asyncio.Semaphore(LISTING_MAX_WORKERS)
+        async def list_folder_blocks(folder_uuid):
+            async with semaphore:
+                return await self.scroll_collection('blockfolder/blocks', {'id': folder_uuid})
+        listings = await asyncio.gather(*(list_folder_blocks(folder_uuid) for folder_uuid in folder_uuids))
+        blocks_mapping={folder_uuid: [block['id'] for block in listing] for folder_uuid, listing in zip(folder_uuids, listings)}
+        logger.info("Fetched folder-block mapping for world %s: %d folders, %d blocks", uuid,
+                    len(blocks_mapping), sum(len(blocks) for blocks in blocks_mapping.values()))
+        return blocks_mapping
+
+    @wau.async_endpoint_exceptions_wrapper
+    async def get_user_worlds_mapping(self, uuid: str = ''):
+        user_uuid = (await self.get_auth_user_id())['id']
+        worlds = [world['id'] for world in await self.get_user_worlds(user_uuid)]
+        if uuid:
+            worlds = [uuid] if uuid in worlds else []
+        logger.info(f"Fetched worlds mapping for user {user_uuid}: {', '.join(worlds)}")
+        return {user_uuid: worlds}
+
+    @wau.async_endpoint_exceptions_wrapper
+    async def get_mapping(self, uuid: str, _type: str, *args, **kwargs):
+        if _type not in MAPPING_TYPES:
+            raise ValueError(f"Invalid type '{_type}'. Supported types are: {', '.join(MAPPING_TYPES)}")
+
+        mapping_methods = {
+            'world': lambda: self.get_user_worlds_mapping(uuid, *args, **kwargs),
+            'categories': lambda: self.get_world_categories_mapping(uuid, *args, **kwargs),
+            'articles': lambda: self.get_category_articles_mapping(uuid, *args, **kwargs),
+            'images': lambda: self.get_world_images_mapping(uuid, *args, **kwargs),
+            'maps': lambda: self.get_world_maps_mapping(uuid, *args, **kwargs),
+            'article_blocks': lambda: self.get_block_folder_blocks_mapping(uuid, *args, **kwargs)
+        }
+        cache_key = self.mapping_cache.key(uuid, _type, args, kwargs)
+        mapping = self.mapping_cache.get(cache_key)
+        if mapping is not None:
+            logger.info("Mapping for type '%s' with UUID: %s served from cache", _type, uuid)
+            return mapping
+        fetch = self.pending_mappings.get(cache_key)
+        if fetch is None:
+            logger.info("Fetching mapping for type '%s' with UUID: %s", _type, uuid)
+            fetch = asyncio.ensure_future(mapping_methods[_type]())
+            self.pending_mappings[cache_key] = fetch
+            try:
+                mapping = await fetch
+            finally:
+                self.pending_mappings.pop(cache_key, None)
+            self.mapping_cache.put(cache_key, mapping)
+            return mapping
+        logger.info("Mapping for type '%s' with UUID: %s joined the fetch in flight", _type, uuid)
+        return await fetch
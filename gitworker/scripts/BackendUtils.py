@@ -1,79 +1,507 @@
 import json
 import logging
+import os
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from time import perf_counter
 
-import Utils
+import Hashing
+import Journal
+import LogConfig
+import Metrics
+
+logger=logging.getLogger(__name__)
+
+
+SQLITE_MAX_PARAMETERS=900
 
 
 class Registry:
-    def __init__(self, reg_dir_filepath:str, reg_name:str):
+    def __init__(self, reg_dir_filepath:str, reg_name:str, write_behind:bool=False):
         self.reg_name=reg_name
         self.reg_dir_filepath=f"{reg_dir_filepath}/{reg_name}"
+        self.write_behind=write_behind
+        self.journal=None
+        self._reg=None
+        self._dirty=set()
 
-    def get_registry(self):
+    def load_registry(self):
         try:
-            with open(self.reg_dir_filepath, mode='r') as _reg:
-                reg=json.load(_reg)
+            with Metrics.timed('magpy_registry_io_seconds', registry=self.reg_name, op='read'):
+                with open(self.reg_dir_filepath, mode='r') as _reg:
+                    reg=json.load(_reg)
+                    Metrics.inc('magpy_registry_bytes_total', _reg.tell(), registry=self.reg_name, op='read')
             return reg
         except Exception as e:
             raise Exception(f"{e}")
 
+    def write_registry(self, reg:dict):
+        try:
+            reg_dir=os.path.dirname(self.reg_dir_filepath)
+            started=perf_counter()
+            fd, tmp_path=tempfile.mkstemp(dir=reg_dir, prefix=f".{self.reg_name}.", suffix='.tmp')
+            try:
+                with os.fdopen(fd, mode='w') as _reg:
+                    json.dump(reg, _reg)
+                    _reg.flush()
+                    os.fsync(_reg.fileno())
+                    written=_reg.tell()
+                if os.path.exists(self.reg_dir_filepath):
+                    os.chmod(tmp_path, os.stat(self.reg_dir_filepath).st_mode & 0o777)
+                os.replace(tmp_path, self.reg_dir_filepath)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            Metrics.observe('magpy_registry_io_seconds', perf_counter() - started, registry=self.reg_name, op='write')
+            Metrics.inc('magpy_registry_bytes_total', written, registry=self.reg_name, op='write')
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def _registry(self):
+        # Live registry dict; in write-behind mode it is loaded once and kept in memory
+        if not self.write_behind:
+            return self.load_registry()
+        if self._reg is None:
+            self._reg=self.load_registry()
+            logger.info("Registry %s loaded into memory (%d entries).", self.reg_name, len(self._reg))
+        return self._reg
+
+    def _journal(self, entries:dict):
+        if self.journal is not None:
+            self.journal.record_registry(self.reg_name, entries)
+
+    @contextmanager
+    def batch(self):
+        # JSON registries are written on flush, so there is nothing to group
+        yield self
+
+    def _store(self, reg:dict, identifiers):
+        if self.write_behind:
+            self._dirty.update(identifiers)
+        else:
+            self.write_registry(reg)
+
+    def get_registry(self):
+        try:
+            return dict(self._registry())
+        except Exception as e:
+            raise Exception(f"{e}")
+
     def update_registry(self, value:dict):
         try:
-            reg=self.get_registry()
+            reg=self._registry()
             reg.update(value)
-            with open(self.reg_dir_filepath, mode='w') as _reg:
-                json.dump(reg, _reg)
-            logging.info(f"Updated registry: {self.reg_name} with new data: {json.dumps(value, indent=2)}")
+            self._journal(value)
+            self._store(reg, value.keys())
+            logger.info("Updated registry: %s with %d entries", self.reg_name, len(value))
+            logger.debug("Updated registry: %s with new data: %s", self.reg_name, LogConfig.Lazy(json.dumps, value, indent=2))
         except Exception as e:
             raise Exception(f"{e}")
 
     def get_entry(self, identifier:str):
         try:
-            return self.get_registry()[identifier]
+            return self._registry()[identifier]
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def get_entries(self, identifiers)->dict:
+        # Stored values of 'identifiers'; identifiers not in the registry are left out
+        try:
+            reg=self._registry()
+            return {identifier: reg[identifier] for identifier in identifiers if identifier in reg}
         except Exception as e:
             raise Exception(f"{e}")
 
     def update_entry(self, identifier:str, value:dict):
         try:
-            reg=self.get_registry()
-            hashed_value=Utils.get_hash(json.dumps(value, ensure_ascii=False))
+            reg=self._registry()
             if isinstance(value, dict):
+                hashed_value=Hashing.hash_value(value)
                 reg[identifier]=hashed_value
             else:
                 raise TypeError(f"Invalid type for 'value'.")
-            with open(self.reg_dir_filepath, mode='w') as _reg:
-                json.dump(reg, _reg) 
+            self._journal({identifier: hashed_value})
+            self._store(reg, [identifier])
 
-            logging.info(f"{self.reg_name.capitalize()} registry updated for {identifier}: {hashed_value}.")
+            logger.info("%s registry updated for %s: %s.", self.reg_name.capitalize(), identifier, hashed_value)
         except Exception as e:
-            logging.warning(f"Unable to modify {reg_type} hash registry.")
+            logger.warning(f"Unable to modify {self.reg_name} hash registry.")
             raise Exception(f"{e}")
 
-    def compare_against_registry(self, value:dict):
+    def remove_entries(self, identifiers:list):
+        # Forget entries, so their objects are treated as changed on the next comparison
+        try:
+            reg=self._registry()
+            removed=[identifier for identifier in identifiers if reg.pop(identifier, None) is not None]
+            if removed:
+                self._journal(dict.fromkeys(removed))
+                if self.write_behind:
+                    self._dirty.update(removed)
+                else:
+                    self.write_registry(reg)
+                logger.info("Removed %d entries from registry %s", len(removed), self.reg_name)
+                logger.debug("Removed from registry %s: %s", self.reg_name, removed)
+        except Exception as e:
+            logger.warning(f"Unable to remove entries from registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def revert_entries(self, identifiers:list):
+        # Drop the unflushed changes of 'identifiers' in write-behind mode; they go back to their value on disk
+        try:
+            reverted=[identifier for identifier in identifiers if identifier in self._dirty]
+            if reverted:
+                stored=self.load_registry()
+                for identifier in reverted:
+                    if identifier in stored:
+                        self._reg[identifier]=stored[identifier]
+                    else:
+                        self._reg.pop(identifier, None)
+                self._dirty.difference_update(reverted)
+                logger.info("Reverted %d unflushed entries of registry %s", len(reverted), self.reg_name)
+        except Exception as e:
+            logger.warning(f"Unable to revert entries of registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def dirty_entries(self)->dict:
+        # Entries changed since the last flush, in write-behind mode; removed entries map to None
         try:
-            stored_reg=self.get_registry()
-            stored_reg_hash=Utils.get_hash(json.dumps(stored_reg, ensure_ascii=False))
-            compared_reg_hash=Utils.get_hash(json.dumps(value, ensure_ascii=False))
-            logging.info(f'Calculated hash ({stored_reg_hash}) for stringified registry object: {stored_reg}')
+            reg=self._registry()
+            return {identifier: reg.get(identifier) for identifier in self._dirty}
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def flush(self):
+        try:
+            if self.write_behind and self._dirty:
+                self.write_registry(self._reg)
+                logger.info("Registry %s flushed to disk (%d dirty entries).", self.reg_name, len(self._dirty))
+                self._dirty.clear()
+        except Exception as e:
+            logger.warning(f"Unable to flush registry: {self.reg_name}")
+            raise Exception(f"{e}")
 
+    def migrate_hashes(self, load_value):
+        # Rehash entries stored with an older hash scheme. 'load_value' returns the
+        # object for an identifier, or None when it cannot be recovered.
+        try:
+            migrated={}
+            skipped=0
+            for identifier, tagged_hash in self.get_registry().items():
+                if Hashing.is_current(tagged_hash):
+                    continue
+                value=load_value(identifier)
+                if not isinstance(value, dict):
+                    skipped += 1
+                    continue
+                migrated[identifier]=Hashing.hash_value(value)
+            if migrated:
+                self.update_registry(value=migrated)
+            logger.info("Registry %s migrated to hash version %s: %d rehashed, %d left on their stored version.", self.reg_name, Hashing.CURRENT_HASH_VERSION, len(migrated), skipped)
+            return len(migrated)
+        except Exception as e:
+            logger.warning(f"Unable to migrate hashes in registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def compare_against_registry(self, value:dict):
+        try:
+            stored_reg=self._registry()
+            stored_reg_hash=Hashing.hash_value(stored_reg)
+            compared_reg_hash=Hashing.hash_value(value)
             comp_result=(stored_reg_hash == compared_reg_hash)
-            logging.info(f"Comparing hash for registry: {self.reg_name}. Stored: {stored_reg_hash}, current: {compared_reg_hash} with result: {comp_result}")
+            logger.info("Comparing hash for registry: %s. Stored: %s, current: %s with result: %s", self.reg_name, stored_reg_hash, compared_reg_hash, comp_result)
             return comp_result
         except Exception as e:
-            logging.warning(f"Unable to compare 'value' against the stored registry.")
+            logger.warning(f"Unable to compare 'value' against the stored registry.")
             raise Exception(f"{e}")
 
     def compare_against_entry(self, identifier:str, value:dict):
         try:
-            stored_reg_entry_hash=self.get_registry()[identifier]
-            compared_value_hash=Utils.get_hash(json.dumps(value, ensure_ascii=False))
+            stored_reg_entry_hash=self._registry().get(identifier)
+            comp_result=Hashing.matches(stored_reg_entry_hash, value)
+            logger.info("Comparing hash for registry: %s with ID: %s. Stored: %s with result: %s", self.reg_name, identifier, stored_reg_entry_hash, comp_result)
+            return comp_result
+        except Exception as e:
+            logger.warning(f"Unable to compare an 'entry' for id: {identifier} between stored and current 'value'")
+            raise Exception(f"{e}")
+
+
+class SQLiteConnection:
+    """
+    One connection per database file, shared by all registries stored in it,
+    so a batch groups the writes of several registries into one transaction.
+    'batch_depth' counts the open batches; the outermost one commits.
+    """
+    connections={}
+
+    def __init__(self, db_filepath:str):
+        self.conn=sqlite3.connect(db_filepath)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS registry (
+                                reg_name TEXT NOT NULL,
+                                identifier TEXT NOT NULL,
+                                value TEXT NOT NULL,
+                                PRIMARY KEY (reg_name, identifier)
+                             ) WITHOUT ROWID""")
+        # git blob id of each registry's JSON file as last imported or exported
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS registry_meta (
+                                reg_name TEXT PRIMARY KEY,
+                                blob_id TEXT NOT NULL
+                             ) WITHOUT ROWID""")
+        self.conn.commit()
+        self.batch_depth=0
+
+    @classmethod
+    def open(cls, db_filepath:str):
+        if db_filepath not in cls.connections:
+            cls.connections[db_filepath]=cls(db_filepath)
+        return cls.connections[db_filepath]
+
+
+class SQLiteRegistry(Registry):
+    """
+    Registry backed by a local SQLite database (WAL mode). Lookups and writes go
+    through the indexed table; the JSON file is only written by export(), so the
+    git repository keeps its layout. The table follows the JSON file whenever
+    that file is not the one it last imported or exported.
+    """
+    def __init__(self, reg_dir_filepath:str, reg_name:str, db_filepath:str, write_behind:bool=True):
+        super().__init__(reg_dir_filepath=reg_dir_filepath, reg_name=reg_name, write_behind=write_behind)
+        self.db_filepath=db_filepath
+        self.connect()
+        self.import_registry()
+
+    def connect(self):
+        try:
+            self.shared=SQLiteConnection.open(self.db_filepath)
+            self.conn=self.shared.conn
+            logger.info(f"SQLite registry {self.reg_name} connected: {self.db_filepath}")
+        except Exception as e:
+            logger.warning(f"Unable to connect to SQLite registry: {self.db_filepath}")
+            raise Exception(f"{e}")
+
+    def file_blob_id(self)->str|None:
+        if not os.path.exists(self.reg_dir_filepath):
+            return None
+        with open(self.reg_dir_filepath, mode='rb') as _reg:
+            return Journal.blob_id(_reg.read())
+
+    def stored_blob_id(self)->str|None:
+        row=self.conn.execute("SELECT blob_id FROM registry_meta WHERE reg_name=?", (self.reg_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def record_blob_id(self, blob_id:str):
+        self.conn.execute("""INSERT INTO registry_meta (reg_name, blob_id) VALUES (?, ?)
+                             ON CONFLICT (reg_name) DO UPDATE SET blob_id=excluded.blob_id""",
+                          (self.reg_name, blob_id))
+        self._commit()
+
+    def import_registry(self):
+        # Reconcile the table with the JSON file when it changed outside this database, e.g. on a pull
+        # or checkout; unflushed entries of an interrupted cycle are replayed from the journal afterwards
+        try:
+            blob_id=self.file_blob_id()
+            if blob_id is None or blob_id == self.stored_blob_id():
+                return
+            reg=self.load_registry()
+            stored=self.get_registry()
+            changed={identifier: value for identifier, value in reg.items()
+                     if identifier not in stored or stored[identifier] != value}
+            removed=[identifier for identifier in stored if identifier not in reg]
+            with self.batch():
+                self.upsert(changed, dirty=False)
+                self.conn.executemany("DELETE FROM registry WHERE reg_name=? AND identifier=?",
+                                      [(self.reg_name, identifier) for identifier in removed])
+                self.record_blob_id(blob_id)
+            logger.info("SQLite registry %s reconciled with %s (blob %s): %d entries imported, %d removed",
+                        self.reg_name, self.reg_dir_filepath, blob_id, len(changed), len(removed))
+        except Exception as e:
+            logger.warning(f"Unable to import registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def _commit(self):
+        if not self.shared.batch_depth:
+            self.conn.commit()
+
+    @contextmanager
+    def batch(self):
+        """Group the writes of the registries in this database into a single transaction."""
+        self.shared.batch_depth += 1
+        try:
+            yield self
+        except Exception:
+            if self.shared.batch_depth == 1:
+                self.conn.rollback()
+            raise
+        else:
+            if self.shared.batch_depth == 1:
+                self.conn.commit()
+        finally:
+            self.shared.batch_depth -= 1
+
+    def upsert(self, values:dict, dirty:bool=True):
+        try:
+            with Metrics.timed('magpy_registry_io_seconds', registry=self.reg_name, op='upsert'):
+                self.conn.executemany("""INSERT INTO registry (reg_name, identifier, value) VALUES (?, ?, ?)
+                                         ON CONFLICT (reg_name, identifier) DO UPDATE SET value=excluded.value""",
+                                      [(self.reg_name, identifier, json.dumps(value)) for identifier, value in values.items()])
+                self._commit()
+            if dirty:
+                self._dirty.update(values.keys())
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def get_registry(self):
+        try:
+            rows=self.conn.execute("SELECT identifier, value FROM registry WHERE reg_name=? ORDER BY identifier",
+                                   (self.reg_name,))
+            return {identifier: json.loads(value) for identifier, value in rows}
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def _registry(self):
+        return self.get_registry()
+
+    def update_registry(self, value:dict):
+        try:
+            self._journal(value)
+            self.upsert(value)
+            logger.info("Updated registry: %s with %d entries", self.reg_name, len(value))
+            logger.debug("Updated registry: %s with new data: %s", self.reg_name, LogConfig.Lazy(json.dumps, value, indent=2))
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def get_entry(self, identifier:str):
+        try:
+            row=self.conn.execute("SELECT value FROM registry WHERE reg_name=? AND identifier=?",
+                                  (self.reg_name, identifier)).fetchone()
+            if row is None:
+                raise KeyError(identifier)
+            return json.loads(row[0])
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def get_entries(self, identifiers)->dict:
+        try:
+            identifiers=list(identifiers)
+            entries={}
+            for offset in range(0, len(identifiers), SQLITE_MAX_PARAMETERS):
+                chunk=identifiers[offset:offset + SQLITE_MAX_PARAMETERS]
+                rows=self.conn.execute(f"SELECT identifier, value FROM registry WHERE reg_name=? AND identifier IN ({','.join('?' * len(chunk))})",
+                                       (self.reg_name, *chunk))
+                entries.update({identifier: json.loads(value) for identifier, value in rows})
+            return entries
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def update_entry(self, identifier:str, value:dict):
+        try:
+            if not isinstance(value, dict):
+                raise TypeError(f"Invalid type for 'value'.")
+            hashed_value=Hashing.hash_value(value)
+            self._journal({identifier: hashed_value})
+            self.upsert({identifier: hashed_value})
+
+            logger.info("%s registry updated for %s: %s.", self.reg_name.capitalize(), identifier, hashed_value)
+        except Exception as e:
+            logger.warning(f"Unable to modify {self.reg_name} hash registry.")
+            raise Exception(f"{e}")
 
-            comp_result=(stored_reg_entry_hash == compared_value_hash)
-            logging.info(f"Comparing hash for registry: {self.reg_name} with ID: {identifier}. Stored: {stored_reg_entry_hash}, current: {compared_value_hash} with result: {comp_result}")
+    def remove_entries(self, identifiers:list):
+        # Forget entries, so their objects are treated as changed on the next comparison
+        try:
+            removed=list(self.get_entries(identifiers))
+            if removed:
+                self._journal(dict.fromkeys(removed))
+                self.conn.executemany("DELETE FROM registry WHERE reg_name=? AND identifier=?",
+                                      [(self.reg_name, identifier) for identifier in removed])
+                self._commit()
+                self._dirty.update(removed)
+                logger.info("Removed %d entries from registry %s", len(removed), self.reg_name)
+                logger.debug("Removed from registry %s: %s", self.reg_name, removed)
+        except Exception as e:
+            logger.warning(f"Unable to remove entries from registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def compare_against_entry(self, identifier:str, value:dict):
+        try:
+            row=self.conn.execute("SELECT value FROM registry WHERE reg_name=? AND identifier=?",
+                                  (self.reg_name, identifier)).fetchone()
+            stored_reg_entry_hash=json.loads(row[0]) if row is not None else None
+            comp_result=Hashing.matches(stored_reg_entry_hash, value)
+            logger.info("Comparing hash for registry: %s with ID: %s. Stored: %s with result: %s", self.reg_name, identifier, stored_reg_entry_hash, comp_result)
             return comp_result
         except Exception as e:
-            logging.warning(f"Unable to compare an 'entry' for id: {identifier} between stored and current 'value'")
+            logger.warning(f"Unable to compare an 'entry' for id: {identifier} between stored and current 'value'")
+            raise Exception(f"{e}")
+
+    def export(self):
+        try:
+            self.write_registry(self.get_registry())
+            self.record_blob_id(self.file_blob_id())
+            logger.info("SQLite registry %s exported to %s", self.reg_name, self.reg_dir_filepath)
+        except Exception as e:
+            logger.warning(f"Unable to export SQLite registry: {self.reg_name}")
+            raise Exception(f"{e}")
+
+    def flush(self):
+        try:
+            if self._dirty:
+                self.export()
+                self._dirty.clear()
+        except Exception as e:
+            logger.warning(f"Unable to flush registry: {self.reg_name}")
             raise Exception(f"{e}")
 
 
+REGISTRY_BACKENDS={
+    'json': Registry,
+    'sqlite': SQLiteRegistry
+}
+
 
+class IndexMembers:
+    """
+    Which file_index entries each tracked world contributed on its last
+    refresh, kept outside the repository as JSON. file_index is shared by all
+    worlds, so this is what lets an entry missing from a world's listings be
+    told apart from an entry owned by another world.
+    """
+    def __init__(self, state_filepath:str):
+        self.state_filepath=state_filepath
+        self.members={}
+        self.dirty=False
+        self.load()
+
+    def load(self):
+        try:
+            if os.path.exists(self.state_filepath):
+                with open(self.state_filepath, mode='r') as _state:
+                    self.members={world: set(uuids) for world, uuids in json.load(_state).items()}
+            logger.info(f"File index members loaded for {len(self.members)} worlds")
+        except Exception as e:
+            logger.warning(f"Unable to load file index members, removals are detected from the next refresh on: {e}")
+            self.members={}
+
+    def get(self, world_uuid:str)->set:
+        return self.members.get(world_uuid, set())
+
+    def update(self, world_uuid:str, uuids:set):
+        if self.members.get(world_uuid) != uuids:
+            self.members[world_uuid]=set(uuids)
+            self.dirty=True
+
+    def flush(self):
+        try:
+            if not self.dirty:
+                return
+            fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(self.state_filepath), prefix='.members.', suffix='.tmp')
+            with os.fdopen(fd, mode='w') as _state:
+                json.dump({world: sorted(uuids) for world, uuids in self.members.items()}, _state)
+            os.replace(tmp_path, self.state_filepath)
+            self.dirty=False
+        except Exception as e:
+            logger.warning(f"Unable to save file index members: {self.state_filepath}")
+            raise Exception(f"{e}")
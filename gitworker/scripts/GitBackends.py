@@ -0,0 +1,307 @@
+import logging
+import os
+import random
+import threading
+from collections import defaultdict
+from io import BytesIO
+from time import monotonic, time
+
+from git import Repo, Commit, Tree, Blob
+from git.index.typ import BaseIndexEntry
+from git.objects.fun import tree_entries_from_data, tree_to_stream
+from gitdb import IStream
+
+import Journal
+import Metrics
+
+logger=logging.getLogger(__name__)
+
+
+FILE_MODE=0o100644
+TREE_MODE=0o040000
+PUSH_RETRY_BASE_DELAY_S=2.0
+PUSH_RETRY_MAX_DELAY_S=300.0
+PUSH_MAX_LAG_COMMITS=1000
+PUSH_SHUTDOWN_TIMEOUT_S=120.0
+# Paths per 'git rm' call, to stay under the command line length limit
+REMOVE_BATCH_SIZE=1000
+
+
+class IndexCommitEngine:
+    """
+    Default engine: objects are written to the working tree and staged through
+    the git index, which re-reads and hashes them from disk.
+    """
+    def __init__(self, repo, repo_path:str):
+        self.repo=repo
+        self.repo_path=repo_path
+
+    def write_object(self, path:str, content:bytes):
+        try:
+            # Written next to the target and renamed over it, so a crash never leaves a truncated object
+            filepath=os.path.join(self.repo_path, path)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            tmp_path=f"{filepath}.tmp"
+            with open(tmp_path, mode='wb') as file:
+                file.write(content)
+            os.replace(tmp_path, filepath)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def recover_object(self, path:str, blob_hexsha:str)->bool:
+        # True when the object written before a crash is intact and can be staged
+        try:
+            filepath=os.path.join(self.repo_path, path)
+            if not os.path.isfile(filepath):
+                return False
+            with open(filepath, mode='rb') as file:
+                return Journal.blob_id(file.read()) == blob_hexsha
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def restore_object(self, path:str):
+        # Put back the committed version of an object, or drop it if it was never committed
+        try:
+            try:
+                self.repo.head.commit.tree[path]
+                self.repo.git.checkout('HEAD', '--', path)
+            except KeyError:
+                filepath=os.path.join(self.repo_path, path)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def stage(self, paths:list):
+        try:
+            self.repo.index.add(paths)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def remove_objects(self, paths:list):
+        # Delete objects from the working tree and stage their removal
+        try:
+            for start in range(0, len(paths), REMOVE_BATCH_SIZE):
+                self.repo.index.remove(paths[start:start + REMOVE_BATCH_SIZE], working_tree=True)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def commit(self, message:str):
+        try:
+            return self.repo.index.commit(message)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+
+class ODBCommitEngine(IndexCommitEngine):
+    """
+    Plumbing engine: serialized objects go straight into the object database as
+    blobs, the new tree is built from the previous HEAD tree by rewriting only
+    the touched subtrees, and the branch ref is moved to the new commit.
+    The working tree is only written when 'materialize' is set; the index is
+    kept in line with HEAD from the known blob hashes, without reading files.
+    """
+    def __init__(self, repo, repo_path:str, materialize:bool=True):
+        super().__init__(repo=repo, repo_path=repo_path)
+        self.materialize=materialize
+        self.pending={}
+
+    def store(self, obj_type:str, data:bytes)->bytes:
+        return self.repo.odb.store(IStream(obj_type, len(data), BytesIO(data))).binsha
+
+    def write_object(self, path:str, content:bytes):
+        try:
+            self.pending[path]=self.store(Blob.type, content)
+            if self.materialize:
+                super().write_object(path, content)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def recover_object(self, path:str, blob_hexsha:str)->bool:
+        # Blobs are in the object database before the working tree is touched
+        try:
+            binsha=bytes.fromhex(blob_hexsha)
+            if self.repo.odb.has_object(binsha):
+                self.pending[path]=binsha
+                if self.materialize and not super().recover_object(path, blob_hexsha):
+                    super().write_object(path, self.repo.odb.stream(binsha).read())
+                return True
+            return False
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def remove_objects(self, paths:list):
+        # A None entry drops the path from the next tree
+        try:
+            for path in paths:
+                self.pending[path]=None
+                filepath=os.path.join(self.repo_path, path)
+                if os.path.isfile(filepath):
+                    os.remove(filepath)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def stage(self, paths:list):
+        # Objects passed through write_object are already stored; anything else
+        # (e.g. the registries and assets) is streamed from the working tree once
+        try:
+            for path in paths:
+                if path not in self.pending:
+                    filepath=os.path.join(self.repo_path, path)
+                    with open(filepath, mode='rb') as file:
+                        self.pending[path]=self.repo.odb.store(IStream(Blob.type, os.path.getsize(filepath), file)).binsha
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def read_tree(self, binsha:bytes|None)->dict:
+        if binsha is None:
+            return {}
+        data=self.repo.odb.stream(binsha).read()
+        return {name: (sha, mode) for sha, mode, name in tree_entries_from_data(data)}
+
+    def build_tree(self, base_binsha:bytes|None, changes:dict)->bytes|None:
+        # None for a tree left empty by removals
+        entries=self.read_tree(base_binsha)
+        subtrees=defaultdict(dict)
+        for path, binsha in changes.items():
+            name, _, rest=path.partition('/')
+            if rest:
+                subtrees[name][rest]=binsha
+            elif binsha is None:
+                entries.pop(name, None)
+            else:
+                entries[name]=(binsha, FILE_MODE)
+        for name, subchanges in subtrees.items():
+            base_subtree=entries[name][0] if name in entries and entries[name][1] == TREE_MODE else None
+            subtree=self.build_tree(base_subtree, subchanges)
+            if subtree is None:
+                entries.pop(name, None)
+            else:
+                entries[name]=(subtree, TREE_MODE)
+        if not entries:
+            return None
+
+        # git orders tree entries by name, with directories compared as 'name/'
+        sorted_entries=sorted(((sha, mode, name) for name, (sha, mode) in entries.items()),
+                              key=lambda entry: entry[2] + ('/' if entry[1] == TREE_MODE else ''))
+        stream=BytesIO()
+        tree_to_stream(sorted_entries, stream.write)
+        return self.store(Tree.type, stream.getvalue())
+
+    def commit(self, message:str):
+        try:
+            head_commit=self.repo.head.commit if self.repo.head.is_valid() else None
+            base_tree=head_commit.tree.binsha if head_commit is not None else None
+            tree_binsha=self.build_tree(base_tree, self.pending)
+            if tree_binsha is None:
+                tree_binsha=self.store(Tree.type, b'')
+            tree=Tree(self.repo, tree_binsha)
+            commit=Commit.create_from_tree(self.repo, tree, message,
+                                           parent_commits=[head_commit] if head_commit is not None else [],
+                                           head=True)
+            removed=[path for path, binsha in self.pending.items() if binsha is None]
+            for start in range(0, len(removed), REMOVE_BATCH_SIZE):
+                self.repo.index.remove(removed[start:start + REMOVE_BATCH_SIZE])
+            self.repo.index.add([BaseIndexEntry((FILE_MODE, binsha, 0, path)) for path, binsha in self.pending.items() if binsha is not None])
+            logger.info(f"Commit {commit.hexsha[:10]} written to the object database ({len(self.pending)} blobs)")
+            self.pending={}
+            return commit
+        except Exception as e:
+            raise Exception(f"{e}")
+
+
+class PushWorker(threading.Thread):
+    """
+    Pushes the branch head in the background. Commits made while a push is
+    running are coalesced into the next push; failed pushes are retried with
+    exponential backoff. 'unpushed_commits' is the number of local commits
+    not known to be on the remote; committers block once it reaches 'max_lag'.
+    'lock' is held during each push, so repository maintenance sharing it
+    never repacks underneath one.
+    """
+    def __init__(self, repo_path:str, remote_name:str, ssh_id_file:str,
+                 max_lag:int=PUSH_MAX_LAG_COMMITS, lock=None):
+        super().__init__(name='push-worker', daemon=True)
+        # Separate Repo object, so the push environment never leaks into the committer's git calls
+        self.repo=Repo(repo_path)
+        self.remote_name=remote_name
+        self.ssh_id_file=ssh_id_file
+        self.max_lag=max(1, max_lag)
+        self.unpushed_commits=self.count_unpushed_commits()
+        self.last_push_at=None
+        self.failures=0
+        self.lock=lock or threading.Lock()
+        self.condition=threading.Condition()
+        self.stopping=False
+
+    def count_unpushed_commits(self)->int:
+        # Commits left unpushed by a previous run, bounded by 'max_lag'
+        try:
+            branch=self.repo.active_branch.name
+            return sum(1 for _ in self.repo.iter_commits(f'{self.remote_name}/{branch}..{branch}', max_count=self.max_lag))
+        except Exception as e:
+            logger.warning(f"Push worker: unable to count unpushed commits: {e}")
+            return 0
+
+    def notify_commit(self, commits:int=1):
+        with self.condition:
+            self.unpushed_commits += commits
+            Metrics.set_gauge('magpy_push_lag_commits', self.unpushed_commits)
+            self.condition.notify_all()
+            while self.unpushed_commits >= self.max_lag and not self.stopping and self.is_alive():
+                logger.warning(f"Push lag reached {self.unpushed_commits} commits, waiting for the push worker")
+                self.condition.wait(timeout=PUSH_RETRY_MAX_DELAY_S)
+
+    def push(self):
+        with self.lock, self.repo.git.custom_environment(GIT_SSH_COMMAND=f'ssh -i {self.ssh_id_file}'):
+            self.repo.remote(self.remote_name).push().raise_if_error()
+
+    def run(self):
+        delay=0.0
+        while True:
+            with self.condition:
+                while self.unpushed_commits == 0 and not self.stopping:
+                    self.condition.wait()
+                if self.unpushed_commits == 0 and self.stopping:
+                    return
+                deadline=monotonic() + delay
+                while not self.stopping and monotonic() < deadline:
+                    self.condition.wait(timeout=deadline - monotonic())
+                pending=self.unpushed_commits
+            try:
+                started=monotonic()
+                with Metrics.timed('magpy_git_operation_seconds', op='push'):
+                    self.push()
+                with self.condition:
+                    self.unpushed_commits -= pending
+                    self.last_push_at=monotonic()
+                    self.failures=0
+                    self.condition.notify_all()
+                    Metrics.set_gauge('magpy_push_lag_commits', self.unpushed_commits)
+                Metrics.set_gauge('magpy_last_push_timestamp_seconds', time())
+                logger.info(f"Push worker: pushed {pending} commits in {monotonic() - started:.1f}s")
+                delay=0.0
+            except Exception as e:
+                self.failures += 1
+                Metrics.inc('magpy_push_failures_total')
+                delay=random.uniform(0, min(PUSH_RETRY_MAX_DELAY_S, PUSH_RETRY_BASE_DELAY_S * 2 ** self.failures))
+                logger.warning(f"Push worker: push failed ({e}), {pending} commits pending, retrying in {delay:.1f}s")
+                with self.condition:
+                    if self.stopping and self.failures > 3:
+                        logger.error(f"Push worker: giving up with {self.unpushed_commits} unpushed commits")
+                        return
+
+    def stop(self, timeout:float=PUSH_SHUTDOWN_TIMEOUT_S):
+        # Drain pending pushes, then stop the thread
+        with self.condition:
+            self.stopping=True
+            self.condition.notify_all()
+        self.join(timeout=timeout)
+        if self.is_alive():
+            logger.warning(f"Push worker did not drain within {timeout}s, {self.unpushed_commits} commits unpushed")
+
+
+COMMIT_ENGINES={
+    'index': IndexCommitEngine,
+    'odb': ODBCommitEngine
+}
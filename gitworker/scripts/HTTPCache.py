@@ -0,0 +1,210 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from hashlib import blake2b, sha1
+from urllib.parse import urlencode
+
+from requests import RequestException
+from pywaclient.exceptions import ConnectionException
+
+import Metrics
+from APIUtils import WorldAnvilUtils
+
+logger=logging.getLogger(__name__)
+
+
+HTTP_CACHE_MAX_BYTES=256*1024*1024
+HTTP_CACHE_MEMORY_ENTRIES=4096
+INDEX_NAME='index.json'
+
+
+class CachedResponse(dict):
+    """
+    Parsed GET response. 'unchanged' is True when the server answered 304 Not
+    Modified or sent the same bytes as last time; 'digest' is then whatever
+    was recorded for this response with HTTPCache.set_digest().
+    """
+    def __init__(self, data:dict, cache_key:str, unchanged:bool=False, digest:str|None=None):
+        super().__init__(data)
+        self.cache_key=cache_key
+        self.unchanged=unchanged
+        self.digest=digest
+
+
+class HTTPCache:
+    """
+    On-disk cache of API GET responses in 'cache_dir', bounded to 'max_bytes'
+    with LRU eviction. Requests are revalidated with If-None-Match and
+    If-Modified-Since when the server sent an ETag or Last-Modified; without
+    them, a body identical to the cached one is recognised by its digest and
+    not parsed again. GETs reach it through the client's APITransport.
+    """
+    def __init__(self, cache_dir:str, max_bytes:int=HTTP_CACHE_MAX_BYTES,
+                 memory_entries:int=HTTP_CACHE_MEMORY_ENTRIES):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.memory_entries=max(0, memory_entries)
+        self.index=OrderedDict()
+        self.parsed=OrderedDict()
+        self.size=0
+        self.dirty=False
+        self.lock=threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.load_index()
+
+    # Persistence section
+    def load_index(self):
+        try:
+            index_filepath=os.path.join(self.cache_dir, INDEX_NAME)
+            if os.path.exists(index_filepath):
+                with open(index_filepath, mode='r') as _index:
+                    self.index=OrderedDict(json.load(_index))
+            self.size=sum(entry['size'] for entry in self.index.values())
+            logger.info(f"HTTP cache loaded: {len(self.index)} responses, {self.size} bytes")
+        except Exception as e:
+            logger.warning(f"Unable to load HTTP cache index, starting empty: {e}")
+            self.index=OrderedDict()
+            self.size=0
+
+    def flush(self):
+        # Save the index in LRU order; bodies are written as they arrive
+        try:
+            with self.lock:
+                if not self.dirty:
+                    return
+                index=list(self.index.items())
+                self.dirty=False
+            fd, tmp_path=tempfile.mkstemp(dir=self.cache_dir, prefix='.index.', suffix='.tmp')
+            with os.fdopen(fd, mode='w') as _index:
+                json.dump(index, _index)
+            os.replace(tmp_path, os.path.join(self.cache_dir, INDEX_NAME))
+        except Exception as e:
+            logger.warning(f"Unable to save HTTP cache index: {self.cache_dir}")
+            raise Exception(f"{e}")
+
+    def body_filepath(self, key:str)->str:
+        return os.path.join(self.cache_dir, key)
+
+    def write_body(self, key:str, body:bytes):
+        fd, tmp_path=tempfile.mkstemp(dir=self.cache_dir, prefix='.body.', suffix='.tmp')
+        with os.fdopen(fd, mode='wb') as _body:
+            _body.write(body)
+        os.replace(tmp_path, self.body_filepath(key))
+
+    def evict(self):
+        # Drop least recently used responses until the cache fits in max_bytes; called with the lock held
+        while self.size > self.max_bytes and self.index:
+            key, entry=self.index.popitem(last=False)
+            self.parsed.pop(key, None)
+            self.size -= entry['size']
+            try:
+                os.remove(self.body_filepath(key))
+            except FileNotFoundError:
+                pass
+            self.dirty=True
+
+    # Lookup section
+    @staticmethod
+    def key(url:str, params:dict)->str:
+        return sha1(f"{url}?{urlencode(sorted(params.items()))}".encode('utf-8')).hexdigest()
+
+    def remember(self, key:str, data:dict):
+        if self.memory_entries:
+            with self.lock:
+                self.parsed[key]=data
+                self.parsed.move_to_end(key)
+                while len(self.parsed) > self.memory_entries:
+                    self.parsed.popitem(last=False)
+
+    def cached_data(self, key:str, body:bytes|None=None)->dict:
+        # Parsed body of a cached response: from memory, else parsed from 'body' or the body file
+        with self.lock:
+            data=self.parsed.get(key)
+        if data is None:
+            if body is None:
+                with open(self.body_filepath(key), mode='rb') as _body:
+                    body=_body.read()
+            data=json.loads(body)
+            self.remember(key, data)
+        return data
+
+    def set_digest(self, key:str, digest:str):
+        # Record what the caller derived from this response, e.g. its registry hash
+        with self.lock:
+            entry=self.index.get(key)
+            if entry is not None and entry.get('digest') != digest:
+                entry['digest']=digest
+                self.dirty=True
+
+    def get(self, session, url:str, path:str, params:dict, headers:dict)->dict:
+        # Conditional GET of 'url' over 'session'
+        key=self.key(url, params)
+        with self.lock:
+            entry=self.index.get(key)
+            if entry is not None:
+                self.index.move_to_end(key)
+                entry=dict(entry)
+        request_headers=dict(headers)
+        if entry is not None:
+            if entry.get('etag'):
+                request_headers['If-None-Match']=entry['etag']
+            if entry.get('last_modified'):
+                request_headers['If-Modified-Since']=entry['last_modified']
+        try:
+            response=session.get(url, params=params, headers=request_headers)
+        except RequestException as err:
+            raise ConnectionException(str(err))
+
+        if response.status_code == 304 and entry is not None:
+            try:
+                data=self.cached_data(key)
+                Metrics.inc('magpy_http_cache_requests_total', result='not_modified')
+                return CachedResponse(data, key, unchanged=True, digest=entry.get('digest'))
+            except (OSError, ValueError):
+                # Body lost or torn: fetch it again unconditionally
+                with self.lock:
+                    self.drop(key)
+                return self.get(session, url, path, params, headers)
+
+        body=response.content
+        body_digest=blake2b(body, digest_size=16).hexdigest()
+        if response.ok and entry is not None and entry['body_digest'] == body_digest:
+            data=self.cached_data(key, body)
+            self.store(key, response, body_digest, len(body), entry.get('digest'))
+            Metrics.inc('magpy_http_cache_requests_total', result='identical')
+            return CachedResponse(data, key, unchanged=True, digest=entry.get('digest'))
+
+        data=WorldAnvilUtils.parse_response(path, response, params, {})
+        self.write_body(key, body)
+        self.store(key, response, body_digest, len(body))
+        self.remember(key, data)
+        Metrics.inc('magpy_http_cache_requests_total', result='changed' if entry is not None else 'miss')
+        return CachedResponse(data, key)
+
+    def store(self, key:str, response, body_digest:str, size:int, digest:str|None=None):
+        with self.lock:
+            previous=self.index.pop(key, None)
+            if previous is not None:
+                self.size -= previous['size']
+            self.index[key]={'etag': response.headers.get('ETag'),
+                             'last_modified': response.headers.get('Last-Modified'),
+                             'body_digest': body_digest,
+                             'size': size,
+                             'digest': digest}
+            self.size += size
+            self.dirty=True
+            self.evict()
+
+    def drop(self, key:str):
+        # Called with the lock held
+        entry=self.index.pop(key, None)
+        self.parsed.pop(key, None)
+        if entry is not None:
+            self.size -= entry['size']
+            self.dirty=True
+
+    def close(self):
+        self.flush()
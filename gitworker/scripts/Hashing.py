@@ -0,0 +1,85 @@
+from hashlib import sha1, blake2b
+import json
+import logging
+
+import Metrics
+
+logger=logging.getLogger(__name__)
+
+
+# Registry values are stored as '<version>:<hexdigest>'. Untagged values were
+# written before hash versioning and use the legacy scheme.
+LEGACY_HASH_VERSION='v1'
+CURRENT_HASH_VERSION='v2'
+HASH_TAG_SEPARATOR=':'
+
+# Characters of encoded JSON collected before each hash update
+CANONICAL_HASH_BUFFER=65536
+
+_canonical_encoder=json.JSONEncoder(sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def legacy_hash(value)->str:
+    # SHA1 of the key-order dependent JSON string, as written by Utils.get_hash
+    return sha1(json.dumps(value, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def canonical_hash(value)->str:
+    # BLAKE2b over canonical JSON (sorted keys, compact separators). The
+    # encoder's chunks are fed to the hash in batches of about
+    # CANONICAL_HASH_BUFFER characters, so the object is never serialized into
+    # a single string, nested members included.
+    hasher=blake2b(digest_size=20)
+    buffered=[]
+    size=0
+    for chunk in _canonical_encoder.iterencode(value):
+        buffered.append(chunk)
+        size+=len(chunk)
+        if size >= CANONICAL_HASH_BUFFER:
+            hasher.update(''.join(buffered).encode('utf-8'))
+            buffered.clear()
+            size=0
+    if buffered:
+        hasher.update(''.join(buffered).encode('utf-8'))
+    return hasher.hexdigest()
+
+HASH_SCHEMES={
+    LEGACY_HASH_VERSION: legacy_hash,
+    CURRENT_HASH_VERSION: canonical_hash
+}
+
+
+def split_hash(tagged_hash:str)->tuple:
+    try:
+        version, separator, digest=tagged_hash.partition(HASH_TAG_SEPARATOR)
+        if not separator:
+            return LEGACY_HASH_VERSION, tagged_hash
+        return version, digest
+    except Exception as e:
+        raise Exception(f"{e}")
+
+def hash_value(value, version:str=CURRENT_HASH_VERSION)->str:
+    try:
+        with Metrics.timed('magpy_hash_seconds', version=version):
+            digest=HASH_SCHEMES[version](value)
+        if version == LEGACY_HASH_VERSION:
+            return digest
+        return f"{version}{HASH_TAG_SEPARATOR}{digest}"
+    except Exception as e:
+        raise Exception(f"{e}")
+
+def matches(tagged_hash:str|None, value)->bool:
+    # Hash 'value' with the scheme of the stored entry, so entries written by
+    # older schemes keep comparing correctly until they are rewritten.
+    try:
+        if tagged_hash is None:
+            return False
+        version, _=split_hash(tagged_hash)
+        if version not in HASH_SCHEMES:
+            logger.warning(f"Unknown hash version '{version}', treating entry as changed.")
+            return False
+        return hash_value(value, version) == tagged_hash
+    except Exception as e:
+        raise Exception(f"{e}")
+
+def is_current(tagged_hash:str)->bool:
+    return split_hash(tagged_hash)[0] == CURRENT_HASH_VERSION
@@ -0,0 +1,81 @@
+import json
+import logging
+import os
+from hashlib import sha1
+
+logger=logging.getLogger(__name__)
+
+
+def blob_id(content:bytes)->str:
+    # git object id of 'content' stored as a blob
+    return sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+
+class WriteAheadJournal:
+    """
+    Append-only log of the object writes and registry updates made since the
+    last commit, one JSON record per line. Object records carry the git blob
+    id of the bytes written, so after a crash every object can be checked
+    against what was stored: intact objects are replayed into a commit,
+    torn or missing ones are rolled back. checkpoint() empties the journal
+    once a commit holds everything it describes.
+    Records are flushed to the OS on append and fsynced on checkpoint; a
+    record lost in a crash only means its object is picked up again by the
+    regular hash comparison on the next cycle.
+    """
+    def __init__(self, journal_filepath:str):
+        self.journal_filepath=journal_filepath
+        self.records=0
+        self.file=open(self.journal_filepath, mode='a', encoding='utf-8')
+
+    def append(self, record:dict):
+        try:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+            self.records += 1
+        except Exception as e:
+            logger.warning(f"Unable to append to journal: {self.journal_filepath}")
+            raise Exception(f"{e}")
+
+    def record_object(self, path:str, content:bytes):
+        self.append({'op': 'object', 'path': path, 'blob': blob_id(content)})
+
+    def record_asset(self, path:str):
+        # Assets are renamed into place once complete, so a present file is intact
+        self.append({'op': 'asset', 'path': path})
+
+    def record_removal(self, path:str):
+        self.append({'op': 'remove', 'path': path})
+
+    def record_registry(self, reg_name:str, entries:dict):
+        self.append({'op': 'registry', 'registry': reg_name, 'entries': entries})
+
+    def load(self)->list:
+        # Records up to the first incomplete line; a torn tail is the write that was interrupted
+        try:
+            records=[]
+            with open(self.journal_filepath, mode='r', encoding='utf-8') as journal:
+                for line in journal:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"Journal: ignoring torn record after {len(records)} records")
+                        break
+            return records
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def checkpoint(self):
+        try:
+            self.file.truncate(0)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if self.records:
+                logger.info(f"Journal checkpoint: {self.records} records committed")
+            self.records=0
+        except Exception as e:
+            logger.warning(f"Unable to checkpoint journal: {self.journal_filepath}")
+            raise Exception(f"{e}")
+
+    def close(self):
+        self.file.close()
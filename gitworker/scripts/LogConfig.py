@@ -0,0 +1,105 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from time import monotonic
+
+
+LOG_FORMAT="%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+LOG_SAMPLE_BURST=20
+LOG_SAMPLE_INTERVAL_S=60
+
+_listener=None
+
+
+class Lazy:
+    """
+    Log argument computed only when a handler formats the record, e.g.
+    logger.debug("Data: %s", Lazy(json.dumps, value, indent=2)). Records are
+    formatted on the listener thread, so the arguments should not be mutated
+    after the call.
+    """
+    __slots__=('func', 'args', 'kwargs')
+
+    def __init__(self, func, *args, **kwargs):
+        self.func=func
+        self.args=args
+        self.kwargs=kwargs
+
+    def __str__(self):
+        return str(self.func(*self.args, **self.kwargs))
+
+
+class SampleFilter(logging.Filter):
+    """
+    Rate-limits repetitive lines: per call site, the first 'burst' records
+    below WARNING in every 'interval_s' window pass, the rest are counted and
+    reported on the first record of the next window.
+    """
+    def __init__(self, burst:int=LOG_SAMPLE_BURST, interval_s:float=LOG_SAMPLE_INTERVAL_S):
+        super().__init__()
+        self.burst=burst
+        self.interval_s=interval_s
+        self.windows={}
+        self.lock=threading.Lock()
+
+    def filter(self, record:logging.LogRecord)->bool:
+        if record.levelno >= logging.WARNING or self.burst <= 0:
+            return True
+        key=(record.pathname, record.lineno)
+        now=monotonic()
+        with self.lock:
+            window=self.windows.get(key)
+            if window is None or now - window[0] >= self.interval_s:
+                suppressed=window[2] if window is not None else 0
+                self.windows[key]=[now, 1, 0]
+                if suppressed:
+                    record.msg=f"{record.msg} [{suppressed} similar lines suppressed]"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread."""
+    def prepare(self, record:logging.LogRecord)->logging.LogRecord:
+        return record
+
+
+def configure(level:str='INFO', module_levels:dict|None=None, stream=sys.stdout,
+              sample_burst:int=LOG_SAMPLE_BURST, sample_interval_s:float=LOG_SAMPLE_INTERVAL_S):
+    # Root logger writes through an in-process queue; a listener thread does the formatting and I/O.
+    # 'module_levels' maps logger (module) names to their own levels.
+    global _listener
+    stop()
+    stream_handler=logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue=queue.SimpleQueue()
+    queue_handler=DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(SampleFilter(burst=sample_burst, interval_s=sample_interval_s))
+
+    root=logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener=logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+def stop():
+    # Drain the queue and stop the listener thread
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener=None
+
+atexit.register(stop)
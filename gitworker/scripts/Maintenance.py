@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from time import monotonic, time
+
+import Metrics
+
+logger=logging.getLogger(__name__)
+
+
+MAINTENANCE_BUDGET_S=30
+MAINTENANCE_PRUNE_EXPIRE='1.day.ago'
+# name: interval in seconds; due tasks run in this order
+MAINTENANCE_INTERVALS_S={
+    'repack': 3600,
+    'multi-pack-index': 3600,
+    'commit-graph': 3600,
+    'prune': 24*3600,
+    'gc': 7*24*3600
+}
+
+
+class RepoMaintenance:
+    """
+    Housekeeping for the archive repository, run between tracking cycles:
+    loose objects are packed incrementally and indexed by a multi-pack-index,
+    the commit-graph is kept current, unreachable loose objects are pruned and
+    a full gc runs weekly. Due tasks run in order until 'budget_s' is spent; a
+    task whose last run took longer than the time left waits for a window it
+    can open, and a git command still running when the budget ends is killed.
+    'lock' is held throughout, so a push never runs alongside. Last runs are
+    persisted as JSON so the schedule survives restarts.
+    """
+    def __init__(self, repo, state_filepath:str, lock=None,
+                 intervals_s:dict=MAINTENANCE_INTERVALS_S,
+                 prune_expire:str=MAINTENANCE_PRUNE_EXPIRE):
+        self.repo=repo
+        self.state_filepath=state_filepath
+        self.lock=lock or threading.Lock()
+        self.intervals_s=intervals_s
+        self.prune_expire=prune_expire
+        self.state={}
+        self.load_state()
+
+    # Persistence section
+    def load_state(self):
+        try:
+            if os.path.exists(self.state_filepath):
+                with open(self.state_filepath, mode='r') as _state:
+                    self.state=json.load(_state)
+            logger.info(f"Maintenance state loaded: {len(self.state)} tasks")
+        except Exception as e:
+            logger.warning(f"Unable to load maintenance state, all tasks due: {e}")
+            self.state={}
+
+    def save_state(self):
+        try:
+            fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(self.state_filepath), prefix='.maintenance.', suffix='.tmp')
+            with os.fdopen(fd, mode='w') as _state:
+                json.dump(self.state, _state)
+            os.replace(tmp_path, self.state_filepath)
+        except Exception as e:
+            logger.warning(f"Unable to save maintenance state")
+            raise Exception(f"{e}")
+
+    # Task section
+    def commands(self, task:str)->list:
+        match task:
+            case 'repack':
+                # Loose objects into a new pack; existing packs are left alone
+                return [['repack', '-d', '-l', '-q']]
+            case 'multi-pack-index':
+                return [['multi-pack-index', 'write'], ['multi-pack-index', 'expire']]
+            case 'commit-graph':
+                return [['commit-graph', 'write', '--reachable', '--split']]
+            case 'prune':
+                return [['prune', f'--expire={self.prune_expire}']]
+            case 'gc':
+                return [['gc', '-q', f'--prune={self.prune_expire}']]
+        raise ValueError(f"Unknown maintenance task: {task}")
+
+    def due_tasks(self, now:float|None=None)->list:
+        now=time() if now is None else now
+        return [task for task, interval_s in self.intervals_s.items()
+                if now - self.state.get(task, {}).get('last_run', 0) >= interval_s]
+
+    def run_task(self, task:str, deadline:float)->bool:
+        # True when every command of the task finished within the deadline
+        started=monotonic()
+        try:
+            with Metrics.timed('magpy_git_operation_seconds', op=task):
+                for command in self.commands(task):
+                    remaining=deadline - monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("time budget spent")
+                    self.repo.git.execute(['git', *command], kill_after_timeout=remaining if remaining != float('inf') else None)
+            succeeded=True
+        except Exception as e:
+            logger.warning(f"Maintenance task '{task}' did not complete: {e}")
+            succeeded=False
+        # A failed task is retried after its interval, not in the next window
+        self.state[task]={'last_run': time(), 'duration_s': monotonic() - started, 'succeeded': succeeded}
+        return succeeded
+
+    def run(self, budget_s:float|None=MAINTENANCE_BUDGET_S, tasks:list|None=None)->list:
+        # Run the due tasks (or 'tasks') that fit in 'budget_s', None for no limit; returns the
+        # tasks run. Skipped while a push holds the lock
+        try:
+            started=monotonic()
+            deadline=started + budget_s if budget_s is not None else float('inf')
+            due=self.due_tasks() if tasks is None else tasks
+            if not due or not self.lock.acquire(blocking=False):
+                return []
+            ran=[]
+            try:
+                for task in due:
+                    remaining=deadline - monotonic()
+                    if ran and self.state.get(task, {}).get('duration_s', 0) > remaining:
+                        logger.info(f"Maintenance task '{task}' deferred: last run took {self.state[task]['duration_s']:.1f}s, {remaining:.1f}s left")
+                        continue
+                    self.run_task(task, deadline)
+                    ran.append(task)
+            finally:
+                self.lock.release()
+            if ran:
+                self.save_state()
+                logger.info(f"Repository maintenance: {', '.join(ran)} in {monotonic() - started:.1f}s")
+            return ran
+        except Exception as e:
+            logger.warning(f"Unable to run repository maintenance")
+            raise Exception(f"{e}")
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, time
+
+logger=logging.getLogger(__name__)
+
+
+HISTOGRAM_BUCKETS_S=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+STATS_INTERVAL_S=30
+
+# name: (type, help). Only declared metrics can be recorded.
+METRICS={
+    'magpy_cycles_total': ('counter', 'Tracking cycles completed.'),
+    'magpy_stage_seconds': ('histogram', 'Time spent in a tracking cycle stage.'),
+    'magpy_api_requests_total': ('counter', 'World Anvil API round trips by endpoint and outcome.'),
+    'magpy_api_request_seconds': ('histogram', 'World Anvil API round trip latency.'),
+    'magpy_rate_limit_wait_seconds': ('histogram', 'Time spent waiting for a rate limiter token.'),
+    'magpy_http_cache_requests_total': ('counter', 'Cached GET requests by result: miss, changed, identical body or not_modified.'),
+    'magpy_beacon_checks_total': ('counter', 'Beacon comparisons; result="unchanged" saved a content fetch.'),
+    'magpy_beacon_cache_hits_total': ('counter', 'Beacons the HTTP cache reported unchanged, compared without hashing.'),
+    'magpy_objects_changed_total': ('counter', 'Objects whose content changed and were written.'),
+    'magpy_assets_total': ('counter', 'Downloaded assets by result: stored or deduplicated.'),
+    'magpy_asset_bytes_total': ('counter', 'Asset bytes downloaded.'),
+    'magpy_hash_seconds': ('histogram', 'Time spent hashing registry values.'),
+    'magpy_registry_io_seconds': ('histogram', 'Registry file reads and writes.'),
+    'magpy_registry_bytes_total': ('counter', 'Registry file bytes read and written.'),
+    'magpy_object_write_seconds': ('histogram', 'Time spent writing tracked objects to the repository.'),
+    'magpy_git_operation_seconds': ('histogram', 'git stage, commit and push latency.'),
+    'magpy_git_commits_total': ('counter', 'Commits created.'),
+    'magpy_push_failures_total': ('counter', 'Failed pushes.'),
+    'magpy_push_lag_commits': ('gauge', 'Local commits not yet pushed.'),
+    'magpy_last_push_timestamp_seconds': ('gauge', 'Unix time of the last successful push.')
+}
+
+_lock=threading.Lock()
+_values={}
+_histograms={}
+
+
+def _key(name:str, labels:dict)->tuple:
+    if name not in METRICS:
+        raise KeyError(f"Undeclared metric: {name}")
+    return (name, tuple(sorted(labels.items())))
+
+def inc(name:str, value:float=1, **labels):
+    key=_key(name, labels)
+    with _lock:
+        _values[key]=_values.get(key, 0) + value
+
+def set_gauge(name:str, value:float, **labels):
+    key=_key(name, labels)
+    with _lock:
+        _values[key]=value
+
+def observe(name:str, value:float, **labels):
+    key=_key(name, labels)
+    position=bisect_left(HISTOGRAM_BUCKETS_S, value)
+    with _lock:
+        histogram=_histograms.get(key)
+        if histogram is None:
+            histogram=_histograms[key]={'buckets': [0] * (len(HISTOGRAM_BUCKETS_S) + 1), 'sum': 0.0, 'count': 0}
+        histogram['buckets'][position] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+@contextmanager
+def timed(name:str, **labels):
+    started=perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, perf_counter() - started, **labels)
+
+def reset():
+    with _lock:
+        _values.clear()
+        _histograms.clear()
+
+
+# Export section
+def _format_labels(labels:tuple, extra:tuple=())->str:
+    pairs=[*labels, *extra]
+    if not pairs:
+        return ''
+    escaped=(str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + '}'
+
+def render_prometheus()->str:
+    with _lock:
+        values=dict(_values)
+        histograms={key: {'buckets': list(hist['buckets']), 'sum': hist['sum'], 'count': hist['count']}
+                    for key, hist in _histograms.items()}
+    lines=[]
+    for name, (metric_type, help_text) in METRICS.items():
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {metric_type}')
+        if metric_type == 'histogram':
+            for (hist_name, labels), hist in sorted(histograms.items()):
+                if hist_name != name:
+                    continue
+                cumulative=0
+                for bound, count in zip(HISTOGRAM_BUCKETS_S, hist['buckets']):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels, (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_format_labels(labels, (("le", "+Inf"),))} {hist["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {hist["sum"]}')
+                lines.append(f'{name}_count{_format_labels(labels)} {hist["count"]}')
+        else:
+            for (value_name, labels), value in sorted(values.items()):
+                if value_name == name:
+                    lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+def _quantile(buckets:list, count:int, quantile:float):
+    # Upper bound of the bucket holding the quantile
+    if count == 0:
+        return None
+    rank=quantile * count
+    cumulative=0
+    for bound, bucket_count in zip((*HISTOGRAM_BUCKETS_S, float('inf')), buckets):
+        cumulative += bucket_count
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+def _total(snapshot_section:dict, name:str, field:str|None=None, **labels)->float:
+    total=0
+    for entry in snapshot_section.get(name, []):
+        if all(entry['labels'].get(label) == value for label, value in labels.items()):
+            total += entry[field] if field else entry['value']
+    return total
+
+def snapshot()->dict:
+    with _lock:
+        values=dict(_values)
+        histograms={key: {'buckets': list(hist['buckets']), 'sum': hist['sum'], 'count': hist['count']}
+                    for key, hist in _histograms.items()}
+    counters={}
+    for (name, labels), value in sorted(values.items()):
+        counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+    timings={}
+    for (name, labels), hist in sorted(histograms.items()):
+        timings.setdefault(name, []).append({'labels': dict(labels), 'count': hist['count'], 'sum': hist['sum'],
+                                             'p50': _quantile(hist['buckets'], hist['count'], 0.5),
+                                             'p95': _quantile(hist['buckets'], hist['count'], 0.95)})
+    beacon_checks=_total(counters, 'magpy_beacon_checks_total')
+    return {
+        'timestamp': time(),
+        'summary': {
+            # Where the time goes, in seconds since start
+            'api_s': _total(timings, 'magpy_api_request_seconds', 'sum'),
+            'rate_limit_wait_s': _total(timings, 'magpy_rate_limit_wait_seconds', 'sum'),
+            'hashing_s': _total(timings, 'magpy_hash_seconds', 'sum'),
+            'disk_s': _total(timings, 'magpy_registry_io_seconds', 'sum') + _total(timings, 'magpy_object_write_seconds', 'sum'),
+            'git_s': _total(timings, 'magpy_git_operation_seconds', 'sum'),
+            'beacon_hit_ratio': _total(counters, 'magpy_beacon_checks_total', result='unchanged') / beacon_checks if beacon_checks else None,
+            'push_lag_commits': _total(counters, 'magpy_push_lag_commits')
+        },
+        'metrics': counters,
+        'histograms': timings
+    }
+
+def write_stats_file(filepath:str):
+    try:
+        fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(filepath), prefix='.stats.', suffix='.tmp')
+        with os.fdopen(fd, mode='w') as stats:
+            json.dump(snapshot(), stats, indent=2)
+        os.replace(tmp_path, filepath)
+    except Exception as e:
+        logger.warning(f"Unable to write stats file: {filepath}")
+        raise Exception(f"{e}")
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type=render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/stats.json':
+            body, content_type=json.dumps(snapshot(), indent=2).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"Metrics endpoint: {format % args}")
+
+
+class MetricsExporter(threading.Thread):
+    """
+    Serves /metrics (Prometheus text) and /stats.json over HTTP when 'port' is
+    set, and rewrites 'stats_filepath' every 'interval_s' when that is set.
+    """
+    def __init__(self, host:str='0.0.0.0', port:int=0, stats_filepath:str|None=None,
+                 interval_s:float=STATS_INTERVAL_S):
+        super().__init__(name='metrics-exporter', daemon=True)
+        self.stats_filepath=stats_filepath
+        self.interval_s=interval_s
+        self.stopping=threading.Event()
+        self.server=None
+        if port:
+            try:
+                self.server=ThreadingHTTPServer((host, port), MetricsRequestHandler)
+                self.server.daemon_threads=True
+                threading.Thread(target=self.server.serve_forever, name='metrics-http', daemon=True).start()
+                logger.info(f"Metrics endpoint listening on {host}:{port}")
+            except OSError as e:
+                logger.warning(f"Metrics endpoint disabled, unable to listen on {host}:{port}: {e}")
+
+    def run(self):
+        while not self.stopping.wait(self.interval_s):
+            if self.stats_filepath:
+                try:
+                    write_stats_file(self.stats_filepath)
+                except Exception as e:
+                    logger.warning(f"Metrics exporter: {e}")
+
+    def stop(self):
+        self.stopping.set()
+        if self.server is not None:
+            self.server.shutdown()
+        if self.stats_filepath:
+            write_stats_file(self.stats_filepath)
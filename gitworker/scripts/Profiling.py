@@ -0,0 +1,151 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from time import perf_counter
+
+logger=logging.getLogger(__name__)
+
+
+PROFILE_TOP_N=30
+PROFILE_SAMPLE_INTERVAL_S=0.01
+PROFILE_KEEP_FILES=100
+
+
+class StackSampler(threading.Thread):
+    """
+    Sampling profiler: every 'interval_s' the stacks of all other threads are
+    recorded, so the cost does not grow with the number of calls made.
+    """
+    def __init__(self, interval_s:float=PROFILE_SAMPLE_INTERVAL_S):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.interval_s=interval_s
+        self.stacks=Counter()
+        self.samples=0
+        self.stopping=threading.Event()
+
+    def run(self):
+        own_id=threading.get_ident()
+        while not self.stopping.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack=[]
+                while frame is not None:
+                    code=frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{code.co_firstlineno}")
+                    frame=frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
+    def folded(self)->str:
+        # Collapsed stacks, the input format of flamegraph tools
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def summary(self, top_n:int=PROFILE_TOP_N)->str:
+        own=Counter()
+        total=Counter()
+        for stack, count in self.stacks.items():
+            functions=stack.split(';')
+            own[functions[-1]] += count
+            for function in set(functions):
+                total[function] += count
+        samples=sum(self.stacks.values()) or 1
+        lines=[f"{self.samples} samples every {self.interval_s * 1000:.0f} ms across threads", '',
+               f"{'own %':>7} {'total %':>7}  function"]
+        for function, count in own.most_common(top_n):
+            lines.append(f"{100 * count / samples:7.1f} {100 * total[function] / samples:7.1f}  {function}")
+        return '\n'.join(lines) + '\n'
+
+
+class CycleProfiler:
+    """
+    Profiles selected tracking cycles. Every 'every_n_cycles'-th cycle runs
+    under cProfile; with 'slow_cycle_s' set, the other cycles run under the
+    StackSampler and are kept only when they take longer than that. Each kept
+    profile is written to 'output_dir' as a dump (.prof or .folded) plus a
+    top-N text summary.
+    """
+    def __init__(self, output_dir:str, every_n_cycles:int=0, slow_cycle_s:float=0,
+                 top_n:int=PROFILE_TOP_N, keep_files:int=PROFILE_KEEP_FILES):
+        self.output_dir=output_dir
+        self.every_n_cycles=max(0, every_n_cycles)
+        self.slow_cycle_s=max(0, slow_cycle_s)
+        self.top_n=top_n
+        self.keep_files=keep_files
+        self.cycle=0
+        os.makedirs(self.output_dir, exist_ok=True)
+        logger.info(f"Cycle profiler enabled: every {self.every_n_cycles or '-'} cycles, slow cycles over {self.slow_cycle_s or '-'}s, output: {self.output_dir}")
+
+    def begin(self):
+        self.cycle += 1
+        self.started=perf_counter()
+        if self.every_n_cycles and self.cycle % self.every_n_cycles == 0:
+            profile=cProfile.Profile()
+            profile.enable()
+            return profile
+        if self.slow_cycle_s:
+            sampler=StackSampler()
+            sampler.start()
+            return sampler
+        return None
+
+    def end(self, session):
+        elapsed_s=perf_counter() - self.started
+        try:
+            match session:
+                case cProfile.Profile():
+                    session.disable()
+                    self.write_cprofile(session, elapsed_s)
+                case StackSampler():
+                    session.stop()
+                    if elapsed_s >= self.slow_cycle_s:
+                        self.write_samples(session, elapsed_s)
+        except Exception as e:
+            logger.warning(f"Unable to write profile for cycle {self.cycle}: {e}")
+
+    def run(self, func, *args, **kwargs):
+        session=self.begin()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.end(session)
+
+    # Output section
+    def filepath(self, elapsed_s:float, suffix:str)->str:
+        return os.path.join(self.output_dir,
+                            f"cycle-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{self.cycle}-{elapsed_s:.1f}s{suffix}")
+
+    def write_cprofile(self, profile:cProfile.Profile, elapsed_s:float):
+        profile.dump_stats(self.filepath(elapsed_s, '.prof'))
+        summary=io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(self.top_n)
+        self.write_summary(elapsed_s, summary.getvalue())
+
+    def write_samples(self, sampler:StackSampler, elapsed_s:float):
+        with open(self.filepath(elapsed_s, '.folded'), mode='w') as folded:
+            folded.write(sampler.folded())
+        self.write_summary(elapsed_s, sampler.summary(self.top_n))
+
+    def write_summary(self, elapsed_s:float, summary:str):
+        filepath=self.filepath(elapsed_s, '.txt')
+        with open(filepath, mode='w') as summary_file:
+            summary_file.write(f"Cycle {self.cycle}: {elapsed_s:.3f}s\n\n{summary}")
+        logger.warning(f"Cycle {self.cycle} profiled ({elapsed_s:.1f}s): {filepath}")
+        self.prune()
+
+    def prune(self):
+        # Keep the newest 'keep_files' profile files
+        files=sorted((entry for entry in os.scandir(self.output_dir) if entry.name.startswith('cycle-')),
+                     key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:max(0, len(files) - self.keep_files)]:
+            os.remove(entry.path)
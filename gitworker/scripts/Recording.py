@@ -0,0 +1,94 @@
+import gzip
+import json
+import logging
+import threading
+import zlib
+from time import perf_counter, time
+
+logger=logging.getLogger(__name__)
+
+
+RECORDING_FLUSH_EVERY=100
+# pywaclient endpoint methods used by WAClient; listings return generators
+RECORDED_ENDPOINTS=[('user', 'identity', False), ('user', 'worlds', True),
+                    ('world', 'get', False), ('world', 'categories', True), ('world', 'articles', True),
+                    ('category', 'get', False), ('article', 'get', False),
+                    ('world', 'images', True), ('world', 'maps', True), ('world', 'statblock_folders', True),
+                    ('block_folder', 'blocks', True), ('image', 'get', False), ('map', 'get', False), ('block', 'get', False)]
+
+
+class TrafficRecorder:
+    """
+    Appends every API call made through a BoromirApiClient to a gzip-compressed
+    JSON-lines file: endpoint, arguments, response body (or error, with its
+    exception class and HTTP status) and latency.
+    Each run adds a new gzip member, so the file only ever grows; a member cut
+    short by a crash loses only its unflushed tail.
+    """
+    def __init__(self, filepath:str, flush_every:int=RECORDING_FLUSH_EVERY):
+        self.filepath=filepath
+        self.flush_every=max(1, flush_every)
+        self.records=0
+        self.lock=threading.Lock()
+        self.file=gzip.open(self.filepath, mode='at', encoding='utf-8')
+        logger.info(f"Recording API traffic to {self.filepath}")
+
+    def record(self, endpoint:str, args:list, started:float, latency_s:float, body=None, error:Exception|None=None):
+        record={'endpoint': endpoint, 'args': args, 'time': started, 'latency_s': latency_s}
+        if error is None:
+            record['body']=body
+        else:
+            record['error']=f"{type(error).__name__}: {error}"
+            record['error_type']=type(error).__name__
+            record['status']=getattr(error, 'status', None)
+            record['retry_after']=getattr(error, 'retry_after', None)
+        line=json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.records += 1
+            if self.records % self.flush_every == 0:
+                self.file.flush()
+
+    def wrap(self, endpoint:str, func, listing:bool):
+        def recorded(*args):
+            started=time()
+            timer=perf_counter()
+            try:
+                result=func(*args)
+                # Listings are paged lazily; the recorded latency covers all pages
+                body=list(result) if listing else result
+            except Exception as e:
+                self.record(endpoint, list(args), started, perf_counter() - timer, error=e)
+                raise
+            self.record(endpoint, list(args), started, perf_counter() - timer, body=body)
+            return iter(body) if listing else body
+        return recorded
+
+    def install(self, client):
+        # Record the endpoint methods of 'client' that WAClient calls; asset downloads are not recorded
+        for endpoint_name, method_name, listing in RECORDED_ENDPOINTS:
+            endpoint=getattr(client, endpoint_name, None)
+            if not hasattr(endpoint, method_name):
+                continue
+            setattr(endpoint, method_name, self.wrap(f"{endpoint_name}.{method_name}", getattr(endpoint, method_name), listing))
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"API recording closed: {self.records} calls recorded in {self.filepath}")
+
+
+def read_records(filepath:str):
+    # Records of every gzip member in order; stops at a torn tail
+    read=0
+    try:
+        with gzip.open(filepath, mode='rt', encoding='utf-8') as recording:
+            for line in recording:
+                try:
+                    record=json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                read += 1
+                yield record
+    except (EOFError, gzip.BadGzipFile, zlib.error):
+        logger.warning(f"Recording {filepath} ends in a truncated member after {read} records")
@@ -0,0 +1,139 @@
+import heapq
+import json
+import logging
+import os
+import tempfile
+from time import time
+
+logger=logging.getLogger(__name__)
+
+
+SCHEDULER_MIN_INTERVAL_S=60
+SCHEDULER_MAX_INTERVAL_S=7*24*3600
+SCHEDULER_BACKOFF_FACTOR=1.5
+SCHEDULER_CHANGE_FRACTION=0.5
+SCHEDULER_EWMA_ALPHA=0.3
+SCHEDULER_TICK_REQUEST_BUDGET=500
+
+
+class PollScheduler:
+    """
+    Per-object polling schedule. Every UUID has a check interval, bounded by
+    [min_interval_s, max_interval_s]; a beacon hit (change) pulls the interval
+    towards a fraction of the object's average time between changes, a miss
+    backs it off. A min-heap of next-check times decides which objects are
+    polled in a tick, most overdue first, up to 'tick_budget' objects.
+    The schedule is persisted as JSON so it survives restarts.
+    """
+    def __init__(self, state_filepath:str,
+                 min_interval_s:float=SCHEDULER_MIN_INTERVAL_S,
+                 max_interval_s:float=SCHEDULER_MAX_INTERVAL_S,
+                 tick_budget:int=SCHEDULER_TICK_REQUEST_BUDGET):
+        self.state_filepath=state_filepath
+        self.min_interval_s=min_interval_s
+        self.max_interval_s=max(min_interval_s, max_interval_s)
+        self.tick_budget=max(1, tick_budget)
+        self.state={}
+        self.heap=[]
+        self.selected=set()
+        self.recorded=set()
+        self.load_state()
+
+    # Persistence section
+    def load_state(self):
+        try:
+            if os.path.exists(self.state_filepath):
+                with open(self.state_filepath, mode='r') as _state:
+                    self.state=json.load(_state)
+            self.heap=[(entry['next_check'], uuid) for uuid, entry in self.state.items()]
+            heapq.heapify(self.heap)
+            logger.info(f"Scheduler state loaded: {len(self.state)} objects")
+        except Exception as e:
+            logger.warning(f"Unable to load scheduler state, starting with an empty schedule: {e}")
+            self.state={}
+            self.heap=[]
+
+    def save_state(self):
+        try:
+            fd, tmp_path=tempfile.mkstemp(dir=os.path.dirname(self.state_filepath), prefix='.scheduler.', suffix='.tmp')
+            with os.fdopen(fd, mode='w') as _state:
+                json.dump(self.state, _state)
+            os.replace(tmp_path, self.state_filepath)
+        except Exception as e:
+            logger.warning(f"Unable to save scheduler state")
+            raise Exception(f"{e}")
+
+    def clamp(self, interval:float)->float:
+        return min(self.max_interval_s, max(self.min_interval_s, interval))
+
+    def schedule(self, uuid:str, next_check:float):
+        self.state[uuid]['next_check']=next_check
+        heapq.heappush(self.heap, (next_check, uuid))
+
+    # Tick section
+    def start_tick(self, now:float|None=None):
+        # Pop the most overdue objects that fit in this tick's budget
+        now=time() if now is None else now
+        self.selected=set()
+        self.recorded=set()
+        while self.heap and len(self.selected) < self.tick_budget:
+            next_check, uuid=self.heap[0]
+            if next_check > now:
+                break
+            heapq.heappop(self.heap)
+            entry=self.state.get(uuid)
+            # Skip heap entries superseded by a later reschedule or a forgotten uuid
+            if entry is None or entry['next_check'] != next_check or uuid in self.selected:
+                continue
+            self.selected.add(uuid)
+        logger.info(f"Scheduler tick: {len(self.selected)} objects due, {len(self.state)} scheduled")
+
+    def select_due(self, uuids:list)->list:
+        # Filter a mapping's uuids to those selected for this tick; unknown uuids
+        # are new objects and are polled right away while the budget allows
+        due=[]
+        for uuid in uuids:
+            if uuid in self.selected:
+                due.append(uuid)
+            elif uuid not in self.state and len(self.selected) < self.tick_budget:
+                self.state[uuid]={'interval': self.min_interval_s, 'next_check': 0, 'last_change': None, 'mean_change_s': None}
+                self.selected.add(uuid)
+                due.append(uuid)
+        return due
+
+    def record(self, uuid:str, changed:bool, now:float|None=None):
+        now=time() if now is None else now
+        entry=self.state[uuid]
+        if changed:
+            if entry['last_change'] is not None:
+                observed=now - entry['last_change']
+                mean=entry['mean_change_s']
+                entry['mean_change_s']=observed if mean is None else SCHEDULER_EWMA_ALPHA * observed + (1 - SCHEDULER_EWMA_ALPHA) * mean
+            entry['last_change']=now
+            mean=entry['mean_change_s']
+            entry['interval']=self.clamp(mean * SCHEDULER_CHANGE_FRACTION if mean is not None else self.min_interval_s)
+        else:
+            entry['interval']=self.clamp(entry['interval'] * SCHEDULER_BACKOFF_FACTOR)
+        self.recorded.add(uuid)
+        self.schedule(uuid, now + entry['interval'])
+
+    def end_tick(self, now:float|None=None):
+        # Selected objects that were not polled (e.g. no longer listed) count as a miss and
+        # wait a backed-off interval, so they never hold on to the most overdue slots
+        now=time() if now is None else now
+        for uuid in self.selected - self.recorded:
+            if uuid in self.state:
+                entry=self.state[uuid]
+                entry['interval']=self.clamp(entry['interval'] * SCHEDULER_BACKOFF_FACTOR)
+                self.schedule(uuid, now + entry['interval'])
+        self.selected=set()
+        self.recorded=set()
+        if len(self.heap) > 2 * len(self.state) + 1024:
+            self.heap=[(entry['next_check'], uuid) for uuid, entry in self.state.items()]
+            heapq.heapify(self.heap)
+        self.save_state()
+
+    def forget(self, uuids:list):
+        # Objects removed from the file index; their heap entries are skipped when popped
+        for uuid in uuids:
+            self.state.pop(uuid, None)
@@ -4,6 +4,8 @@ from cerberus import Validator
 import yaml
 import logging
 
+logger=logging.getLogger(__name__)
+
 
 
 
@@ -18,7 +20,7 @@ class WorldAnvilSecrets:
                 secrets=yaml.load(secret_file, yaml.Loader)
             return secrets
         except Exception as e:
-            logging.warning("Unable to load 'secrets' file.")
+            logger.warning("Unable to load 'secrets' file.")
             raise Exception(f"{e}")
     def validate_secret(self):
         try:
@@ -37,8 +39,8 @@ class WorldAnvilSecrets:
                 self.repo_ssh_url=wa_secret_map['remote_repo']['remote_repository_url']
                 self.worlds_list=wa_secret_map['track']['worlds']
                 
-                logging.info("Secrets loaded.")
+                logger.info("Secrets loaded.")
         except Exception as e:
-            logging.warning("Unable to process 'secrets' file.")
+            logger.warning("Unable to process 'secrets' file.")
             raise Exception(f"{e}")
 
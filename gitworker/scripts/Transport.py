@@ -0,0 +1,85 @@
+import logging
+from functools import cache
+
+import requests
+from requests.adapters import HTTPAdapter
+from pywaclient.endpoints import BasicEndpoint
+
+from APIUtils import WorldAnvilUtils as wau, RateLimiter
+
+logger=logging.getLogger(__name__)
+
+
+HTTP_POOL_CONNECTIONS=16
+# pywaclient's BasicEndpoint request methods, all overridden by TransportEndpoint
+ENDPOINT_REQUEST_METHODS=['_get_request', '_post_request', '_put_request', '_patch_request', '_delete_request']
+
+
+class APITransport:
+    """
+    The single route of WAClient's API requests: one keep-alive session, a
+    rate limiter token per round trip (every listing page included), retries
+    of transient failures that honour Retry-After, and GETs revalidated
+    through the HTTP cache when one is set. Other transports, such as the
+    benchmark's fake API, are mounted on 'session' as requests adapters.
+    """
+    def __init__(self, rate_limiter:RateLimiter=None, http_cache=None,
+                 pool_connections:int=HTTP_POOL_CONNECTIONS):
+        self.rate_limiter=rate_limiter or RateLimiter()
+        self.http_cache=http_cache
+        self.session=requests.Session()
+        adapter=HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_connections)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def round_trip(self, method:str, url:str, path:str, params:dict, content:dict, headers:dict):
+        if method == 'GET' and self.http_cache is not None:
+            return self.http_cache.get(self.session, url, path, params, headers)
+        return wau.request(self.session, method, url, path, params, content, headers)
+
+    def request(self, method:str, url:str, path:str, params:dict, content:dict, headers:dict):
+        return wau.retry_round_trip(self.rate_limiter, path, self.round_trip, method, url, path, params, content, headers)
+
+    def close(self):
+        self.session.close()
+
+
+class TransportEndpoint:
+    """
+    Mixin for pywaclient endpoints: their request methods go through the
+    APITransport of their client instead of module-level requests calls.
+    """
+    def _get_request(self, path:str, params:dict):
+        return self.client.transport.request('GET', self.client.base_url + path, path, params, {}, self.client.headers)
+
+    def _put_request(self, path:str, content:dict):
+        return self.client.transport.request('PUT', self.client.base_url + path, path, {}, content, self.client.headers_post)
+
+    def _patch_request(self, path:str, params:dict, content:dict):
+        return self.client.transport.request('PATCH', self.client.base_url + path, path, params, content, self.client.headers_post)
+
+    def _post_request(self, path:str, params:dict, content:dict):
+        return self.client.transport.request('POST', self.client.base_url + path, path, params, content, self.client.headers_post)
+
+    def _delete_request(self, path:str, params:dict):
+        return self.client.transport.request('DELETE', self.client.base_url + path, path, params, {}, self.client.headers)
+
+
+@cache
+def transport_endpoint_class(endpoint_class:type)->type:
+    return type(endpoint_class.__name__, (TransportEndpoint, endpoint_class), {})
+
+def route_endpoints(client, transport:APITransport)->int:
+    # Route every endpoint of a BoromirApiClient through 'transport'; returns how many were routed
+    missing=[name for name in ENDPOINT_REQUEST_METHODS if not callable(getattr(BasicEndpoint, name, None))]
+    if missing:
+        raise Exception(f"pywaclient's BasicEndpoint has no {', '.join(missing)}; TransportEndpoint needs updating")
+    client.transport=transport
+    routed=0
+    for endpoint in vars(client).values():
+        if isinstance(endpoint, BasicEndpoint):
+            if not isinstance(endpoint, TransportEndpoint):
+                endpoint.__class__=transport_endpoint_class(type(endpoint))
+            routed += 1
+    logger.info(f"{routed} API endpoints routed through the transport")
+    return routed
@@ -3,23 +3,36 @@ import time
 from datetime import datetime
 import logging
 import sys
+import signal
 import git
+import asyncio
+import os
+import queue
+import threading
+import multiprocessing
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor
 
+import Assets
 import BackendUtils
+import GitBackends
+import Hashing
+import Journal
+import LogConfig
+import Metrics
+from Maintenance import RepoMaintenance, MAINTENANCE_BUDGET_S, MAINTENANCE_INTERVALS_S
+from Profiling import CycleProfiler
+from Scheduler import PollScheduler
+from HTTPCache import HTTPCache
+from Recording import TrafficRecorder
 from APIClients import WAClient
+from APIUtils import RateLimiter, RATE_LIMIT_REQUESTS_PER_S, RATE_LIMIT_BURST
+from AsyncAPIClients import AsyncWAClient
 from APIRelationships import WorldAnvilRelationships
 from Secrets import WorldAnvilSecrets
 from Schemas import WORLDANVIL_SECRET_SCHEMA
 
-
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+logger=logging.getLogger('gitworker')
 
 
 NULL_UUID="00000000-0000-0000-0000-000000000000"
@@ -29,61 +42,250 @@ VERSION='0.1'
 SSH_ID_FILE='/home/gitworker/.ssh/id_rsa'
 REPO_PATH='/home/gitworker/repo'
 FILE_INDEX_PATH='/home/gitworker/repo/file_index'
+FILE_INDEX_MEMBERS_PATH='/home/gitworker/repo/file_index_members.json'
 QUIT_AT='2038-01-11 11:01'
 SECRET_PATH='/run/secrets/secret_config'
 PING_INTERVAL_S=60
+REGISTRY_WRITE_BEHIND=True
+REGISTRY_BACKEND='json'
+REGISTRY_DB_PATH='/home/gitworker/repo/registry.db'
+FETCH_MAX_WORKERS=8
+GIT_BATCH_COMMITS=True
+GIT_MAX_OBJECTS_PER_COMMIT=500
+GIT_COMMIT_ENGINE='index'
+GIT_MATERIALIZE_WORKTREE=True
+PUSH_IN_BACKGROUND=True
+SCHEDULER_ENABLED=False
+SCHEDULER_STATE_PATH='/home/gitworker/repo/scheduler_state.json'
+# git repack/multi-pack-index/commit-graph/prune/gc between cycles, within MAINTENANCE_BUDGET_S
+MAINTENANCE_ENABLED=True
+MAINTENANCE_STATE_PATH='/home/gitworker/repo/maintenance_state.json'
+ASYNC_DRIVER=False
+ASYNC_MAX_IN_FLIGHT=200
+METRICS_HOST='0.0.0.0'
+METRICS_PORT=9108
+METRICS_STATS_PATH='/home/gitworker/repo/stats.json'
+METRICS_STATS_INTERVAL_S=30
+PROFILE_EVERY_N_CYCLES=0
+PROFILE_SLOW_CYCLE_S=0
+PROFILE_DIR='/home/gitworker/repo/profiles'
+SHARD_PROCESSES=0
+SHARD_STATE_PATH='/home/gitworker/shards'
+SHARD_RESTART_DELAY_S=30
+SHARD_SHUTDOWN_TIMEOUT_S=120
+REGISTRY_NAMES=['beacon_hash_reg', 'track_hash_reg', 'file_index']
+FILE_INDEX_TYPES={'world': 'world', 'categories': 'category', 'articles': 'article',
+                  'images': 'image', 'maps': 'map', 'article_blocks': 'block'}
+# Resolved in this order every cycle, where enabled in 'track_changes'
+TRACKED_TYPES=['world', 'categories', 'articles', 'images', 'maps', 'article_blocks']
+# Types whose binary (an image file, a map's image) is archived in the asset store
+ASSET_TYPES=['images', 'maps']
+# Key under which an archived object refers to its asset
+ASSET_KEY='magpy_asset'
+# Objects are stored at '<type>/<uuid[:2]>/<uuid>.json'; file_index records each object's path.
+# Entries recorded before the sharded layout hold only the type and stay at '<uuid>' until --migrate-layout
+OBJECT_PATH_FORMAT='{index_type}/{prefix}/{uuid}.json'
+OBJECT_PATH_SUFFIX='.json'
+JOURNAL_ENABLED=True
+JOURNAL_PATH='/home/gitworker/repo/journal.jsonl'
+# Use the article listings' entries as article beacons instead of one beacon call per article
+LISTING_BEACONS=False
+# gzip JSON-lines file to record all API traffic to, for offline replay; '' disables
+API_RECORDING_PATH=''
+HTTP_CACHE_ENABLED=True
+HTTP_CACHE_PATH='/home/gitworker/repo/http_cache'
+HTTP_CACHE_MAX_BYTES=256*1024*1024
+LOG_LEVEL='INFO'
+# Per-module overrides, e.g. {'APIClients': 'WARNING', 'BackendUtils': 'DEBUG'}
+LOG_MODULE_LEVELS={}
+# Per call site, lines below WARNING beyond this many per minute are dropped; 0 keeps all
+LOG_SAMPLE_BURST=20
 
 class Gitworker:
-    def __init__(self, secret_obj=None):
+    def __init__(self, secret_obj=None,
+                 batch_commits:bool=GIT_BATCH_COMMITS,
+                 max_objects_per_commit:int=GIT_MAX_OBJECTS_PER_COMMIT):
+        self.batch_commits=batch_commits
+        self.max_objects_per_commit=max(1, max_objects_per_commit)
         self.load_secret(secret_obj)
         self.load_repo()
         self.load_registries()
+        self.initiate_asset_store()
         self.validate_repo_settings()
         self.initiate_commit_backend()
+        self.initiate_commit_engine()
+        self.initiate_push_worker()
+        self.initiate_maintenance()
+        self.initiate_journal()
 
-        logging.info("Gitworker object initiated.")
+        logger.info("Gitworker object initiated.")
     def load_secret(self, secret_obj=None):
         try:
             self.repo_ssh_url=secret_obj.repo_ssh_url
-            logging.info("Gitworker: secrets loaded...")
+            logger.info("Gitworker: secrets loaded...")
         except Exception as e:
-            logging.warning("Gitworker: unable to load secrets")
+            logger.warning("Gitworker: unable to load secrets")
             raise Exception(f"{e}")
     def load_repo(self):
         try:
             self.remote_repo_name=self.repo_ssh_url.rstrip('.git').split('/')[-1]
             self.repo_path=f"{REPO_PATH}/{self.remote_repo_name}"
             self.repo=git.Repo(self.repo_path)
-            logging.info("Gitworker: repository object set...")
+            logger.info("Gitworker: repository object set...")
         except Exception as e:
-            logging.warning("Gitworker: unable to load repository")
+            logger.warning("Gitworker: unable to load repository")
             raise Exception(f"{e}")
     def load_registries(self):
         try:
+            backend_kwargs={'write_behind': REGISTRY_WRITE_BEHIND}
+            if REGISTRY_BACKEND == 'sqlite':
+                backend_kwargs['db_filepath']=REGISTRY_DB_PATH
             self.registries={
-                'beacon_hash_reg': BackendUtils.Registry(reg_dir_filepath=self.repo_path, reg_name='beacon_hash_reg'),
-                'track_hash_reg': BackendUtils.Registry(reg_dir_filepath=self.repo_path, reg_name='track_hash_reg'),
-                'file_index': BackendUtils.Registry(reg_dir_filepath=self.repo_path, reg_name='file_index')
+                reg_name: BackendUtils.REGISTRY_BACKENDS[REGISTRY_BACKEND](reg_dir_filepath=self.repo_path,
+                                                                          reg_name=reg_name,
+                                                                          **backend_kwargs)
+                for reg_name in REGISTRY_NAMES
             }
+            self.file_index_members=BackendUtils.IndexMembers(FILE_INDEX_MEMBERS_PATH)
+            logger.info(f"Gitworker: registries loaded with '{REGISTRY_BACKEND}' backend...")
+        except Exception as e:
+            raise Exception(f"{e}")
+    def initiate_asset_store(self):
+        try:
+            self.asset_store=Assets.AssetStore(repo_path=self.repo_path, tracked=self.tracked_assets(self.repo))
+            logger.info(f"Gitworker: asset store set in {self.repo_path}/{Assets.ASSETS_DIR}...")
         except Exception as e:
             raise Exception(f"{e}")
+    @staticmethod
+    def tracked_assets(repo)->set:
+        # Asset paths in the git index; a stored file missing from it never made it into a commit
+        prefix=f"{Assets.ASSETS_DIR}/"
+        return {path for path, stage in repo.index.entries if path.startswith(prefix)}
     def validate_repo_settings(self):
         try:
             remote_repo_set=self.repo.remote('github-repo').exists()
             if remote_repo_set:
                 self.remote=self.repo.remote('github-repo')
             self.repo.heads['main'].checkout()
-            logging.info("Gitworker: remote repository validated...")
+            logger.info("Gitworker: remote repository validated...")
         except Exception as e:
-            logging.warning("Gitworker: unable to validate remote repository")
+            logger.warning("Gitworker: unable to validate remote repository")
             raise Exception(f"{e}")
     def initiate_commit_backend(self):
         try:
             self.commit_message=""
-            self.index_list=[reg_name for reg_name in self.registries.keys()]
-            logging.info("Gitworker: commit message and index initiated...")
+            self.index_list=[]
+            self.pending_sections=[]
+            self.unpushed_commits=0
+            logger.info("Gitworker: commit message and index initiated...")
+        except Exception as e:
+            logger.warning("Gitworker: unable to initiate commit message and index")
+            raise Exception(f"{e}")
+
+    def initiate_commit_engine(self):
+        try:
+            engine_kwargs={'materialize': GIT_MATERIALIZE_WORKTREE} if GIT_COMMIT_ENGINE == 'odb' else {}
+            self.commit_engine=GitBackends.COMMIT_ENGINES[GIT_COMMIT_ENGINE](repo=self.repo,
+                                                                             repo_path=self.repo_path,
+                                                                             **engine_kwargs)
+            logger.info(f"Gitworker: '{GIT_COMMIT_ENGINE}' commit engine initiated...")
         except Exception as e:
-            logging.warning("Gitworker: unable to initiate commit message and index")
+            logger.warning("Gitworker: unable to initiate commit engine")
+            raise Exception(f"{e}")
+
+    def initiate_push_worker(self):
+        try:
+            self.push_worker=None
+            # Shared with the maintenance tasks, which must not run during a push
+            self.git_lock=threading.Lock()
+            if PUSH_IN_BACKGROUND and hasattr(self, 'remote'):
+                self.push_worker=GitBackends.PushWorker(repo_path=self.repo_path,
+                                                        remote_name=self.remote.name,
+                                                        ssh_id_file=SSH_ID_FILE,
+                                                        lock=self.git_lock)
+                self.push_worker.start()
+                logger.info(f"Gitworker: background push worker started ({self.push_worker.unpushed_commits} unpushed commits)...")
+        except Exception as e:
+            logger.warning("Gitworker: unable to start push worker")
+            raise Exception(f"{e}")
+    def initiate_maintenance(self):
+        try:
+            self.maintenance=None
+            if MAINTENANCE_ENABLED:
+                self.maintenance=RepoMaintenance(repo=self.repo,
+                                                 state_filepath=MAINTENANCE_STATE_PATH,
+                                                 lock=self.git_lock)
+                logger.info(f"Gitworker: repository maintenance scheduled, {MAINTENANCE_BUDGET_S}s budget per idle window...")
+        except Exception as e:
+            logger.warning("Gitworker: unable to initiate repository maintenance")
+            raise Exception(f"{e}")
+    def initiate_journal(self):
+        try:
+            self.journal=None
+            if JOURNAL_ENABLED:
+                self.journal=Journal.WriteAheadJournal(JOURNAL_PATH)
+                self.recover_journal()
+                for registry in self.registries.values():
+                    registry.journal=self.journal
+                logger.info(f"Gitworker: write-ahead journal opened: {JOURNAL_PATH}...")
+        except Exception as e:
+            logger.warning("Gitworker: unable to initiate the journal")
+            raise Exception(f"{e}")
+    def recover_journal(self):
+        # Commit the objects of an interrupted cycle that made it to disk intact; roll back
+        # the rest and forget their hashes, so only those objects are fetched again
+        try:
+            records=self.journal.load()
+            if not records:
+                return
+            objects={}
+            assets=[]
+            removals=[]
+            registry_entries={}
+            for record in records:
+                match record['op']:
+                    case 'object':
+                        objects[record['path']]=record['blob']
+                    case 'asset':
+                        assets.append(record['path'])
+                    case 'remove':
+                        removals.append(record['path'])
+                    case 'registry':
+                        registry_entries.setdefault(record['registry'], {}).update(record['entries'])
+            rolled_back=[path for path, blob in objects.items() if not self.commit_engine.recover_object(path, blob)]
+            for path in rolled_back:
+                self.commit_engine.restore_object(path)
+            rolled_back_uuids=[self.path_uuid(path) for path in rolled_back]
+            for reg_name, entries in registry_entries.items():
+                if reg_name != 'file_index':
+                    entries={identifier: value for identifier, value in entries.items() if identifier not in rolled_back_uuids}
+                self.apply_registry_entries(reg_name, entries)
+            for reg_name in ['beacon_hash_reg', 'track_hash_reg']:
+                self.registries[reg_name].remove_entries(rolled_back_uuids)
+            # Removals the index engine staged already are no longer tracked and skipped
+            self.remove_objects(removals)
+
+            self.index_list.extend(path for path in objects if path not in rolled_back)
+            # An asset is only in place once complete
+            self.index_list.extend(path for path in assets if os.path.isfile(os.path.join(self.repo_path, path)))
+            self.update_commit_message(f"Replayed {len(objects) - len(rolled_back)} objects, rolled back {len(rolled_back)}")
+            if rolled_back:
+                self.update_commit_message(f"Rolled back: {', '.join(rolled_back)}")
+            self.add_to_index()
+            self.post_commit(short_commit_message="Recovered interrupted cycle")
+            logger.warning(f"Gitworker: journal recovered {len(records)} records, {len(objects) - len(rolled_back)} objects replayed, {len(rolled_back)} rolled back")
+        except Exception as e:
+            logger.warning("Gitworker: unable to recover the journal")
+            raise Exception(f"{e}")
+    def shutdown(self):
+        try:
+            if self.journal is not None:
+                self.journal.close()
+            if self.push_worker is not None:
+                logger.info(f"Gitworker: draining push worker ({self.push_worker.unpushed_commits} unpushed commits)...")
+                self.push_worker.stop()
+        except Exception as e:
+            logger.warning("Gitworker: unable to shut down cleanly")
             raise Exception(f"{e}")
 
     # Index list section
@@ -91,65 +293,417 @@ class Gitworker:
         try:
             if element != '':
                 self.index_list.append(element)
-                logging.info(f"Added element to git index: {element}")
+                logger.info("Added element to git index: %s", element)
             else:
-                logging.warning(f"Unable to add element to git index: {element}")
+                logger.warning(f"Unable to add element to git index: {element}")
                 raise Exception(f"Invalid element value. Index update aborted.")
         except Exception as e:
-            logging.warning("Unable to update list of git tracked indexes")
+            logger.warning("Unable to update list of git tracked indexes")
             raise Exception(f"{e}")
+    def flush_registries(self):
+        try:
+            for registry in self.registries.values():
+                registry.flush()
+            self.file_index_members.flush()
+        except Exception as e:
+            logger.warning(f"Unable to flush registries to disk.")
+            raise Exception(f"{e}")
+    @contextmanager
+    def registry_batch(self):
+        # Registry writes inside are grouped into one transaction where the backend supports it
+        with ExitStack() as stack:
+            for registry in self.registries.values():
+                stack.enter_context(registry.batch())
+            yield
     def add_to_index(self):
+        # Stage the registries and the objects changed since the last commit
         try:
-            self.repo.index.add(self.index_list)
-            logging.info(f"Update git index with the list of tracked objects: {self.index_list}")
+            self.flush_registries()
+            paths=list(dict.fromkeys([*self.registries.keys(), *self.index_list]))
+            with Metrics.timed('magpy_git_operation_seconds', op='stage'):
+                self.commit_engine.stage(paths)
+            logger.info("Update git index with %d changed objects", len(self.index_list))
+            logger.debug("Changed objects: %s", self.index_list)
         except Exception as e:
-            logging.warning(f"Unable to update the git index.")
+            logger.warning(f"Unable to update the git index.")
             raise Exception(f"{e}")
 
     # Commit section
     def update_commit_message(self, message:str=""):
         try:
             self.commit_message += ''.join([message, '\n'])
-            logging.info(f"Updated the commit message")
+            logger.debug("Updated the commit message")
         except Exception as e:
-            logging.warning(f"Unable to update the commit message")
+            logger.warning(f"Unable to update the commit message")
             raise Exception(f"{e}")
     def flush_commit_message(self):
         try:
             self.commit_message=""
-            logging.info(f"Commit message reset.")
+            logger.info(f"Commit message reset.")
         except Exception as e:
             raise Exception(f"{e}")
     def post_commit(self, short_commit_message:str="Object update"):
         try:
-            self.repo.index.commit(''.join([short_commit_message,
-                                            '\n\n',
-                                            self.commit_message])
-                                   )
-            logging.info(f"Commit posted: {short_commit_message} {self.commit_message[:20]}...")
+            with Metrics.timed('magpy_git_operation_seconds', op='commit'):
+                self.commit_engine.commit(''.join([short_commit_message,
+                                                   '\n\n',
+                                                   self.commit_message])
+                                          )
+            Metrics.inc('magpy_git_commits_total')
+            logger.info("Commit posted: %s %s...", short_commit_message, self.commit_message[:20])
+            if self.journal is not None:
+                self.journal.checkpoint()
             self.flush_commit_message()
+            self.index_list=[]
+            self.unpushed_commits += 1
+        except Exception as e:
+            logger.warning(f"Unable to post commit")
+            raise Exception(f"{e}")
+
+    # Batching section
+    def stage_object(self, path:str='', message:str=""):
+        try:
+            self.update_index_list(element=path)
+            self.update_commit_message(message=message)
+            if self.batch_commits and len(self.index_list) >= self.max_objects_per_commit:
+                self.commit_pending()
+        except Exception as e:
+            raise Exception(f"{e}")
+    def remove_objects(self, paths:list)->list:
+        # Delete objects from the archive in the next commit; returns the paths git tracked
+        try:
+            removed=set(paths)
+            self.index_list=[path for path in self.index_list if path not in removed]
+            entries=self.repo.index.entries
+            tracked=[path for path in paths if (path, 0) in entries]
+            if tracked:
+                if self.journal is not None:
+                    for path in tracked:
+                        self.journal.record_removal(path)
+                self.commit_engine.remove_objects(tracked)
+                logger.info("Removed %d objects from the archive", len(tracked))
+            return tracked
+        except Exception as e:
+            raise Exception(f"{e}")
+    def stage_asset(self, path:str=''):
+        try:
+            if self.journal is not None:
+                self.journal.record_asset(path)
+            self.update_index_list(element=path)
         except Exception as e:
-            logging.warning(f"Unable to post commit")
             raise Exception(f"{e}")
+    def commit_changes(self, short_commit_message:str="Object update"):
+        # Commit and push right away, or defer to the end of the cycle in batch mode
+        try:
+            if self.batch_commits:
+                if short_commit_message not in self.pending_sections:
+                    self.pending_sections.append(short_commit_message)
+                return
+            self.add_to_index()
+            self.post_commit(short_commit_message=short_commit_message)
+            self.push_to_remote_repository()
+        except Exception as e:
+            raise Exception(f"{e}")
+    def commit_pending(self):
+        try:
+            if not self.index_list and not self.pending_sections:
+                return
+            short_commit_message=', '.join(self.pending_sections) or "Object update"
+            self.add_to_index()
+            self.post_commit(short_commit_message=short_commit_message)
+            self.pending_sections=[]
+        except Exception as e:
+            logger.warning(f"Unable to commit pending changes")
+            raise Exception(f"{e}")
+    def finish_cycle(self):
+        # One commit (or one per GIT_MAX_OBJECTS_PER_COMMIT objects) and one push per cycle
+        try:
+            self.commit_pending()
+            self.flush_registries()
+            if self.journal is not None and not self.index_list:
+                # Registry-only changes (e.g. beacons of unchanged content) are on disk now
+                self.journal.checkpoint()
+            if self.unpushed_commits > 0:
+                self.push_to_remote_repository()
+        except Exception as e:
+            logger.warning(f"Unable to finish the commit cycle")
+            raise Exception(f"{e}")
+
+    # Layout section
+    @staticmethod
+    def sharded_path(index_type:str, uuid:str=NULL_UUID)->str:
+        return OBJECT_PATH_FORMAT.format(index_type=index_type, prefix=uuid[:2], uuid=uuid)
+
+    @staticmethod
+    def path_uuid(path:str)->str:
+        return os.path.basename(path).removesuffix(OBJECT_PATH_SUFFIX)
+
+    @staticmethod
+    def index_type(file_index_entry:str)->str:
+        # file_index entries are object paths, or just the type for objects in the flat layout
+        return file_index_entry.partition('/')[0]
 
-    def update_repo_object(self, uuid:str=NULL_UUID, new_content:dict|list={}):
+    def object_path(self, uuid:str=NULL_UUID, index_type:str|None=None)->str:
+        # Repository path of an object: the one recorded in file_index, else the sharded
+        # path for 'index_type'; objects indexed by type only are in the flat layout
         try:
-            with open(f'{REPO_PATH}/{self.remote_repo_name}/{uuid}', mode='w') as file:
-                new_content_str=json.dumps(new_content, indent=2)
+            entry=self.registries['file_index'].get_entries([uuid]).get(uuid)
+            if entry is None:
+                return self.sharded_path(index_type, uuid) if index_type else uuid
+            return entry if '/' in entry else uuid
+        except Exception as e:
+            raise Exception(f"{e}")
 
-                file.write(new_content_str)
-            logging.info(f"Object with uuid: {uuid} updated in the local repository.")
+    def update_repo_object(self, uuid:str=NULL_UUID, new_content:dict|list={}, index_type:str|None=None)->str:
+        # Returns the path the object was written to
+        try:
+            path=self.object_path(uuid, index_type)
+            with Metrics.timed('magpy_object_write_seconds'):
+                content=json.dumps(new_content, indent=2).encode('utf-8')
+                if self.journal is not None:
+                    self.journal.record_object(path, content)
+                self.commit_engine.write_object(path, content)
+            logger.info("Object with uuid: %s updated in the local repository: %s", uuid, path)
+            return path
         except Exception as e:
-            logging.warning(f"Unable to update local repo for uuid: {uuid}")
+            logger.warning(f"Unable to update local repo for uuid: {uuid}")
+            raise Exception(f"{e}")
+
+    def load_repo_object(self, uuid:str=NULL_UUID):
+        # Read from HEAD when the working tree is not materialized
+        try:
+            content=self.read_committed_object(self.object_path(uuid))
+            return json.loads(content) if content is not None else None
+        except Exception as e:
+            logger.warning(f"Unable to load object with uuid: {uuid} from the local repository")
+            raise Exception(f"{e}")
+
+    def load_tracked_content(self, uuid:str=NULL_UUID):
+        # Object as fetched from the API, without the asset reference added on archiving
+        content=self.load_repo_object(uuid)
+        if isinstance(content, dict):
+            content.pop(ASSET_KEY, None)
+        return content
+
+    def migrate_hash_registries(self, apiclient: WAClient = None):
+        # One-shot rehash of track/beacon registries into the current hash version.
+        # Tracked content is read back from the repository; beacons can only be
+        # rebuilt by refetching them, so they are skipped without an API client.
+        try:
+            self.registries['track_hash_reg'].migrate_hashes(self.load_tracked_content)
+
+            if apiclient is not None:
+                file_index=self.registries['file_index'].get_registry()
+                index_types={index_type: _type for _type, index_type in FILE_INDEX_TYPES.items()}
+                def load_beacon(uuid):
+                    objtype=index_types.get(self.index_type(file_index.get(uuid, '')))
+                    if objtype is None:
+                        return None
+                    return apiclient.apimethods_mapping[objtype](uuid=uuid, granularity=apiclient.beacon_gran[objtype])
+                self.registries['beacon_hash_reg'].migrate_hashes(load_beacon)
+
+            self.commit_changes(short_commit_message=f'Hash registries migrated to {Hashing.CURRENT_HASH_VERSION}')
+            self.finish_cycle()
+        except Exception as e:
+            logger.warning(f"Unable to migrate hash registries")
+            raise Exception(f"{e}")
+
+    def read_committed_object(self, path:str)->bytes|None:
+        # Object bytes from the working tree, or from HEAD when the working tree is not materialized
+        filepath=os.path.join(self.repo_path, path)
+        if os.path.isfile(filepath):
+            with open(filepath, mode='rb') as file:
+                return file.read()
+        try:
+            return self.repo.head.commit.tree[path].data_stream.read()
+        except KeyError:
+            return None
+
+    def migrate_layout(self):
+        # One-shot move of the objects indexed in the flat layout to their sharded paths, in a single commit
+        try:
+            file_index=self.registries['file_index'].get_registry()
+            flat={uuid: entry for uuid, entry in file_index.items() if '/' not in entry}
+            moved=[]
+            for uuid, index_type in flat.items():
+                path=self.sharded_path(index_type, uuid)
+                content=self.read_committed_object(uuid)
+                if content is not None:
+                    self.commit_engine.write_object(path, content)
+                    moved.append(uuid)
+                    self.index_list.append(path)
+                flat[uuid]=path
+            if not flat:
+                logger.info("Gitworker: all objects already in the sharded layout")
+                return 0
+            self.registries['file_index'].update_registry(value=flat)
+            self.commit_engine.remove_objects(moved)
+            self.update_commit_message(f"Moved {len(moved)} objects to {OBJECT_PATH_FORMAT}, {len(flat) - len(moved)} index entries without a stored object")
+            self.add_to_index()
+            self.post_commit(short_commit_message='Objects moved to the sharded layout')
+            self.push_to_remote_repository()
+            logger.info(f"Gitworker: {len(moved)} objects moved to the sharded layout")
+            return len(moved)
+        except Exception as e:
+            logger.warning(f"Unable to migrate the repository layout")
             raise Exception(f"{e}")
 
     def push_to_remote_repository(self):
         try:
-            with self.repo.git.custom_environment(GIT_SSH_COMMAND=f'ssh -i {SSH_ID_FILE}'):
+            if self.push_worker is not None:
+                self.push_worker.notify_commit(commits=self.unpushed_commits)
+                logger.info(f"Handed {self.unpushed_commits} commits to the push worker (lag: {self.push_worker.unpushed_commits})")
+                self.unpushed_commits=0
+                return
+            with Metrics.timed('magpy_git_operation_seconds', op='push'), self.repo.git.custom_environment(GIT_SSH_COMMAND=f'ssh -i {SSH_ID_FILE}'):
                 self.remote.push()
-            logging.info(f"Pushing commits to remote repository")
+            Metrics.set_gauge('magpy_last_push_timestamp_seconds', time.time())
+            logger.info(f"Pushing {self.unpushed_commits} commits to remote repository")
+            self.unpushed_commits=0
+        except Exception as e:
+            logger.warning(f"Unable to push to remote repository")
+            raise Exception(f"{e}")
+
+    def run_maintenance(self, budget_s:float|None=MAINTENANCE_BUDGET_S, tasks:list|None=None)->list:
+        # Only when idle: nothing staged or awaiting a commit, and every commit pushed
+        try:
+            if self.maintenance is None:
+                return []
+            if self.index_list or self.pending_sections or self.unpushed_commits:
+                return []
+            if self.push_worker is not None and self.push_worker.unpushed_commits > 0:
+                logger.debug(f"Maintenance skipped: {self.push_worker.unpushed_commits} commits waiting for the push worker")
+                return []
+            return self.maintenance.run(budget_s=budget_s, tasks=tasks)
         except Exception as e:
-            logging.warning(f"Unable to push to remote repository")
+            logger.warning(f"Unable to run repository maintenance")
+            raise Exception(f"{e}")
+
+    def apply_registry_entries(self, reg_name:str, entries:dict):
+        # Entries recorded as None were removed from the registry
+        try:
+            updated={identifier: value for identifier, value in entries.items() if value is not None}
+            removed=[identifier for identifier, value in entries.items() if value is None]
+            if updated:
+                self.registries[reg_name].update_registry(value=updated)
+            if removed:
+                self.registries[reg_name].remove_entries(removed)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    # Shard section
+    def commit_shard_changes(self, shard_commit:dict):
+        # Merge a shard's registry delta and commit the objects it wrote
+        try:
+            for reg_name, entries in shard_commit['registries'].items():
+                self.apply_registry_entries(reg_name, entries)
+            self.remove_objects(shard_commit.get('removed', []))
+            self.index_list.extend(shard_commit['paths'])
+            self.commit_message += shard_commit['message']
+            self.add_to_index()
+            self.post_commit(short_commit_message=shard_commit['summary'])
+            logger.info("Committed changes from shard %s: %d objects", shard_commit['shard'], len(shard_commit['paths']))
+        except Exception as e:
+            logger.warning(f"Unable to commit changes from shard {shard_commit.get('shard')}")
+            raise Exception(f"{e}")
+
+
+class ShardGitworker(Gitworker):
+    """
+    Gitworker used inside a shard process. Objects are written to the shared
+    working tree and hashes go to the shard's own registries; instead of
+    committing, each commit is handed to the committer process as the list of
+    written paths plus the registry entries changed since the previous one.
+    """
+    def __init__(self, shard_id:int, repo_path:str, commit_queue,
+                 batch_commits:bool=GIT_BATCH_COMMITS,
+                 max_objects_per_commit:int=GIT_MAX_OBJECTS_PER_COMMIT):
+        self.shard_id=shard_id
+        self.repo_path=repo_path
+        self.shard_path=f"{SHARD_STATE_PATH}/{shard_id}"
+        self.commit_queue=commit_queue
+        self.batch_commits=batch_commits
+        self.max_objects_per_commit=max(1, max_objects_per_commit)
+        self.push_worker=None
+        self.maintenance=None
+        self.journal=None
+        self.registry_delta={}
+        self.removed_paths=[]
+        self.load_registries()
+        self.initiate_asset_store()
+        self.initiate_commit_backend()
+        self.commit_engine=GitBackends.IndexCommitEngine(repo=None, repo_path=self.repo_path)
+
+        logger.info(f"ShardGitworker object initiated for shard {self.shard_id}.")
+    def load_registries(self):
+        try:
+            self.registries={
+                reg_name: BackendUtils.Registry(reg_dir_filepath=self.shard_path, reg_name=reg_name, write_behind=True)
+                for reg_name in REGISTRY_NAMES
+            }
+            self.file_index_members=BackendUtils.IndexMembers(f"{self.shard_path}/file_index_members.json")
+            logger.info(f"ShardGitworker: shard {self.shard_id} registries loaded from {self.shard_path}...")
+        except Exception as e:
+            raise Exception(f"{e}")
+    def initiate_asset_store(self):
+        # Assets go through the committer's index, read from the shared repository
+        try:
+            self.asset_store=Assets.AssetStore(repo_path=self.repo_path, tracked=self.tracked_assets(git.Repo(self.repo_path)))
+            logger.info(f"ShardGitworker: asset store set in {self.repo_path}/{Assets.ASSETS_DIR}...")
+        except Exception as e:
+            raise Exception(f"{e}")
+    def flush_registries(self):
+        # Keep the entries changed since the last hand-off, then persist the shard registries
+        try:
+            for reg_name, registry in self.registries.items():
+                self.registry_delta.setdefault(reg_name, {}).update(registry.dirty_entries())
+            super().flush_registries()
+        except Exception as e:
+            logger.warning(f"Unable to collect shard {self.shard_id} registry changes.")
+            raise Exception(f"{e}")
+    def add_to_index(self):
+        # Staging happens in the committer process
+        self.flush_registries()
+    def post_commit(self, short_commit_message:str="Object update"):
+        try:
+            self.commit_queue.put({
+                'shard': self.shard_id,
+                'summary': short_commit_message,
+                'message': self.commit_message,
+                'paths': list(dict.fromkeys(self.index_list)),
+                'removed': self.removed_paths,
+                'registries': self.registry_delta
+            })
+            logger.info("Shard %s: handed %d objects to the committer: %s", self.shard_id, len(self.index_list), short_commit_message)
+            self.flush_commit_message()
+            self.index_list=[]
+            self.registry_delta={}
+            self.removed_paths=[]
+        except Exception as e:
+            logger.warning(f"Unable to hand shard {self.shard_id} changes to the committer")
+            raise Exception(f"{e}")
+    def remove_objects(self, paths:list)->list:
+        # Removed in the committer process, which skips paths git does not track
+        self.index_list=[path for path in self.index_list if path not in set(paths)]
+        self.removed_paths.extend(paths)
+        return paths
+    def push_to_remote_repository(self):
+        # Pushes are done by the committer process
+        self.unpushed_commits=0
+    def abort_cycle(self):
+        # Hand over the objects staged before an error or SIGTERM. Hashes registered for objects
+        # that were not staged go back to their last handed-over value, so they are fetched again
+        try:
+            staged={self.path_uuid(path) for path in self.index_list}
+            for reg_name in ['beacon_hash_reg', 'track_hash_reg']:
+                registry=self.registries[reg_name]
+                unstaged=[identifier for identifier, value in registry.dirty_entries().items()
+                          if value is not None and identifier not in staged]
+                registry.revert_entries(unstaged)
+            self.commit_pending()
+            logger.warning(f"Shard {self.shard_id}: cycle aborted, {len(self.index_list)} staged objects handed over")
+        except Exception as e:
+            logger.warning(f"Unable to abort the cycle of shard {self.shard_id}")
             raise Exception(f"{e}")
 
 
@@ -165,37 +719,84 @@ class TrackWorld:
             self.world_uuid=world_uuid
             self.track_changes=track_changes
             self.apiobj_rels=apiobj_rels
-            logging.info(f">>> TrackWorld object initiated for world {self.world_uuid} owned by user {self.world_owner_uuid}. Track changes settings:\n{json.dumps(self.track_changes, indent=2)}")
+            logger.info(f">>> TrackWorld object initiated for world {self.world_uuid} owned by user {self.world_owner_uuid}. Track changes settings:\n{json.dumps(self.track_changes, indent=2)}")
         except Exception as e:
-            logging.warning(f"TrackWorld object could not be created")
+            logger.warning(f"TrackWorld object could not be created")
             raise Exception(f"{e}")
 
 class TrackObjectService:
-    def __init__(self, gitworker: Gitworker, trackobjs: dict, apiclient: WAClient):
+    def __init__(self, gitworker: Gitworker, trackobjs: dict, apiclient: WAClient,
+                 max_workers: int = FETCH_MAX_WORKERS, scheduler: PollScheduler = None,
+                 profiler: CycleProfiler = None):
         self.gitworker = gitworker
         self.trackobjs = trackobjs
         self.apiclient = apiclient
+        self.max_workers = max(1, max_workers)
+        self.scheduler = scheduler
+        self.profiler = profiler
+
+    def select_due(self, uuids: list):
+        if self.scheduler is None:
+            return uuids
+        due = self.scheduler.select_due(uuids)
+        logger.info("Scheduler: %d of %d objects due", len(due), len(uuids))
+        return due
+
+    def forget_polled(self, uuids: list):
+        if self.scheduler is not None:
+            self.scheduler.forget(uuids)
+
+    def record_polled(self, uuids: list, changed_uuids: list):
+        if self.scheduler is not None:
+            changed = set(changed_uuids)
+            for uuid in uuids:
+                self.scheduler.record(uuid, changed=uuid in changed)
+
+    def fetch_objects(self, objtype: str, uuids: list, granularity: int):
+        # Fetch objects on a bounded worker pool; results come back in the order of 'uuids'
+        try:
+            fetch = lambda uuid: self.apiclient.apimethods_mapping[objtype](uuid=uuid, granularity=granularity)
+            if self.max_workers == 1 or len(uuids) <= 1:
+                return [fetch(uuid) for uuid in uuids]
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(uuids))) as executor:
+                return list(executor.map(fetch, uuids))
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def fetch_beacons(self, objtype: str, uuids: list):
+        # Listing entries serve as beacons where the client kept them; the rest take a beacon call
+        try:
+            beacons = self.apiclient.get_listing_beacons(objtype, uuids)
+            missing = [uuid for uuid in uuids if uuid not in beacons]
+            beacons.update(zip(missing, self.fetch_objects(objtype, missing, self.apiclient.beacon_gran[objtype])))
+            return [beacons[uuid] for uuid in uuids]
+        except Exception as e:
+            raise Exception(f"{e}")
 
     def get_file_index_per_type(self, trackobj_identifier: str = NULL_UUID,
                                 _type:str=''):
         try:
-            wa_mapping_api_generators = {
-                    'world': lambda: self.apiclient.get_mapping(trackobj_identifier, 'world'),
-                    'categories': lambda: self.apiclient.get_mapping(trackobj_identifier, 'categories'),
-                    'articles': lambda: self.apiclient.get_mapping(trackobj_identifier, 'articles')
-            }
+            mapping = None
+            if _type != 'world':
+                mapping = self.apiclient.get_mapping(trackobj_identifier, _type)
+            return self.build_file_index_per_type(trackobj_identifier=trackobj_identifier, _type=_type, mapping=mapping)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def build_file_index_per_type(self, trackobj_identifier: str = NULL_UUID,
+                                  _type:str='', mapping:dict|None=None):
+        try:
             _file_index={}
             match _type:
                 case 'world':
                     _file_index={trackobj_identifier: 'world'}
                 case 'categories':
-                    _file_index={category_uuid: 'category' for category_uuid in wa_mapping_api_generators['categories']()}
-                case 'articles':
-                    articles_mapping = wa_mapping_api_generators['articles']()
-                    for cat in articles_mapping.keys():
-                        _file_index.update({article_uuid: 'article' for article_uuid in articles_mapping[cat]})
+                    _file_index={category_uuid: 'category' for category_uuid in mapping[trackobj_identifier]}
+                case 'articles' | 'images' | 'maps' | 'article_blocks':
+                    for parent_uuid in mapping.keys():
+                        _file_index.update({child_uuid: FILE_INDEX_TYPES[_type] for child_uuid in mapping[parent_uuid]})
                 case _:
-                    logging.warning(f"Invalid file index type: {_type}")
+                    logger.warning(f"Invalid file index type: {_type}")
                     raise Exception(f"Invalid file index type: {_type}")
             return _file_index
         except Exception as e:
@@ -203,23 +804,191 @@ class TrackObjectService:
 
     def update_file_index(self, trackobj_identifier: str = NULL_UUID):
         try:
-            temp_file_index=self.gitworker.registries['file_index'].get_registry()
-
-            for _type in ['world', 'categories', 'articles']:
-                if self.trackobjs[trackobj_identifier].track_changes[_type]:
-                    resolved_file_index=self.get_file_index_per_type(trackobj_identifier=trackobj_identifier,
-                                                                     _type=_type)
-                    temp_file_index.update(resolved_file_index)
+            types=[_type for _type in TRACKED_TYPES if self.trackobjs[trackobj_identifier].track_changes.get(_type, False)]
+            world_file_index={}
+            for _type in types:
+                world_file_index.update(self.get_file_index_per_type(trackobj_identifier=trackobj_identifier,
+                                                                     _type=_type))
 
-            if not self.gitworker.registries['file_index'].compare_against_registry(value=temp_file_index):
-                self.gitworker.registries['file_index'].update_registry(value=temp_file_index)
-                self.gitworker.add_to_index()
-                self.gitworker.post_commit(short_commit_message='File index updated')
-                self.gitworker.push_to_remote_repository()
-            logging.info(f">>>> File index updated <<<<")
+            self.commit_file_index(trackobj_identifier, world_file_index, types)
         except Exception as e:
             raise Exception(f"File index could not be updated. {e}")
 
+    def diff_file_index(self, trackobj_identifier: str, world_file_index: dict, types: list):
+        # Set difference between a world's listings and the entries it contributed last time;
+        # only entries of the refreshed types can be found removed
+        try:
+            indexed_types={FILE_INDEX_TYPES[_type] for _type in types}
+            members=self.gitworker.file_index_members.get(trackobj_identifier)
+            stored=self.gitworker.registries['file_index'].get_entries(members | world_file_index.keys())
+            stored={uuid: self.gitworker.index_type(entry) for uuid, entry in stored.items()}
+            added={uuid: objtype for uuid, objtype in world_file_index.items() if uuid not in stored}
+            retyped={uuid: objtype for uuid, objtype in world_file_index.items() if uuid in stored and stored[uuid] != objtype}
+            removed={uuid: stored[uuid] for uuid in members - world_file_index.keys() if stored.get(uuid) in indexed_types}
+            kept={uuid for uuid in members - world_file_index.keys() - removed.keys() if uuid in stored}
+            return added, removed, retyped, kept | world_file_index.keys()
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def commit_file_index(self, trackobj_identifier: str, world_file_index: dict, types: list):
+        try:
+            with self.gitworker.registry_batch():
+                added, removed, retyped, members=self.diff_file_index(trackobj_identifier, world_file_index, types)
+                self.gitworker.file_index_members.update(trackobj_identifier, members)
+                if not (added or removed or retyped):
+                    logger.info("File index unchanged for world %s", trackobj_identifier)
+                    return
+
+                # Stored paths, before retyped entries move to the path of their new type
+                old_paths={uuid: self.gitworker.object_path(uuid) for uuid in {**removed, **retyped}}
+                if added or retyped:
+                    self.gitworker.registries['file_index'].update_registry(value={uuid: self.gitworker.sharded_path(objtype, uuid)
+                                                                                   for uuid, objtype in {**added, **retyped}.items()})
+                if retyped:
+                    # Rewritten under the path of their new type; the old file goes
+                    for reg_name in ['beacon_hash_reg', 'track_hash_reg']:
+                        self.gitworker.registries[reg_name].remove_entries(list(retyped))
+                    self.gitworker.remove_objects([old_paths[uuid] for uuid in retyped])
+                    self.gitworker.update_commit_message(f"Retyped in world {trackobj_identifier}: {', '.join(f'{uuid} ({objtype})' for uuid, objtype in retyped.items())}")
+                if removed:
+                    # Forget the hashes too, so an object that comes back is fetched again
+                    for reg_name in ['file_index', 'beacon_hash_reg', 'track_hash_reg']:
+                        self.gitworker.registries[reg_name].remove_entries(list(removed))
+                    self.forget_polled(list(removed))
+                    self.gitworker.remove_objects([old_paths[uuid] for uuid in removed])
+                    self.gitworker.update_commit_message(f"Removed from world {trackobj_identifier}: {', '.join(f'{uuid} ({objtype})' for uuid, objtype in removed.items())}")
+                self.gitworker.commit_changes(short_commit_message='File index updated')
+                logger.info(">>>> File index updated for world %s: %d added, %d removed, %d retyped <<<<", trackobj_identifier, len(added), len(removed), len(retyped))
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def resolve_beacons(self, objtype: str, uuids: list, beacons: list):
+        # Return the beacons that changed, by uuid. They are registered by resolve_contents once
+        # their object is written, so a crash or a split commit never leaves a beacon ahead of its object
+        try:
+            changed_beacons = {}
+            registry = self.gitworker.registries['beacon_hash_reg']
+            cache_hits = self.cached_beacons(uuids, beacons)
+            Metrics.inc('magpy_beacon_cache_hits_total', len(cache_hits), objtype=objtype)
+            for uuid, beacon in zip(uuids, beacons):
+                if uuid in cache_hits:
+                    continue
+                logger.info(">>> Resolving %s-type Object Tracking <<<", objtype.capitalize())
+                if not registry.compare_against_entry(identifier=uuid, value=beacon):
+                    logger.info(">> Beacon hash condition satisfied <<")
+                    changed_beacons[uuid] = beacon
+            self.record_beacon_digests(uuids, beacons, cache_hits | changed_beacons.keys())
+            Metrics.inc('magpy_beacon_checks_total', len(changed_beacons), objtype=objtype, result='changed')
+            Metrics.inc('magpy_beacon_checks_total', len(uuids) - len(changed_beacons), objtype=objtype, result='unchanged')
+            return changed_beacons
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def cached_beacons(self, uuids: list, beacons: list):
+        # Beacons the HTTP cache reports unchanged whose recorded hash is still the registered one;
+        # these need no hashing
+        digests = {uuid: beacon.digest for uuid, beacon in zip(uuids, beacons)
+                   if getattr(beacon, 'unchanged', False) and beacon.digest is not None}
+        if not digests:
+            return set()
+        stored = self.gitworker.registries['beacon_hash_reg'].get_entries(digests)
+        return {uuid for uuid, digest in digests.items() if stored.get(uuid) == digest}
+
+    def record_beacon_digests(self, uuids: list, beacons: list, skipped: set = set()):
+        # Remember the registered hash of each cached beacon for the next cache hit
+        http_cache = getattr(self.apiclient, 'http_cache', None)
+        if http_cache is None:
+            return
+        cached = {uuid: beacon.cache_key for uuid, beacon in zip(uuids, beacons)
+                  if getattr(beacon, 'cache_key', None) is not None and uuid not in skipped}
+        stored = self.gitworker.registries['beacon_hash_reg'].get_entries(cached)
+        for uuid, cache_key in cached.items():
+            if uuid in stored:
+                http_cache.set_digest(cache_key, stored[uuid])
+
+    def pending_assets(self, objtype: str, uuids: list, contents: list):
+        # Objects of an asset type whose content changed, so their binary is downloaded again
+        if objtype not in ASSET_TYPES or not uuids:
+            return {}
+        stored = self.gitworker.registries['track_hash_reg'].get_entries(uuids)
+        return {uuid: content for uuid, content in zip(uuids, contents) if not Hashing.matches(stored.get(uuid), content)}
+
+    def archive_asset(self, objtype: str, content: dict):
+        url = self.apiclient.get_asset_url(objtype, content)
+        if not url:
+            return None
+        return self.gitworker.asset_store.store(self.apiclient.download_asset(url), url)
+
+    def register_assets(self, objtype: str, pending: dict, results: list):
+        # Stage newly stored assets; an object whose download failed keeps its old beacon, so it is retried next cycle
+        try:
+            assets = {}
+            failed = []
+            for uuid, result in zip(pending, results):
+                if isinstance(result, Exception):
+                    logger.warning(f"Unable to archive the asset of {objtype} {uuid}, retrying next cycle: {result}")
+                    failed.append(uuid)
+                elif result is not None:
+                    asset, new = result
+                    if new:
+                        self.gitworker.stage_asset(asset['path'])
+                    assets[uuid] = asset
+            return assets, failed
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def archive_assets(self, objtype: str, uuids: list, contents: list):
+        # Download the binaries of changed objects into the asset store; returns their
+        # asset references by uuid and the uuids whose download failed
+        try:
+            pending = self.pending_assets(objtype, uuids, contents)
+            if not pending:
+                return {}, []
+            def archive(content):
+                try:
+                    return self.archive_asset(objtype, content)
+                except Exception as e:
+                    return e
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending))) as executor:
+                results = list(executor.map(archive, pending.values()))
+            return self.register_assets(objtype, pending, results)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    def resolve_contents(self, objtype: str, uuids: list, contents: list, assets: dict = {}, beacons: dict = {}):
+        # Write, register and commit the objects whose content changed, then register their beacons
+        try:
+            with self.gitworker.registry_batch():
+                objs_changed = 0
+                for uuid, content in zip(uuids, contents):
+                    path = None
+                    if not self.gitworker.registries['track_hash_reg'].compare_against_entry(identifier=uuid, value=content):
+                        logger.info("> Content hash condition satisfied <")
+
+                        objs_changed += 1
+
+                        archived = {**content, ASSET_KEY: assets[uuid]} if uuid in assets else content
+                        path = self.gitworker.update_repo_object(uuid=uuid, new_content=archived, index_type=FILE_INDEX_TYPES[objtype])
+                        self.gitworker.registries['track_hash_reg'].update_entry(identifier=uuid, value=content)
+                    if uuid in beacons:
+                        self.gitworker.registries['beacon_hash_reg'].update_entry(identifier=uuid, value=beacons[uuid])
+                    if path is not None:
+                        self.gitworker.stage_object(path=path,
+                                                    message=f"{uuid}: {content.get('url', '')}, beacon gran: {self.apiclient.beacon_gran[objtype]}, track_gran: {self.apiclient.track_gran[objtype]}")
+                registered = [uuid for uuid in uuids if uuid in beacons]
+                self.record_beacon_digests(registered, [beacons[uuid] for uuid in registered])
+                if objs_changed > 0:
+                    Metrics.inc('magpy_objects_changed_total', objs_changed, objtype=objtype)
+                    self.gitworker.commit_changes(short_commit_message=f'{objtype.capitalize()} update')
+                return objs_changed
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    @staticmethod
+    def drop_failed(uuids: list, contents: list, failed: list):
+        kept = [(uuid, content) for uuid, content in zip(uuids, contents) if uuid not in failed]
+        return [uuid for uuid, _ in kept], [content for _, content in kept]
+
     def resolve_mapping(self, trackobj_identifier: str = NULL_UUID, objtype: str = 'world'):
         try:
             if trackobj_identifier not in self.trackobjs:
@@ -227,74 +996,449 @@ class TrackObjectService:
 
             trackobj = self.trackobjs[trackobj_identifier]
 
-            if trackobj.track_changes[objtype]:
-                logging.info(f"{objtype.capitalize()} tracking: ON. Fetching {trackobj.apiobj_rels.find_parent(objtype)}-{objtype} mapping...")
+            if trackobj.track_changes.get(objtype, False):
+                parent = trackobj.apiobj_rels.find_parent(objtype)
+                logger.info("%s tracking: ON. Fetching %s-%s mapping...", objtype.capitalize(), parent, objtype)
                 mapping = self.apiclient.get_mapping(_type=objtype, uuid=trackobj_identifier)
                 for key_uuid in mapping:
-                    logging.info(f">>>> Resolving {objtype.capitalize()} belonging to {trackobj.apiobj_rels.find_parent(objtype)}: {key_uuid} <<<<")
-                    objs_changed = 0
-                    for uuid in mapping[key_uuid]:
-                        beacon = self.apiclient.apimethods_mapping[objtype](uuid=uuid, granularity=self.apiclient.beacon_gran[objtype])
-                        logging.info(f">>> Resolving {objtype.capitalize()}-type Object Tracking <<<")
-                        if not self.gitworker.registries['beacon_hash_reg'].compare_against_entry(identifier=uuid, value=beacon):
-                            logging.info(f">> Beacon hash condition satisfied <<")
-                            self.gitworker.registries['beacon_hash_reg'].update_entry(identifier=uuid, value=beacon)
-
-                            content = self.apiclient.apimethods_mapping[objtype](uuid=uuid, granularity=self.apiclient.track_gran[objtype])
-                            if not self.gitworker.registries['track_hash_reg'].compare_against_entry(identifier=uuid, value=content):
-                                logging.info(f"> Content hash condition satisfied <")
-
-                                objs_changed += 1
-
-                                self.gitworker.update_repo_object(uuid=uuid, new_content=content)
-                                self.gitworker.registries['track_hash_reg'].update_entry(identifier=uuid, value=content)
-                                self.gitworker.update_index_list(element=uuid)
-                                self.gitworker.add_to_index()
-                                self.gitworker.update_commit_message(message=f"{uuid}: {content['url']}, beacon gran: {self.apiclient.beacon_gran[objtype]}, track_gran: {self.apiclient.track_gran[objtype]}")
-                    if objs_changed > 0:
-                        self.gitworker.post_commit(short_commit_message=f'{objtype.capitalize()} update')
-                        self.gitworker.push_to_remote_repository()
-                        objs_changed = 0
+                    logger.info(">>>> Resolving %s belonging to %s: %s <<<<", objtype.capitalize(), parent, key_uuid)
+                    uuids = self.select_due(list(mapping[key_uuid]))
+                    beacons = self.fetch_beacons(objtype, uuids)
+                    changed_beacons = self.resolve_beacons(objtype, uuids, beacons)
+                    changed_uuids = list(changed_beacons)
+                    self.record_polled(uuids, changed_uuids)
+
+                    contents = self.fetch_objects(objtype, changed_uuids, self.apiclient.track_gran[objtype])
+                    assets, failed = self.archive_assets(objtype, changed_uuids, contents)
+                    if failed:
+                        changed_uuids, contents = self.drop_failed(changed_uuids, contents, failed)
+                    self.resolve_contents(objtype, changed_uuids, contents, assets, changed_beacons)
             else:
-                logging.info(f"{objtype.capitalize()} tracking disabled in configuration file.")
+                logger.info("%s tracking disabled in configuration file.", objtype.capitalize())
         except Exception as e:
             raise Exception(f">>> Cannot resolve {objtype}. {e}")
 
+    def start_tick(self):
+        if self.scheduler is not None:
+            self.scheduler.start_tick()
+
+    def end_tick(self):
+        if self.scheduler is not None:
+            self.scheduler.end_tick()
+
+    def run_cycle(self):
+        with Metrics.timed('magpy_stage_seconds', stage='cycle'):
+            self.apiclient.mapping_cache.clear()
+            self.start_tick()
+            for identifier in self.trackobjs.keys():
+                with Metrics.timed('magpy_stage_seconds', stage='file_index'):
+                    self.update_file_index(identifier)
+                for objtype in TRACKED_TYPES:
+                    with Metrics.timed('magpy_stage_seconds', stage=f'resolve_{objtype}'):
+                        self.resolve_mapping(identifier, objtype=objtype)
+            with Metrics.timed('magpy_stage_seconds', stage='finish_cycle'):
+                self.gitworker.finish_cycle()
+            self.end_tick()
+            self.apiclient.flush_http_cache()
+        Metrics.inc('magpy_cycles_total')
+
     def main(self):
         try:
             while datetime.now() < datetime.strptime(QUIT_AT, '%Y-%m-%d %H:%M'):
-                for identifier in self.trackobjs.keys():
-                    self.update_file_index(identifier)
-                    self.resolve_mapping(identifier, objtype='world')
-                    self.resolve_mapping(identifier, objtype='categories')
-                    self.resolve_mapping(identifier, objtype='articles')
+                if self.profiler is None:
+                    self.run_cycle()
+                else:
+                    self.profiler.run(self.run_cycle)
+
+                idle_from=time.monotonic()
+                self.gitworker.run_maintenance(budget_s=min(MAINTENANCE_BUDGET_S, PING_INTERVAL_S))
+                time.sleep(max(0, PING_INTERVAL_S - (time.monotonic() - idle_from)))
+        except Exception as e:
+            logger.error(f"Error in main method: {e}")
+            raise Exception(f"Error in main method: {e}")
+
+class AsyncTrackObjectService(TrackObjectService):
+    """
+    asyncio driver for TrackObjectService. All tracked worlds are polled
+    concurrently through an AsyncWAClient with up to 'max_in_flight' requests
+    outstanding. Registry, file and git steps are synchronous, so each one
+    runs to completion, but the steps of different worlds interleave: one
+    world's split commit can flush the registries while another world's
+    contents are still being fetched. That is safe because a beacon is only
+    registered together with its written and staged object.
+    """
+    def __init__(self, gitworker: Gitworker, trackobjs: dict, apiclient: AsyncWAClient,
+                 max_in_flight: int = ASYNC_MAX_IN_FLIGHT, scheduler: PollScheduler = None,
+                 profiler: CycleProfiler = None):
+        super().__init__(gitworker=gitworker, trackobjs=trackobjs, apiclient=apiclient, scheduler=scheduler,
+                         profiler=profiler)
+        self.max_in_flight = max(1, max_in_flight)
+        self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+    async def fetch_objects(self, objtype: str, uuids: list, granularity: int):
+        async def fetch(uuid):
+            async with self.semaphore:
+                return await self.apiclient.apimethods_mapping[objtype](uuid=uuid, granularity=granularity)
+        try:
+            return await asyncio.gather(*(fetch(uuid) for uuid in uuids))
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    async def fetch_beacons(self, objtype: str, uuids: list):
+        try:
+            beacons = self.apiclient.get_listing_beacons(objtype, uuids)
+            missing = [uuid for uuid in uuids if uuid not in beacons]
+            beacons.update(zip(missing, await self.fetch_objects(objtype, missing, self.apiclient.beacon_gran[objtype])))
+            return [beacons[uuid] for uuid in uuids]
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    async def archive_asset(self, objtype: str, content: dict):
+        async with self.semaphore:
+            url = await self.apiclient.get_asset_url(objtype, content)
+        if not url:
+            return None
+        download = self.gitworker.asset_store.begin(url)
+        try:
+            async with self.semaphore:
+                async for chunk in self.apiclient.download_asset(url):
+                    download.write(chunk)
+        except Exception as e:
+            download.abort()
+            raise Exception(f"{e}")
+        return download.finish()
+
+    async def archive_assets(self, objtype: str, uuids: list, contents: list):
+        try:
+            pending = self.pending_assets(objtype, uuids, contents)
+            if not pending:
+                return {}, []
+            results = await asyncio.gather(*(self.archive_asset(objtype, content) for content in pending.values()),
+                                           return_exceptions=True)
+            return self.register_assets(objtype, pending, results)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    async def get_file_index_per_type(self, trackobj_identifier: str = NULL_UUID,
+                                      _type:str=''):
+        try:
+            mapping = None
+            if _type != 'world':
+                async with self.semaphore:
+                    mapping = await self.apiclient.get_mapping(trackobj_identifier, _type)
+            return self.build_file_index_per_type(trackobj_identifier=trackobj_identifier, _type=_type, mapping=mapping)
+        except Exception as e:
+            raise Exception(f"{e}")
+
+    async def update_file_index(self, trackobj_identifier: str = NULL_UUID):
+        try:
+            types = [_type for _type in TRACKED_TYPES if self.trackobjs[trackobj_identifier].track_changes.get(_type, False)]
+            resolved_file_indexes = await asyncio.gather(*(self.get_file_index_per_type(trackobj_identifier=trackobj_identifier,
+                                                                                        _type=_type) for _type in types))
+            world_file_index={}
+            for resolved_file_index in resolved_file_indexes:
+                world_file_index.update(resolved_file_index)
 
-                time.sleep(PING_INTERVAL_S)
+            self.commit_file_index(trackobj_identifier, world_file_index, types)
         except Exception as e:
-            logging.error(f"Error in main method: {e}")
+            raise Exception(f"File index could not be updated. {e}")
+
+    async def resolve_mapping(self, trackobj_identifier: str = NULL_UUID, objtype: str = 'world'):
+        try:
+            if trackobj_identifier not in self.trackobjs:
+                raise Exception(f"TrackWorld object with identifier {trackobj_identifier} not found.")
+
+            trackobj = self.trackobjs[trackobj_identifier]
+
+            if trackobj.track_changes.get(objtype, False):
+                parent = trackobj.apiobj_rels.find_parent(objtype)
+                logger.info("%s tracking: ON. Fetching %s-%s mapping...", objtype.capitalize(), parent, objtype)
+                async with self.semaphore:
+                    mapping = await self.apiclient.get_mapping(_type=objtype, uuid=trackobj_identifier)
+                for key_uuid in mapping:
+                    logger.info(">>>> Resolving %s belonging to %s: %s <<<<", objtype.capitalize(), parent, key_uuid)
+                    uuids = self.select_due(list(mapping[key_uuid]))
+                    beacons = await self.fetch_beacons(objtype, uuids)
+                    changed_beacons = self.resolve_beacons(objtype, uuids, beacons)
+                    changed_uuids = list(changed_beacons)
+                    self.record_polled(uuids, changed_uuids)
+
+                    contents = await self.fetch_objects(objtype, changed_uuids, self.apiclient.track_gran[objtype])
+                    assets, failed = await self.archive_assets(objtype, changed_uuids, contents)
+                    if failed:
+                        changed_uuids, contents = self.drop_failed(changed_uuids, contents, failed)
+                    self.resolve_contents(objtype, changed_uuids, contents, assets, changed_beacons)
+            else:
+                logger.info("%s tracking disabled in configuration file.", objtype.capitalize())
+        except Exception as e:
+            raise Exception(f">>> Cannot resolve {objtype}. {e}")
+
+    async def track_world(self, identifier: str):
+        with Metrics.timed('magpy_stage_seconds', stage='file_index'):
+            await self.update_file_index(identifier)
+        for objtype in TRACKED_TYPES:
+            with Metrics.timed('magpy_stage_seconds', stage=f'resolve_{objtype}'):
+                await self.resolve_mapping(identifier, objtype=objtype)
+
+    async def run_cycle(self):
+        with Metrics.timed('magpy_stage_seconds', stage='cycle'):
+            self.apiclient.mapping_cache.clear()
+            self.start_tick()
+            await asyncio.gather(*(self.track_world(identifier) for identifier in self.trackobjs.keys()))
+            with Metrics.timed('magpy_stage_seconds', stage='finish_cycle'):
+                self.gitworker.finish_cycle()
+            self.end_tick()
+        Metrics.inc('magpy_cycles_total')
+
+    async def main(self):
+        try:
+            async with self.apiclient:
+                while datetime.now() < datetime.strptime(QUIT_AT, '%Y-%m-%d %H:%M'):
+                    profile_session = self.profiler.begin() if self.profiler is not None else None
+                    try:
+                        await self.run_cycle()
+                    finally:
+                        if self.profiler is not None:
+                            self.profiler.end(profile_session)
+
+                    # No request is in flight between cycles, so blocking the loop here is harmless
+                    idle_from=time.monotonic()
+                    self.gitworker.run_maintenance(budget_s=min(MAINTENANCE_BUDGET_S, PING_INTERVAL_S))
+                    await asyncio.sleep(max(0, PING_INTERVAL_S - (time.monotonic() - idle_from)))
+        except Exception as e:
+            logger.error(f"Error in main method: {e}")
             raise Exception(f"Error in main method: {e}")
 
+def build_trackobjs(owner_uuid:str, worlds:dict):
+    # 'worlds' maps world uuids to their 'track_changes' settings
+    return { world_uuid: TrackWorld(owner_uuid, world_uuid, track_changes, WorldAnvilRelationships())
+            for world_uuid, track_changes in worlds.items() }
+
+def build_profiler(output_dir: str = PROFILE_DIR):
+    if not PROFILE_EVERY_N_CYCLES and not PROFILE_SLOW_CYCLE_S:
+        return None
+    return CycleProfiler(output_dir=output_dir, every_n_cycles=PROFILE_EVERY_N_CYCLES, slow_cycle_s=PROFILE_SLOW_CYCLE_S)
+
+def run_track_service(gitw: Gitworker, wa_secrets: WorldAnvilSecrets, trackobjs: dict,
+                      scheduler: PollScheduler = None, rate_limiter: RateLimiter = None,
+                      profiler: CycleProfiler = None, http_cache_dir: str = HTTP_CACHE_PATH,
+                      recording_path: str = API_RECORDING_PATH):
+    if ASYNC_DRIVER:
+        async_wacli = AsyncWAClient(application_key=wa_secrets.application_key,
+                                    authentication_token=wa_secrets.authentication_token,
+                                    rate_limiter=rate_limiter, listing_beacons=LISTING_BEACONS)
+        track_service = AsyncTrackObjectService(gitworker=gitw, trackobjs=trackobjs, apiclient=async_wacli,
+                                                scheduler=scheduler, profiler=profiler)
+        logger.info(f"AsyncTrackObjectService initialized.")
+        asyncio.run(track_service.main())
+    else:
+        http_cache = HTTPCache(cache_dir=http_cache_dir, max_bytes=HTTP_CACHE_MAX_BYTES) if HTTP_CACHE_ENABLED else None
+        recorder = TrafficRecorder(recording_path) if recording_path else None
+        wacli = WAClient(application_key=wa_secrets.application_key,
+                         authentication_token=wa_secrets.authentication_token,
+                         rate_limiter=rate_limiter, http_cache=http_cache, listing_beacons=LISTING_BEACONS,
+                         recorder=recorder, pool_connections=FETCH_MAX_WORKERS)
+        track_service = TrackObjectService(gitworker=gitw, trackobjs=trackobjs, apiclient=wacli,
+                                           scheduler=scheduler, profiler=profiler)
+        logger.info(f"TrackObjectService initialized.")
+        try:
+            track_service.main()
+        finally:
+            wacli.close()
+            if http_cache is not None:
+                http_cache.close()
+            if recorder is not None:
+                recorder.close()
+
+def configure_logging():
+    LogConfig.configure(level=LOG_LEVEL, module_levels=LOG_MODULE_LEVELS, sample_burst=LOG_SAMPLE_BURST)
+
+def run_shard(shard_id:int, shard_count:int, repo_path:str, owner_uuid:str, worlds:dict, commit_queue):
+    # Entry point of a shard process: track 'worlds' and hand commits to 'commit_queue'
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    configure_logging()
+    gitw = None
+    # Shards only keep a stats file; the HTTP endpoint belongs to the supervisor
+    metrics_exporter = Metrics.MetricsExporter(stats_filepath=f"{SHARD_STATE_PATH}/{shard_id}/stats.json",
+                                               interval_s=METRICS_STATS_INTERVAL_S)
+    metrics_exporter.start()
+    clean_exit = False
+    try:
+        wa_secrets = WorldAnvilSecrets(SECRET_PATH, WORLDANVIL_SECRET_SCHEMA)
+        gitw = ShardGitworker(shard_id=shard_id, repo_path=repo_path, commit_queue=commit_queue)
+        scheduler = PollScheduler(state_filepath=f"{gitw.shard_path}/scheduler_state.json") if SCHEDULER_ENABLED else None
+        # The API rate limit is shared between shards
+        rate_limiter = RateLimiter(requests_per_s=RATE_LIMIT_REQUESTS_PER_S / shard_count,
+                                   burst=max(1, RATE_LIMIT_BURST // shard_count))
+        run_track_service(gitw, wa_secrets, build_trackobjs(owner_uuid, worlds),
+                          scheduler=scheduler, rate_limiter=rate_limiter,
+                          profiler=build_profiler(f"{PROFILE_DIR}/shard-{shard_id}"),
+                          http_cache_dir=f"{gitw.shard_path}/http_cache",
+                          recording_path=API_RECORDING_PATH and f"{API_RECORDING_PATH}.shard-{shard_id}")
+        clean_exit = True
+    except Exception as e:
+        logger.error(f"Error in shard {shard_id}: {e}")
+        raise Exception(f"Error in shard {shard_id}: {e}")
+    finally:
+        # An error or SIGTERM can stop the cycle between a beacon and its object
+        if gitw is not None and clean_exit:
+            gitw.finish_cycle()
+        elif gitw is not None:
+            gitw.abort_cycle()
+        metrics_exporter.stop()
+        LogConfig.stop()
+
+
+class ShardSupervisor:
+    """
+    Shards the tracked worlds across worker processes, one per world or group
+    of worlds. Shard processes fetch, hash and serialize; this process is the
+    single git committer: it merges every shard's registry delta into the
+    repository registries, commits in arrival order and pushes.
+    Shard registries are reseeded from the repository registries on start.
+    """
+    def __init__(self, gitworker: Gitworker, owner_uuid: str, worlds: dict, processes: int = SHARD_PROCESSES):
+        try:
+            self.gitworker = gitworker
+            self.owner_uuid = owner_uuid
+            # 'spawn' keeps the committer's git and push threads out of the shard processes
+            self.context = multiprocessing.get_context('spawn')
+            self.commit_queue = self.context.Queue()
+            world_uuids = sorted(worlds)
+            self.shard_count = max(1, min(processes, len(world_uuids)))
+            self.shards = {shard_id: {world_uuid: worlds[world_uuid] for world_uuid in world_uuids[shard_id::self.shard_count]}
+                           for shard_id in range(self.shard_count)}
+            self.processes = {}
+            self.started_at = {}
+            logger.info(f"ShardSupervisor: {len(world_uuids)} worlds split across {self.shard_count} shards")
+        except Exception as e:
+            logger.warning(f"ShardSupervisor could not be created")
+            raise Exception(f"{e}")
+
+    def seed_shard_registries(self):
+        try:
+            self.gitworker.flush_registries()
+            for shard_id in self.shards:
+                shard_path = f"{SHARD_STATE_PATH}/{shard_id}"
+                os.makedirs(shard_path, exist_ok=True)
+                for reg_name, registry in self.gitworker.registries.items():
+                    BackendUtils.Registry(reg_dir_filepath=shard_path, reg_name=reg_name).write_registry(registry.get_registry())
+            logger.info(f"ShardSupervisor: shard registries seeded in {SHARD_STATE_PATH}")
+        except Exception as e:
+            logger.warning(f"Unable to seed shard registries")
+            raise Exception(f"{e}")
+
+    def start_shard(self, shard_id: int):
+        try:
+            process = self.context.Process(target=run_shard, name=f'shard-{shard_id}',
+                                           args=(shard_id, self.shard_count, self.gitworker.repo_path,
+                                                 self.owner_uuid, self.shards[shard_id], self.commit_queue))
+            process.start()
+            self.processes[shard_id] = process
+            self.started_at[shard_id] = time.monotonic()
+            logger.info(f"ShardSupervisor: shard {shard_id} started (pid {process.pid}) for worlds: {', '.join(self.shards[shard_id])}")
+        except Exception as e:
+            logger.warning(f"Unable to start shard {shard_id}")
+            raise Exception(f"{e}")
+
+    def check_shards(self):
+        # Restart shards that died, at most once per SHARD_RESTART_DELAY_S
+        for shard_id, process in self.processes.items():
+            if not process.is_alive() and time.monotonic() - self.started_at[shard_id] >= SHARD_RESTART_DELAY_S:
+                logger.warning(f"ShardSupervisor: shard {shard_id} exited with code {process.exitcode}, restarting")
+                self.start_shard(shard_id)
+
+    def commit_shard_changes(self, timeout: float):
+        # Commit everything the shards handed over; returns the number of commits
+        commits = 0
+        try:
+            shard_commit = self.commit_queue.get(timeout=timeout)
+            while True:
+                self.gitworker.commit_shard_changes(shard_commit)
+                commits += 1
+                shard_commit = self.commit_queue.get_nowait()
+        except queue.Empty:
+            return commits
+
+    def stop(self):
+        # Stop the shards, committing whatever they hand over while exiting
+        try:
+            for process in self.processes.values():
+                if process.is_alive():
+                    process.terminate()
+            deadline = time.monotonic() + SHARD_SHUTDOWN_TIMEOUT_S
+            while any(process.is_alive() for process in self.processes.values()) and time.monotonic() < deadline:
+                self.commit_shard_changes(timeout=1.0)
+            self.commit_shard_changes(timeout=1.0)
+            self.gitworker.finish_cycle()
+            logger.info(f"ShardSupervisor: shards stopped")
+        except Exception as e:
+            logger.warning(f"ShardSupervisor: unable to stop shards cleanly")
+            raise Exception(f"{e}")
+
+    def main(self):
+        try:
+            self.seed_shard_registries()
+            for shard_id in self.shards:
+                self.start_shard(shard_id)
+            try:
+                while datetime.now() < datetime.strptime(QUIT_AT, '%Y-%m-%d %H:%M'):
+                    if self.commit_shard_changes(timeout=PING_INTERVAL_S) > 0:
+                        self.gitworker.finish_cycle()
+                    else:
+                        # Nothing handed over for a whole interval: the shards are between cycles
+                        self.gitworker.run_maintenance()
+                    self.check_shards()
+            finally:
+                self.stop()
+        except Exception as e:
+            logger.error(f"Error in supervisor main method: {e}")
+            raise Exception(f"Error in supervisor main method: {e}")
+
 if __name__=='__main__':
+    # Turn 'docker stop' into SystemExit so pending pushes are drained below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    configure_logging()
+    gitw = None
+    metrics_exporter = Metrics.MetricsExporter(host=METRICS_HOST, port=METRICS_PORT,
+                                               stats_filepath=METRICS_STATS_PATH,
+                                               interval_s=METRICS_STATS_INTERVAL_S)
+    metrics_exporter.start()
     try:
         wa_secrets = WorldAnvilSecrets(SECRET_PATH, WORLDANVIL_SECRET_SCHEMA)
         gitw = Gitworker(wa_secrets)
+        if '--migrate-layout' in sys.argv:
+            gitw.migrate_layout()
+            sys.exit(0)
+        if '--maintenance' in sys.argv:
+            # Every task once, without a time budget
+            gitw.run_maintenance(budget_s=None, tasks=list(MAINTENANCE_INTERVALS_S))
+            sys.exit(0)
         wacli = WAClient(application_key=wa_secrets.application_key,
                         authentication_token=wa_secrets.authentication_token)
 
         owner_uuid = wacli.get_auth_user_id()['id']
         worlds_uuid_url_mapping = { _world['url']: _world['id'] for _world in wacli.get_user_worlds(uuid=owner_uuid)}
 
-        trackobjs = { worlds_uuid_url_mapping[_world['url']]: TrackWorld(owner_uuid,
-                                                                         worlds_uuid_url_mapping[_world['url']],
-                                                                         _world['track_changes'],
-                                                                         WorldAnvilRelationships()
-                                                                         )
-                    for _world in wa_secrets.worlds_list }
-        track_service = TrackObjectService(gitworker=gitw, trackobjs=trackobjs, apiclient=wacli)
-        logging.info(f"TrackObjectService initialized.")
-        track_service.main()
-        logging.info(f"TrackObjectService main loop finished.")
+        if '--migrate-hashes' in sys.argv:
+            gitw.migrate_hash_registries(apiclient=wacli)
+            sys.exit(0)
+
+        worlds = { worlds_uuid_url_mapping[_world['url']]: _world['track_changes'] for _world in wa_secrets.worlds_list }
+        if SHARD_PROCESSES > 0 or '--supervisor' in sys.argv:
+            ShardSupervisor(gitworker=gitw, owner_uuid=owner_uuid, worlds=worlds,
+                            processes=SHARD_PROCESSES or len(worlds)).main()
+        else:
+            scheduler = PollScheduler(state_filepath=SCHEDULER_STATE_PATH) if SCHEDULER_ENABLED else None
+            run_track_service(gitw, wa_secrets, build_trackobjs(owner_uuid, worlds), scheduler=scheduler,
+                              profiler=build_profiler())
+        logger.info(f"TrackObjectService main loop finished.")
     except Exception as e:
-        logging.error(f"Error in main: {e}")
+        logger.error(f"Error in main: {e}")
         raise Exception(f"Error in main: {e}")
+    finally:
+        if gitw is not None:
+            gitw.shutdown()
+        metrics_exporter.stop()
+        LogConfig.stop()
     print("End of script.")
@@ -3,8 +3,20 @@
 echo 'Initiating sys_setup.sh'
 cd /home/gitworker/repo
 
-echo "Preparing for cloning of $REMOTE_REPO_SSH_URL to $REMOTE_REPOSITORY_NAME"
-git clone $REMOTE_REPO_SSH_URL
+# Shallow (CLONE_DEPTH=1) and/or partial (CLONE_FILTER=blob:none) clone on first boot;
+# history and blobs beyond those are fetched by git on demand
+CLONE_ARGS=()
+if [ -n "$CLONE_DEPTH" ]; then
+	CLONE_ARGS+=(--depth "$CLONE_DEPTH")
+fi
+if [ -n "$CLONE_FILTER" ]; then
+	CLONE_ARGS+=(--filter="$CLONE_FILTER")
+fi
+
+if [ ! -d ./$REMOTE_REPOSITORY_NAME/.git ]; then
+	echo "Preparing for cloning of $REMOTE_REPO_SSH_URL to $REMOTE_REPOSITORY_NAME ${CLONE_ARGS[*]}"
+	git clone "${CLONE_ARGS[@]}" $REMOTE_REPO_SSH_URL
+fi
 cd $REMOTE_REPOSITORY_NAME
 
 if [ ! -f ./track_hash_reg ]; then